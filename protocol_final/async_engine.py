@@ -0,0 +1,1123 @@
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import frame_codec
+from frame_codec import (decode_sack, CAP_EXTENDED_SEQ, CAP_MTU_PROBE, CAP_STREAMS, CAP_STRIPES, CAP_COMPRESSION, CAP_FEC, CAP_RESUME, CAP_DELTA, STREAM_FLAG, STREAM_ID, DELTA_REQUEST, DELTA_HEADER, SUPPORTED_CAPABILITIES, encode_capabilities,
+                         decode_capabilities, handler_table)
+from window_manager import (SenderWindow, ReceiverWindow, Packet, MAX_SEQ_NUM, EXTENDED_SEQ_SPACE, WINDOW_SIZE,
+                            FILE_WINDOW_SIZE, RETRANSMIT_BUDGET, corrupt_frame)
+from retransmit import RttEstimator, MAX_RETRANSMISSIONS
+from congestion import create_controller, Pacer, CONTROLLERS
+from receiveThread import (handle_file_transfer, handle_text_message, handle_fec_parity, handle_resume_offer,
+                           handle_delta, control_answer, register_transfer, interrupt_transfers, send_sack, file_stream_id,
+                           reject_frame, RECEIVED_FILES_DIR)
+from sendThread import fragment_ranges, missing_fragments, DEFAULT_FRAGMENT_MAX_LENGTH
+from datagram_io import DatagramIO, MAX_SEGMENTS
+from stripes import StripeHeader, stripe_range, stripe_count, range_crc32, DEFAULT_STRIPES
+from compression import negotiated_codec, compress_file, CODECS, DEFAULT_CODEC, NO_CODEC
+from fec import FecEncoder, parse_fec
+from resume import file_identity, encode_offer, decode_answer
+from delta import Signature, build_patch, POLL_INTERVAL
+from frame_pool import FramePool
+import metrics
+from pmtu import (MtuSearch, interface_mtu, set_dont_fragment, fragment_length, PROBE_ATTEMPTS, IP_MTU_DISCOVER,
+                  IP_UDP_HEADER_LENGTH, MTU_PROBE_ACK)
+
+KEEP_ALIVE_INTERVAL = 5.0   # seconds
+CONNECT_ATTEMPTS = 5
+CONNECT_INTERVAL = 0.5
+SESSION_IDLE_TIMEOUT = 3 * KEEP_ALIVE_INTERVAL     # server mode drops peers silent for this long
+
+
+class TransportSocket:
+    # lets the receive handlers in receiveThread answer through the engine
+    def __init__(self, engine):
+        self.engine = engine
+
+    def sendto(self, data, addr):
+        self.engine.sendto(data, addr)
+
+
+class Session:
+    # protocol state for one peer, everything runs on the event loop so no locks are needed
+    def __init__(self, engine, addr):
+        self.engine = engine
+        self.addr = addr
+        self.loop = engine.loop
+        self.sock = TransportSocket(engine)
+        self.directory = RECEIVED_FILES_DIR
+        self.last_seen = time.time()
+
+        self.connected = False
+        self.connected_waiter = None
+        self.keepalive_ack = None
+        self.keepalive_task = None
+        self.capabilities = 0   # optional features agreed on in the SYN / SYN-ACK exchange
+        self.timestamp = 0
+
+        # sender state
+        self.sender_window = SenderWindow(WINDOW_SIZE)
+        self.streams = {}       # stream id -> SenderWindow of a file transfer running on its own stream
+        self.last_stream_id = 0
+        self.window_changed = asyncio.Event()
+        self.control_acks = {}  # timestamp -> future for frames sent outside the window
+        self.rtt = RttEstimator()
+        self.congestion = create_controller()
+        self.pacer = Pacer()
+        self.retransmissions = 0
+        self.budget = RETRANSMIT_BUDGET     # bytes of unacknowledged frames, all windows together
+        self.frag_max_len = DEFAULT_FRAGMENT_MAX_LENGTH
+        self.max_frag_len = DEFAULT_FRAGMENT_MAX_LENGTH     # raised by the path MTU probe
+        self.compression = DEFAULT_CODEC    # codec for files when the peer supports it, None sends them as is
+        self.fec = None                     # (group size, parity fragments) for files when the peer supports FEC
+        self.delta = False                  # send patches against the peer's copy of a file when it has one
+
+        # receiver state
+        self.receiver_window = ReceiverWindow(WINDOW_SIZE)
+        self.file_transfer_states = {}  # stream id -> FileTransferState, None for the transfer without a stream
+        self.fragmented_messages = {}
+        self.ack_timer = None
+
+    def next_timestamp(self):
+        self.timestamp = (self.timestamp + 1) % 256
+        return self.timestamp
+
+    def send_frame(self, msgType, flags=0, payload=b'', fragmentSeq=0, timestamp=None):
+        if timestamp is None:
+            timestamp = self.next_timestamp()
+        frame = frame_codec.encode(msgType, flags, payload, fragmentSeq, timestamp)
+        self.engine.sendto(frame, self.addr)
+        return frame
+
+    # --- connection control ---
+
+    async def connect(self):
+        if self.connected:
+            return True
+        self.connected_waiter = self.loop.create_future()
+        for attempt in range(CONNECT_ATTEMPTS):
+            print("Attempting connection...")
+            self.send_frame(1, flags=2, payload=encode_capabilities(self.engine.capabilities))
+            try:
+                await asyncio.wait_for(asyncio.shield(self.connected_waiter), CONNECT_INTERVAL)
+                print("Connection Established")
+                return True
+            except asyncio.TimeoutError:
+                continue
+        print("Connection failed")
+        return False
+
+    async def send_probe(self, size):
+        # True when a DF datagram of size bytes reached the peer
+        timestamp = self.next_timestamp()
+        waiter = self.loop.create_future()
+        self.control_acks[timestamp] = waiter
+        try:
+            for attempt in range(PROBE_ATTEMPTS):
+                self.send_frame(1, 6, bytes(size - frame_codec.HEADER_LENGTH), 0, timestamp)
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), self.rtt.timeout(attempt))
+                    return True
+                except asyncio.TimeoutError:
+                    continue
+            return False
+        finally:
+            self.control_acks.pop(timestamp, None)
+
+    async def probe_path_mtu(self):
+        # binary search for the largest UDP payload that reaches the peer, fragments are sized to fit it
+        search = MtuSearch(interface_mtu(*self.addr))
+        sock = self.engine.transport.get_extra_info('socket')
+        previous = set_dont_fragment(sock)
+        try:
+            size = search.next_probe()
+            while size is not None:
+                search.on_result(size, await self.send_probe(size))
+                size = search.next_probe()
+        finally:
+            if previous is not None:
+                sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, previous)
+        self.frag_max_len = self.max_frag_len = fragment_length(search.best)
+        self.engine.fit_buffers(search.best)
+        print(f"Path MTU {search.best + IP_UDP_HEADER_LENGTH} bytes, fragment length set to {self.frag_max_len}")
+        return search.best
+
+    def on_connected(self):
+        self.connected = True
+        if self.connected_waiter is not None and not self.connected_waiter.done():
+            self.connected_waiter.set_result(True)
+        if self.keepalive_task is None:
+            self.keepalive_task = self.loop.create_task(self.keep_alive())
+
+    def on_disconnected(self):
+        self.connected = False
+        if self.keepalive_task is not None:
+            self.keepalive_task.cancel()
+            self.keepalive_task = None
+        # transfers from the peer stop here, what arrived is kept for resuming
+        interrupt_transfers(self.file_transfer_states)
+
+    async def keep_alive(self):
+        try:
+            while self.connected:
+                await asyncio.sleep(KEEP_ALIVE_INTERVAL)
+                self.keepalive_ack = self.loop.create_future()
+                self.send_frame(1, flags=4)
+                try:
+                    await asyncio.wait_for(self.keepalive_ack, KEEP_ALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    print("Lost connection to peer")
+                    self.connected = False
+                    interrupt_transfers(self.file_transfer_states)
+                    self.engine.on_session_closed(self)
+        finally:
+            self.keepalive_task = None
+
+    def close(self):
+        self.send_frame(1, flags=8)
+        print("Cutting Connection")
+        self.on_disconnected()
+
+    def release(self):
+        # the session leaves the server's table, stop its timers and close files still being received
+        self.on_disconnected()
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        for window in [self.sender_window] + list(self.streams.values()):
+            for packet in window.packets.values():
+                packet.timer.cancel()
+            window.failed = True
+        self.window_changed.set()
+
+    def handle_control(self, frame, addr=None):
+        if frame.flags == 2:
+            self.capabilities = decode_capabilities(frame.payload) & self.engine.capabilities
+            self.send_frame(1, flags=3, payload=encode_capabilities(self.capabilities))
+            print(f"A peer has connected: {self.addr}")
+            self.receiver_window = ReceiverWindow(WINDOW_SIZE)
+            # a peer that connects again has given up its running transfers
+            interrupt_transfers(self.file_transfer_states)
+            self.on_connected()
+        elif frame.flags == 3:
+            self.capabilities = decode_capabilities(frame.payload) & self.engine.capabilities
+            self.on_connected()
+        elif frame.flags == 4:
+            self.send_frame(1, flags=5)  # response to keep alive
+        elif frame.flags == 5:
+            if self.keepalive_ack is not None and not self.keepalive_ack.done():
+                self.keepalive_ack.set_result(True)
+        elif frame.flags == 8:
+            self.send_frame(1, flags=9)
+            print("peer has cut their connection")
+            self.on_disconnected()
+            self.engine.on_session_closed(self)
+        elif frame.flags == 9:
+            self.on_disconnected()
+            self.engine.on_session_closed(self)
+        elif frame.flags == 6:
+            # path MTU probe, tell the sender how much arrived. Its fragments will be that large
+            self.engine.fit_buffers(frame_codec.HEADER_LENGTH + len(frame.payload))
+            self.send_frame(1, 7, MTU_PROBE_ACK.pack(frame_codec.HEADER_LENGTH + len(frame.payload)), 0,
+                            frame.timeStamp)
+        elif frame.flags == 7:
+            waiter = self.control_acks.pop(frame.timeStamp, None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(True)
+
+    # --- reliability ---
+
+    def track(self, packet):
+        packet.timer = self.loop.call_later(self.rtt.timeout(packet.retransmissions), self.on_packet_timeout, packet)
+
+    def retransmit(self, packet):
+        self.engine.sendto(packet.payload, self.addr)
+        packet.send_time = time.time()
+        packet.retransmissions += 1
+        self.retransmissions += 1
+        metrics.retransmits.inc()
+        packet.timer.cancel()
+        self.track(packet)
+
+    def window_for(self, packet):
+        if packet.stream_id is None:
+            return self.sender_window
+        return self.streams.get(packet.stream_id)
+
+    def on_packet_timeout(self, packet):
+        window = self.window_for(packet)
+        if packet.acknowledged or window is None or window.packets.get(packet.sequence_number) is not packet:
+            return
+        # the timer was armed with the RTO of the time it was sent, a growing queue may have raised it since
+        remaining = packet.send_time + self.rtt.timeout(packet.retransmissions) - time.time()
+        if remaining > 0:
+            packet.timer = self.loop.call_later(remaining, self.on_packet_timeout, packet)
+            return
+        if packet.retransmissions >= MAX_RETRANSMISSIONS:
+            print(f"Failed to send packet {packet.sequence_number} after {MAX_RETRANSMISSIONS} attempts")
+            window.remove_packet(packet.sequence_number)
+            window.failed = True
+            self.window_changed.set()
+            return
+        self.retransmit(packet)
+        self.congestion.on_timeout(None, self.rtt.srtt)
+
+    def on_acked(self, packets):
+        now = time.time()
+        for packet in packets:
+            packet.timer.cancel()
+        samples = [now - packet.send_time for packet in packets if packet.retransmissions == 0]
+        if samples:
+            self.rtt.sample(min(samples))
+        if packets:
+            self.congestion.on_ack(len(packets), now)
+            self.window_changed.set()
+
+    async def wait_for(self, condition, window=None):
+        # returns False when a packet ran out of retransmissions
+        window = self.sender_window if window is None else window
+        while not condition():
+            if window.failed:
+                window.failed = False
+                return False
+            self.window_changed.clear()
+            await self.window_changed.wait()
+        return True
+
+    def in_flight(self):
+        return len(self.sender_window.packets) + sum(len(window.packets) for window in self.streams.values())
+
+    def in_flight_bytes(self):
+        return self.sender_window.bytes + sum(window.bytes for window in self.streams.values())
+
+    def can_send(self, window=None):
+        # the congestion window is shared by all streams, each active stream may use an equal part of it.
+        # New fragments also wait while the unacknowledged ones fill the retransmission budget
+        window = self.sender_window if window is None else window
+        if (window.is_full() or not self.congestion.can_send(self.in_flight()) or
+                self.in_flight_bytes() >= self.budget):
+            return False
+        share = max(1, int(self.congestion.cwnd) // max(1, len(self.streams)))
+        return len(window.packets) < share
+
+    def open_stream(self, size):
+        stream_id = self.last_stream_id
+        while True:
+            stream_id = stream_id % MAX_SEQ_NUM + 1     # 1..65535, ids of finished streams are reused
+            if stream_id not in self.streams:
+                break
+        self.last_stream_id = stream_id
+        self.streams[stream_id] = SenderWindow(size, EXTENDED_SEQ_SPACE)
+        return stream_id, self.streams[stream_id]
+
+    def send_packet(self, msgType, flags, payload, timestamp=None, seq_num=None, window=None, stream_id=None,
+                    corrupt=False):
+        window = self.sender_window if window is None else window
+        if seq_num is None:
+            seq_num = window.next_seq_num
+            window.next_seq_num = (seq_num + 1) % window.seq_space
+        started = time.perf_counter()
+        frame = frame_codec.encode(msgType, flags, payload, seq_num & MAX_SEQ_NUM,
+                                   self.next_timestamp() if timestamp is None else timestamp)
+        metrics.on_fragment(time.perf_counter() - started, len(window.packets))
+        packet = Packet(seq_num, frame, time.time(), stream_id)
+        window.store(packet)
+        self.track(packet)
+        # with corrupt the peer gets a damaged copy first, the window keeps the frame for the resend
+        if corrupt:
+            metrics.corrupted_fragments.inc()
+        self.engine.sendto(corrupt_frame(frame) if corrupt else frame, self.addr)
+        return packet
+
+    def send_fragment(self, pool, file, length, window, batch, stream_id=None, indexed=False, corrupt=False):
+        # next file fragment framed in a buffer of the pool and queued in batch, see flush. Returns the file data
+        # it carries, None at the end
+        seq_num = window.next_seq_num
+        started = time.perf_counter()
+        fragment = pool.fragment(file, length, seq_num, self.next_timestamp(), stream_id, indexed)
+        if fragment is None:
+            return None
+        buffer, frame, data = fragment
+        window.next_seq_num = (seq_num + 1) % window.seq_space
+        metrics.on_fragment(time.perf_counter() - started, len(window.packets))
+        packet = Packet(seq_num, frame, time.time(), stream_id, buffer, pool)
+        window.store(packet)
+        self.track(packet)
+        if corrupt:
+            metrics.corrupted_fragments.inc()
+            print(f"Corrupting fragment {seq_num}")
+        batch.append(corrupt_frame(frame) if corrupt else frame)
+        return data
+
+    def flush(self, batch):
+        # Fragments that may leave right away go out together, a few per syscall. Nothing runs on the loop
+        # between queueing a fragment and its flush, so an ACK can't hand its buffer back before the frame is sent
+        if batch:
+            self.engine.send_many(batch, self.addr)
+            batch.clear()
+
+    async def send_reliable(self, msgType, flags, payload=b'', fragmentSeq=0, timestamp=None):
+        # frames outside the sender window (file metadata) are resent until the peer acknowledges them.
+        # Returns True, or the payload of an answer that carries more than an ACK (resume offers)
+        if timestamp is None:
+            timestamp = self.next_timestamp()
+        waiter = self.loop.create_future()
+        self.control_acks[timestamp] = waiter
+        try:
+            for attempt in range(MAX_RETRANSMISSIONS + 1):
+                if attempt:
+                    metrics.retransmits.inc()
+                send_time = time.time()
+                self.send_frame(msgType, flags, payload, fragmentSeq, timestamp)
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), self.rtt.timeout(attempt))
+                    if attempt == 0:
+                        self.rtt.sample(time.time() - send_time)
+                    return waiter.result()
+                except asyncio.TimeoutError:
+                    print(f"No ACK for message {timestamp}, attempt {attempt + 1}")
+            return False
+        finally:
+            self.control_acks.pop(timestamp, None)
+
+    async def fetch_signature(self, filename, flag, file_payload):
+        # chunk signatures of the peer's copy of the file, None when the peer does not answer
+        signature = Signature()
+        while True:
+            answer = await self.send_reliable(8, 1 | flag, file_payload(
+                DELTA_REQUEST.pack(len(signature.chunks), self.frag_max_len) + filename.encode('utf-8')))
+            if answer is True or not answer:
+                return None
+            remaining = signature.add_page(answer)
+            if remaining is None:
+                await asyncio.sleep(POLL_INTERVAL)  # the peer is still reading its copy
+            elif remaining == 0:
+                return signature
+
+    def handle_ack(self, frame, addr=None):
+        window = self.sender_window
+        if frame.flags == 1:
+            waiter = self.control_acks.pop(frame.timeStamp, None)
+            if waiter is not None:
+                if not waiter.done():
+                    waiter.set_result(True)
+                return
+            packet = window.packets.get(frame.fragmentSeq)
+            if packet is not None:
+                packet.acknowledged = True
+                window.remove_packet(frame.fragmentSeq)
+                self.on_acked([packet])
+
+        elif frame.flags == 2:
+            print(f"Received NAK for packet {frame.fragmentSeq}")
+            packet = window.packets.get(window.resolve(frame.fragmentSeq))
+            if packet is not None:
+                self.retransmit(packet)
+                self.congestion.on_loss(None, self.rtt.srtt)
+
+        elif frame.flags & ~STREAM_FLAG == 3:
+            # SACK of the sender window, or of a file stream when it carries a stream id
+            payload = frame.payload
+            if frame.flags & STREAM_FLAG:
+                window = self.streams.get(STREAM_ID.unpack_from(payload)[0])
+                payload = payload[STREAM_ID.size:]
+                if window is None:
+                    return
+            cumulative, selective = decode_sack(payload)
+            self.on_acked(window.process_sack(cumulative, selective))
+
+            # fast retransmit fragments the receiver skipped over
+            if selective:
+                lost = window.detect_losses(window.highest(cumulative, selective))
+                for packet in lost:
+                    self.retransmit(packet)
+                if lost:
+                    self.congestion.on_loss(None, self.rtt.srtt)
+
+    # --- sending ---
+
+    async def send_text(self, text, corrupt=False):
+        # corrupt (!err) damages the first copy of one fragment, the receiver has to notice and get it resent
+        fragMaxLen = self.frag_max_len
+        fragments = [text[i:i + fragMaxLen].encode('utf-8') for i in range(0, len(text), fragMaxLen)]
+        window = self.sender_window
+
+        if len(fragments) == 1:
+            # the receiver acknowledges single messages with the same fragmentSeq, always 1. The window
+            # starts over at 0 once it is empty when 1 has fallen behind its base
+            if not window.can_send(1):
+                if not await self.wait_for(lambda: not window.packets):
+                    return False
+                window.base = window.next_seq_num = 0
+            packet = self.send_packet(2, 1, fragments[0], seq_num=len(fragments), corrupt=corrupt)
+            return await self.wait_for(lambda: packet.acknowledged)
+
+        # the receiver drops fragments of a message it has not seen start, so the start is acknowledged first
+        message_id = self.next_timestamp()
+        if not await self.send_reliable(3, 2, fragmentSeq=len(fragments), timestamp=message_id):
+            return False
+        corrupt_fragment = random.randrange(len(fragments)) if corrupt else None
+        packets = []
+        for j, fragment in enumerate(fragments):
+            if not await self.wait_for(self.can_send):
+                return False
+            packets.append(self.send_packet(3, 4, j.to_bytes(4, byteorder='big') + fragment,
+                                            timestamp=message_id, corrupt=j == corrupt_fragment))
+        if not await self.wait_for(lambda: all(packet.acknowledged for packet in packets)):
+            return False
+
+        # completion packet
+        self.send_frame(2, flags=5)
+        return True
+
+    async def send_file(self, filepath, stripe=None, corrupt=False):
+        # stripe: (transfer id, index, count) sends just that byte range, see send_file_striped.
+        # corrupt (!err) damages the first copy of one fragment
+        fragMaxLen = self.frag_max_len
+        extended = bool(self.capabilities & CAP_EXTENDED_SEQ)
+        streams = bool(self.capabilities & CAP_STREAMS)
+
+        # With streams every file gets its own window next to the text window and other files,
+        # otherwise the file takes over the sender window
+        stream_id = None
+        window = None
+        if streams:
+            stream_id, window = self.open_stream(FILE_WINDOW_SIZE)
+
+        def file_payload(payload):
+            return payload if stream_id is None else STREAM_ID.pack(stream_id) + payload
+        flag = STREAM_FLAG if streams else 0
+        compressed = None
+        patch = None
+
+        try:
+            with open(filepath, 'rb') as file:
+                filename = os.path.basename(filepath)
+                file_size = os.fstat(file.fileno()).st_size
+                source = file
+                if stripe is None:
+                    name = filename.encode('utf-8')
+
+                    # when the peer has a copy of the file only a patch against it is sent
+                    if self.delta and self.capabilities & CAP_DELTA:
+                        signature = await self.fetch_signature(filename, flag, file_payload)
+                        if signature is None:
+                            return False
+                        if signature.count:
+                            patch = build_patch(file, signature, file_size)
+                            if patch is None:
+                                print(f"{filename} differs too much from the peer's copy, sending it whole")
+                            else:
+                                print(f"Delta against the peer's copy of {filename}: {patch[2]} of {file_size} "
+                                      f"bytes reused, {patch[1]} bytes of patch")
+                                delta_header = DELTA_HEADER.pack(signature.size, file_size, patch[3])
+                                source, file_size = patch[0], patch[1]
+
+                    codec = negotiated_codec(self.capabilities, self.compression)
+                    if codec is not None:
+                        compressed = compress_file(source, codec, file_size)
+                        if compressed is None:
+                            print(f"{filename} does not compress, sending it as is")
+                            codec = None
+                        else:
+                            print(f"Compressed {filename} with {codec.name}: {file_size} -> {compressed[1]} bytes")
+                            file_size = compressed[1]
+                    if self.capabilities & CAP_COMPRESSION:
+                        name = bytes([codec.id if codec else NO_CODEC]) + name
+                    print(f"Sending file: {filename}" + (f" on stream {stream_id}" if streams else ""))
+                    if not await self.send_reliable(4, 1 | flag, file_payload(name)):
+                        return False
+                    if patch and not await self.send_reliable(8, 3 | flag, file_payload(delta_header)):
+                        return False
+                else:
+                    # from here on the stripe is sent like a file of its own
+                    transfer_id, index, count = stripe
+                    total_size = file_size
+                    offset, file_size = stripe_range(total_size, index, count)
+                    header = StripeHeader(transfer_id, total_size, offset, file_size, index, count,
+                                          range_crc32(file, offset, file_size), filename)
+                    print(f"Sending stripe {index + 1}/{count} of {filename}: {file_size} bytes at {offset}")
+                    if not await self.send_reliable(4, 7 | flag, file_payload(header.pack())):
+                        return False
+                    file.seek(offset)
+
+                if not await self.send_reliable(4, 2 | flag, file_payload(str(file_size).encode('utf-8'))):
+                    return False
+
+                # a receiver that kept part of this file from an interrupted transfer answers with what it is
+                # missing, resuming needs the 32-bit fragment index
+                ranges = None
+                if self.capabilities & CAP_RESUME and (extended or streams) and stripe is None:
+                    answer = await self.send_reliable(7, 1 | flag, file_payload(
+                        encode_offer(file_identity(file, codec), fragMaxLen)))
+                    if not answer:
+                        return False
+                    if answer is not True:
+                        fragment_size, ranges = decode_answer(answer)
+                        if 0 < fragment_size <= fragMaxLen:
+                            fragMaxLen = fragment_size
+                        else:
+                            ranges = None
+
+                fragment_count = (file_size + fragMaxLen - 1) // fragMaxLen
+                if ranges is None:
+                    ranges = [(0, fragment_count)]
+                resuming = ranges != [(0, fragment_count)]
+                if resuming:
+                    print(f"Resuming {filename}: {fragment_count - missing_fragments(ranges)} of {fragment_count} "
+                          f"fragments already at the peer")
+                # without the 32-bit index the 16-bit sequence number is the fragment index and must not wrap
+                if not extended and not streams and fragment_count > MAX_SEQ_NUM + 1:
+                    print(f"File needs {fragment_count} fragments, the peer supports at most {MAX_SEQ_NUM + 1}, "
+                          f"increase the fragment length")
+                    return False
+                if not await self.send_reliable(4, 3 | flag, file_payload(str(fragment_count).encode('utf-8'))):
+                    return False
+                corrupt_fragment = random.randrange(fragment_count) if corrupt and fragment_count else None
+
+                # parity fragments after every group let the receiver repair losses without a retransmission
+                # FEC groups follow the fragment order from the start of the file, a resumed transfer goes without
+                encoder = FecEncoder(*self.fec) if self.fec and self.capabilities & CAP_FEC and not resuming else None
+
+                # The receiver uses the sequence number as the fragment index, so every file starts a new window
+                if not streams:
+                    window = self.sender_window = SenderWindow(FILE_WINDOW_SIZE,
+                                                               EXTENDED_SEQ_SPACE if extended else MAX_SEQ_NUM + 1)
+
+                # fragments are framed in buffers of the pool, the window hands them back once acknowledged.
+                # Every wait flushes the batch first
+                pool = FramePool(fragMaxLen)
+                batch = []
+                source = compressed[0] if compressed else source
+                for index, length in fragment_ranges(source, fragMaxLen, ranges, file_size):
+                    if index != window.next_seq_num:
+                        # the receiver has the fragments up to index, the window continues there once it is empty
+                        self.flush(batch)
+                        if not await self.wait_for(lambda: not window.packets, window):
+                            return False
+                        window.base = window.next_seq_num = index
+                    if not self.can_send(window):
+                        self.flush(batch)
+                        if not await self.wait_for(lambda: self.can_send(window), window):
+                            return False
+
+                    # Spread the window over the round trip instead of sending it in one burst
+                    delay = self.pacer.delay(self.congestion.cwnd, self.rtt.srtt)
+                    if delay > 0:
+                        self.flush(batch)
+                        await asyncio.sleep(delay)
+                        self.pacer.delay(self.congestion.cwnd, self.rtt.srtt)
+                    self.pacer.on_send()
+
+                    fragment = self.send_fragment(pool, source, length, window, batch, stream_id, extended,
+                                                  index == corrupt_fragment)
+                    if fragment is None:
+                        break
+                    metrics.file_bytes_sent.inc(len(fragment))
+                    # the encoder keeps the group's fragments, the buffer may be reused before the group is complete
+                    for payload in encoder.add(bytes(fragment)) if encoder else []:
+                        batch.append(frame_codec.encode(6, flag, file_payload(payload), 0, self.next_timestamp()))
+                    if len(batch) >= MAX_SEGMENTS:
+                        self.flush(batch)
+
+                for payload in encoder.flush() if encoder else []:
+                    batch.append(frame_codec.encode(6, flag, file_payload(payload), 0, self.next_timestamp()))
+                self.flush(batch)
+                return await self.wait_for(lambda: not window.packets, window)
+        finally:
+            if streams:
+                window = self.streams.pop(stream_id, None)
+            if window is not None:
+                window.clear()
+                # messages go back to a text window, handle_ack looks them up by their 16-bit sequence number
+                if window is self.sender_window:
+                    self.sender_window = SenderWindow(WINDOW_SIZE)
+                    self.window_changed.set()
+            if compressed:
+                compressed[0].close()
+            if patch:
+                patch[0].close()
+
+    # --- receiving ---
+
+    def schedule_delayed_ack(self):
+        if self.ack_timer is not None:
+            return
+        delays = [state.delayed_ack.time_until_due() for state in self.file_transfer_states.values()]
+        delays = [delay for delay in delays if delay is not None]
+        if delays:
+            self.ack_timer = self.loop.call_later(min(delays), self.flush_delayed_ack)
+
+    def flush_delayed_ack(self):
+        self.ack_timer = None
+        for state in self.file_transfer_states.values():
+            if state.delayed_ack.is_due():
+                send_sack(state, self.sock, *self.addr)
+        self.schedule_delayed_ack()
+
+    def handle_frame(self, frame, addr):
+        self.last_seen = time.time()
+        # the CRC was checked once by decode, the handlers only ever see frames that passed
+        if not frame.valid:
+            ip, port = self.addr
+            reject_frame(frame, self.sock, ip, port)
+            return
+        handler = self.frame_handlers[frame.msgType << 4 | frame.flags]
+        if handler is None:
+            print(f"Unknown message type: {frame.msgType}")
+            return
+        handler(self, frame, addr)
+
+    def receive_text(self, frame, addr):
+        ip, port = self.addr
+        handle_text_message(frame, self.sock, ip, port, self.receiver_window, addr, self.fragmented_messages)
+
+    def receive_file(self, frame, addr):
+        ip, port = self.addr
+        stream_id = file_stream_id(frame)
+        state = self.file_transfer_states.get(stream_id)
+        new_state = handle_file_transfer(frame, self.sock, ip, port, state, self.directory, self.capabilities)
+        if new_state is not state:
+            register_transfer(self.file_transfer_states, stream_id, new_state)
+        self.schedule_delayed_ack()
+
+    def receive_fec_parity(self, frame, addr):
+        ip, port = self.addr
+        handle_fec_parity(frame, self.sock, ip, port, self.file_transfer_states.get(file_stream_id(frame)))
+        self.schedule_delayed_ack()
+
+    def receive_control_answer(self, frame, addr):
+        waiter = self.control_acks.pop(frame.timeStamp, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(control_answer(frame))
+
+    def receive_resume_offer(self, frame, addr):
+        ip, port = self.addr
+        handle_resume_offer(frame, self.sock, ip, port, self.file_transfer_states.get(file_stream_id(frame)))
+
+    def receive_delta(self, frame, addr):
+        ip, port = self.addr
+        handle_delta(frame, self.sock, ip, port, self.file_transfer_states.get(file_stream_id(frame)), self.directory)
+
+    # (msgType, flags) -> handler, a new frame type only needs its handler and an entry here
+    frame_handlers = handler_table([
+        (1, range(2, 10), handle_control),
+        (2, (1, 2, 4, 5), receive_text),
+        (3, (1, 2, 4), receive_text),
+        (4, range(16), receive_file),
+        (5, (1, 2, 3, 3 | STREAM_FLAG), handle_ack),
+        (6, range(16), receive_fec_parity),
+        (7, (1, 1 | STREAM_FLAG), receive_resume_offer),
+        (7, (2, 2 | STREAM_FLAG), receive_control_answer),
+        (8, (1, 3, 1 | STREAM_FLAG, 3 | STREAM_FLAG), receive_delta),
+        (8, (2, 2 | STREAM_FLAG), receive_control_answer),
+    ])
+
+
+class ProtocolEngine(asyncio.DatagramProtocol):
+    # with a fixed peer every datagram belongs to one session, otherwise it is a server: sessions are keyed by
+    # the source address and a peer is admitted by its SYN
+    def __init__(self, peer=None):
+        self.peer = peer
+        self.sessions = {}
+        self.transport = None
+        self.io = None          # batched sends on the transport's socket, see start_engine
+        self.loop = None
+        self.reaper = None
+        # only a server can take the stripes of one file on several sessions
+        self.capabilities = SUPPORTED_CAPABILITIES | (CAP_STRIPES if peer is None else 0)
+
+    @property
+    def server(self):
+        return self.peer is None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        if self.server:
+            self.reaper = self.loop.create_task(self.reap_idle_sessions())
+
+    def connection_lost(self, exc):
+        if self.reaper is not None:
+            self.reaper.cancel()
+
+    def fit_buffers(self, datagram_size):
+        # grows the kernel buffers for datagrams of datagram_size bytes, the size a path MTU probe found
+        self.io.fit(datagram_size)
+
+    def session_for(self, addr):
+        key = self.peer if self.peer is not None else addr
+        session = self.sessions.get(key)
+        if session is None:
+            session = self.sessions[key] = Session(self, key)
+            if self.server:
+                # peers may send files with the same name, every peer gets its own directory
+                session.directory = os.path.join(RECEIVED_FILES_DIR, f"{addr[0]}_{addr[1]}")
+        return session
+
+    def on_session_closed(self, session):
+        if not self.server or self.sessions.get(session.addr) is not session:
+            return
+        del self.sessions[session.addr]
+        session.release()
+        print(f"Session closed: {session.addr} ({len(self.sessions)} active)")
+
+    async def reap_idle_sessions(self):
+        # peers that vanish without a FIN, keep alives keep a connected peer from looking idle
+        while True:
+            await asyncio.sleep(KEEP_ALIVE_INTERVAL)
+            deadline = time.time() - SESSION_IDLE_TIMEOUT
+            for session in [session for session in self.sessions.values() if session.last_seen < deadline]:
+                print(f"Peer {session.addr} timed out")
+                self.on_session_closed(session)
+
+    def sendto(self, data, addr):
+        self.transport.sendto(data, addr)
+        metrics.on_sent(data)
+
+    def send_many(self, datagrams, addr):
+        # straight to the socket with GSO, unless the transport still holds datagrams that have to go first.
+        # What the socket does not take when its buffer is full is left to the transport to queue
+        sent = 0 if self.transport.get_write_buffer_size() else self.io.send_many(datagrams, addr)
+        for data in datagrams[sent:]:
+            self.transport.sendto(data, addr)
+        metrics.on_sent_many(datagrams)
+
+    def datagram_received(self, data, addr):
+        metrics.on_received(data)
+        try:
+            frame = frame_codec.decode(data)
+        except struct.error:
+            print(f"Dropping short datagram from {addr}")
+            return
+        if self.server and addr not in self.sessions and not (frame.msgType == 1 and frame.flags == 2):
+            return  # not connected, or the session timed out and the peer has to send a new SYN
+        try:
+            self.session_for(addr).handle_frame(frame, addr)
+        except Exception as e:
+            print(f"Error in protocol engine: {e}")
+
+    def error_received(self, exc):
+        print(f"Socket error: {exc}")
+
+
+async def start_engine(listenPort: int, peer=None, host: str = '0.0.0.0', sock=None):
+    # the engine keeps the socket next to its transport, file fragments bypass the transport in GSO batches
+    if sock is None:
+        sock = server_socket(listenPort, host)
+    loop = asyncio.get_running_loop()
+    transport, engine = await loop.create_datagram_endpoint(lambda: ProtocolEngine(peer), sock=sock)
+    # the window has to fit in the kernel buffers
+    engine.io = DatagramIO(sock)
+    return engine
+
+
+def server_socket(listenPort: int, host: str = '0.0.0.0', reuse_port=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, listenPort))
+    sock.setblocking(False)
+    return sock
+
+
+async def serve(sock):
+    await start_engine(sock.getsockname()[1], sock=sock)     # the loop keeps the transport and its engine
+    print(f"Worker {os.getpid()} serving on port {sock.getsockname()[1]}")
+    await asyncio.Event().wait()
+
+
+def serve_worker(sock, metrics_address=None, index=0):
+    if metrics_address:
+        metrics.serve_metrics(metrics_address, index)   # every worker counts for itself, on its own endpoint
+    try:
+        asyncio.run(serve(sock))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_server(listenPort: int, workers: int = None, host: str = '0.0.0.0', metrics_address=None):
+    # Every worker process owns one socket of a SO_REUSEPORT group. The kernel picks the socket by a hash
+    # of the peer's address and port, so a peer always lands on the same worker and its session.
+    # All sockets are bound before the first worker starts, otherwise the hash would change under
+    # peers that connected early.
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        print("SO_REUSEPORT is not available, running a single worker")
+        workers = 1
+    if workers == 1:
+        serve_worker(server_socket(listenPort, host), metrics_address)
+        return
+
+    sockets = [server_socket(listenPort, host, reuse_port=True) for _ in range(workers)]
+    processes = [multiprocessing.Process(target=serve_worker, args=(sock, metrics_address, index), daemon=True)
+                 for index, sock in enumerate(sockets)]
+    for process in processes:
+        process.start()
+    for sock in sockets:
+        sock.close()    # the workers hold their own references
+    print(f"Serving on port {listenPort} with {workers} worker processes")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+async def send_file_in_background(session, filepath):
+    if await session.send_file(filepath):
+        print(f"File sent successfully: {filepath}")
+    else:
+        print(f"Failed to send file: {filepath}")
+
+
+async def stripe_worker(ip, port, filepath, transfer_id, index, count):
+    engine = await start_engine(0, peer=(ip, port))
+    engine.capabilities |= CAP_STRIPES
+    session = engine.session_for((ip, port))
+    try:
+        if not await session.connect():
+            return False
+        if not session.capabilities & CAP_STRIPES:
+            print("The peer does not accept striped transfers, it has to run with --server")
+            return False
+        if session.capabilities & CAP_MTU_PROBE:
+            await session.probe_path_mtu()
+        return await session.send_file(filepath, (transfer_id, index, count))
+    finally:
+        if session.connected:
+            session.close()
+        engine.transport.close()
+
+
+def send_stripe(ip, port, filepath, transfer_id, index, count):
+    return asyncio.run(stripe_worker(ip, port, filepath, transfer_id, index, count))
+
+
+def send_file_striped(ip: str, port: int, filepath: str, stripes: int = DEFAULT_STRIPES):
+    # Splits the file into byte ranges and sends each one from its own process, socket and session, so CRC and
+    # framing run on several cores. The ranges reach different workers of a --server receiver, which write them
+    # into the same file and verify every range.
+    count = stripe_count(os.path.getsize(filepath), stripes)
+    transfer_id = random.getrandbits(32)
+    print(f"Sending {filepath} in {count} stripes")
+    with ProcessPoolExecutor(count) as pool:
+        futures = [pool.submit(send_stripe, ip, port, filepath, transfer_id, index, count) for index in range(count)]
+        return all(future.result() for future in futures)
+
+
+async def run_command(session, payload, transfers):
+    # one line of the command line, transfers keeps the file transfers running in the background until they finish
+    loop = asyncio.get_running_loop()
+    try:
+        if payload == "!start":
+            if session.connected:
+                print("Connection already established")
+            elif await session.connect() and session.capabilities & CAP_MTU_PROBE:
+                await session.probe_path_mtu()
+            return
+
+        if not session.connected:
+            print("Connection not established")
+            return
+
+        if payload == "!help":
+            print("Commands:")
+            print("!start - Establish a connection with the peer")
+            print("!end - Cut the connection with the peer")
+            print("!file - Send a file to the peer")
+            print("!stripe - Send a file over several connections at once, the peer has to run --server")
+            print("!frag - Set the maximum fragment length")
+            print("!cc - Choose the congestion control algorithm")
+            print("!buffer - Set how much unacknowledged file data is kept for retransmission")
+            print("!compress - Choose the compression codec for files")
+            print("!fec - Set the FEC group size and parity fragments for files")
+            print("!delta - Send only the changes when the peer has an older copy of a file")
+            print("!stats - Show packet, retransmission, RTT and goodput statistics")
+            print("!help - Display this help message")
+            return
+
+        if payload == "!end":
+            session.close()
+            return
+
+        if payload == "!stats":
+            print(metrics.summary())
+            return
+
+        if payload == "!err":
+            print("Choose what type of message you want to corrupt:")
+            print("1. Corrupt a message")
+            print("2. Corrupt a file")
+            while True:
+                choice = await loop.run_in_executor(None, input, "Enter choice: ")
+                if choice == "1":
+                    text = await loop.run_in_executor(None, input, "Enter the message to corrupt: ")
+                    if not await session.send_text(text, corrupt=True):
+                        print("Failed to deliver message")
+                    break
+                elif choice == "2":
+                    filepath = await loop.run_in_executor(None, input, "Enter the source file path: ")
+                    if not os.path.exists(filepath):
+                        print("File does not exist")
+                    elif await session.send_file(filepath, corrupt=True):
+                        print("Corrupted file transfer completed")
+                    else:
+                        print("Failed to send corrupted file")
+                    break
+                else:
+                    print("Invalid choice,try again")
+            return
+
+        if payload == "!file":
+            filepath = await loop.run_in_executor(None, input, "Enter the source file path: ")
+            if not os.path.exists(filepath):
+                print("File does not exist")
+                return
+            if session.capabilities & CAP_STREAMS:
+                # the file gets its own stream, messages and other files can be sent meanwhile
+                task = loop.create_task(send_file_in_background(session, filepath))
+                transfers.add(task)
+                task.add_done_callback(transfers.discard)
+                return
+            if await session.send_file(filepath):
+                print("File sent successfully")
+            else:
+                print("Failed to send file")
+            return
+
+        if payload == "!stripe":
+            filepath = await loop.run_in_executor(None, input, "Enter the source file path: ")
+            if not os.path.exists(filepath):
+                print("File does not exist")
+                return
+            value = await loop.run_in_executor(None, input, f"Number of stripes [{DEFAULT_STRIPES}]: ")
+            stripes = int(value) if value.strip() else DEFAULT_STRIPES
+            if await loop.run_in_executor(None, send_file_striped, *session.addr, filepath, stripes):
+                print(f"File sent successfully: {filepath}")
+            else:
+                print(f"Failed to send file: {filepath}")
+            return
+
+        if payload == "!frag":
+            value = await loop.run_in_executor(None, input, "Enter the maximum fragment length: ")
+            fragMaxLen = int(value)
+            if 1 <= fragMaxLen <= session.max_frag_len:
+                session.frag_max_len = fragMaxLen
+                print(f"Fragment length set to {fragMaxLen}")
+            else:
+                print(f"Invalid fragment length, the path allows at most {session.max_frag_len}")
+            return
+
+        if payload == "!buffer":
+            value = await loop.run_in_executor(None, input, "Retransmission buffer in MiB: ")
+            try:
+                budget = int(value) * 2 ** 20
+                if budget < 1:
+                    raise ValueError
+                session.budget = budget
+                session.window_changed.set()
+                print(f"Retransmission buffer set to {budget // 2 ** 20} MiB")
+            except ValueError:
+                print("Please enter a positive integer")
+            return
+
+        if payload == "!fec":
+            value = await loop.run_in_executor(
+                None, input, "FEC data fragments and parity fragments per group (e.g. 16 2, off): ")
+            try:
+                session.fec = parse_fec(value)
+                print(f"FEC set to {session.fec[0]} + {session.fec[1]}" if session.fec else "FEC off")
+            except ValueError as e:
+                print(f"Invalid FEC setting: {e}")
+            return
+
+        if payload == "!delta":
+            value = await loop.run_in_executor(None, input, "Delta transfers (on, off): ")
+            session.delta = value.strip().lower() == "on"
+            print("Delta transfers on" if session.delta else "Delta transfers off")
+            return
+
+        if payload == "!compress":
+            name = await loop.run_in_executor(None, input, f"Compression ({', '.join(CODECS)}, none): ")
+            if name == "none":
+                session.compression = None
+                print("Compression off")
+            elif name in CODECS:
+                session.compression = name
+                print(f"Compression set to {name}")
+            else:
+                print("Unknown compression codec")
+            return
+
+        if payload == "!cc":
+            name = await loop.run_in_executor(None, input, f"Congestion control ({', '.join(CONTROLLERS)}): ")
+            if name in CONTROLLERS:
+                session.congestion = create_controller(name)
+                session.window_changed.set()
+                print(f"Congestion control set to {name}")
+            else:
+                print("Unknown congestion control")
+            return
+
+        print(f"Sending message: {payload}")
+        if not await session.send_text(payload):
+            print("Failed to deliver message")
+
+    except Exception as e:
+        print(f"Error in send loop: {e}")
+
+
+async def run_cli(ip: str, port: int, listenPort: int):
+    engine = await start_engine(listenPort, peer=(ip, port))
+    session = engine.session_for((ip, port))
+    loop = asyncio.get_running_loop()
+    transfers = set()
+    print(f"Listening on port {listenPort}...")
+    print("To start talking, type !start")
+
+    while True:
+        try:
+            payload = await loop.run_in_executor(None, input, "Enter message: ")
+        except EOFError:
+            break
+        await run_command(session, payload, transfers)
+
+
+class EngineThread:
+    # The engine's event loop on a thread of its own, for callers that block: the threaded entry point and the
+    # benchmark's threads mode. call() runs a coroutine on the loop and waits for its result
+    def __init__(self, listenPort: int, peer):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.engine = self.call(start_engine(listenPort, peer=peer))
+        self.session = self.call(self.open_session(peer))
+
+    async def open_session(self, peer):
+        return self.engine.session_for(peer)
+
+    def call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+
+def run_threaded(ip: str, port: int, listenPort: int):
+    # the engine runs on its own thread, commands are read and run from this one
+    runner = EngineThread(listenPort, (ip, port))
+    transfers = set()
+    print(f"Listening on port {listenPort}...")
+    print("To start talking, type !start")
+
+    while True:
+        try:
+            payload = input("Enter message: ")
+        except EOFError:
+            break
+        runner.call(run_command(runner.session, payload, transfers))
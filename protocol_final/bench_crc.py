@@ -0,0 +1,42 @@
+# Micro-benchmark for the checksum backends
+# usage: python bench_crc.py [file] [fragment size]
+import sys
+import time
+from checksum import crc16, crc16_table, crc16_bitwise, Crc16, CRC16_BACKEND
+
+DEFAULT_FILE = "test_files/2mb.txt"
+DEFAULT_FRAGMENT = 1462
+
+
+def run(name, func, view, fragment_size, limit=None):
+    total = len(view) if limit is None else min(len(view), limit)
+    start = time.perf_counter()
+    for i in range(0, total, fragment_size):
+        func(view[i:min(i + fragment_size, total)])
+    elapsed = time.perf_counter() - start
+    fragments = (total + fragment_size - 1) // fragment_size
+    print(f"{name:<10} {total / elapsed / 1e6:10.2f} MB/s  {elapsed / fragments * 1e6:10.2f} us/fragment")
+    return elapsed
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_FILE
+    fragment_size = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_FRAGMENT
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    view = memoryview(data)
+
+    # all backends must agree with the bit-by-bit reference
+    sample = view[:fragment_size]
+    assert crc16(sample) == crc16_table(sample) == crc16_bitwise(sample)
+    whole = Crc16()
+    for i in range(0, len(view), fragment_size):
+        whole.update(view[i:i + fragment_size])
+    assert whole.value == crc16(view)
+
+    print(f"{len(view)} bytes, {fragment_size} byte fragments, fast backend: {CRC16_BACKEND}")
+    # the bit-by-bit version is slow, only measure the first 256 KB
+    run("bitwise", crc16_bitwise, view, fragment_size, limit=256 * 1024)
+    run("table", crc16_table, view, fragment_size)
+    run("crc16", crc16, view, fragment_size)
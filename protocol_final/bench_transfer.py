@@ -0,0 +1,339 @@
+# Loopback benchmark for file and text transfers, prints the results as JSON
+# usage: python bench_transfer.py [--sizes 10M,100M,1G] [--engine threads|asyncio] [--output results.json]
+#
+# Every scenario starts a fresh receiver and sender process on 127.0.0.1, the sender reports
+# goodput, packets/s, retransmissions and message latency, both report their CPU time and peak RSS.
+import argparse
+import hashlib
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_FILES = [os.path.join(HERE, "test_files", "2mb.txt"), os.path.join(HERE, "test_files", "cat.jpg")]
+DEFAULT_SIZES = "10M,100M"
+DEFAULT_MESSAGES = 200
+DEFAULT_FRAGMENT_MESSAGES = 20
+FRAGMENTS_PER_MESSAGE = 10
+CONNECT_TIMEOUT = 5.0
+SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+
+def percentile(values, p):
+    # nearest rank
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def file_digest(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def generate_file(directory, size):
+    # random content so later compression cannot shortcut the transfer, kept between runs
+    path = os.path.join(directory, f"bench_{size}.bin")
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        return path
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            chunk = min(remaining, 1 << 20)
+            f.write(os.urandom(chunk))
+            remaining -= chunk
+    return path
+
+
+def peak_rss_kb():
+    # ru_maxrss survives fork + exec on Linux and would report the harness, VmHWM is per process image
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def usage():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    return {"cpu_seconds": round(own.ru_utime + own.ru_stime, 3), "peak_rss_kb": peak_rss_kb()}
+
+
+def write_result(path, result):
+    result.update(usage())
+    with open(path, 'w') as f:
+        json.dump(result, f)
+
+
+def configure(session, args):
+    import async_engine
+    from congestion import create_controller
+    session.frag_max_len = args.fragment
+    if args.window:
+        async_engine.FILE_WINDOW_SIZE = args.window
+    if args.cc:
+        session.congestion = create_controller(args.cc)
+    if args.fec:
+        from fec import parse_fec
+        session.fec = parse_fec(args.fec)
+
+
+async def send_scenario(session, args):
+    if not await session.connect():
+        return {"ok": False, "error": "connection failed"}
+
+    if args.file:
+        start = time.perf_counter()
+        ok = await session.send_file(args.file)
+        return {"ok": ok, "seconds": time.perf_counter() - start, "retransmissions": session.retransmissions}
+
+    latencies = []
+    ok = True
+    text = "x" * (args.fragment * args.fragments)
+    for i in range(args.messages):
+        start = time.perf_counter()
+        ok = await session.send_text(text)
+        if not ok:
+            break
+        latencies.append(time.perf_counter() - start)
+    return {"ok": ok, "seconds": sum(latencies), "latencies": latencies,
+            "retransmissions": session.retransmissions}
+
+
+# --- worker processes ---
+# threads: the engine on its own thread, driven by blocking calls from the main thread (main.py's default),
+# asyncio: everything on one event loop
+
+def receiver_threads(args):
+    from async_engine import EngineThread
+    runner = EngineThread(args.listen, ("127.0.0.1", args.port))
+    configure(runner.session, args)
+    sys.stdin.read()    # the harness closes stdin once the sender is done
+
+
+def sender_threads(args):
+    from async_engine import EngineThread
+    runner = EngineThread(args.listen, ("127.0.0.1", args.port))
+    configure(runner.session, args)
+    return runner.call(send_scenario(runner.session, args))
+
+
+def receiver_asyncio(args):
+    import asyncio
+    from async_engine import start_engine
+
+    async def run():
+        engine = await start_engine(args.listen, peer=("127.0.0.1", args.port))
+        configure(engine.session_for(("127.0.0.1", args.port)), args)
+        await asyncio.get_running_loop().run_in_executor(None, sys.stdin.read)
+
+    asyncio.run(run())
+
+
+def sender_asyncio(args):
+    import asyncio
+    from async_engine import start_engine
+
+    async def run():
+        engine = await start_engine(args.listen, peer=("127.0.0.1", args.port))
+        session = engine.session_for(("127.0.0.1", args.port))
+        configure(session, args)
+        return await send_scenario(session, args)
+
+    return asyncio.run(run())
+
+
+def run_worker(args):
+    # protocol output goes to stdout, which the harness discards unless --verbose
+    if args.role == "receiver":
+        (receiver_asyncio if args.engine == "asyncio" else receiver_threads)(args)
+        write_result(args.result, {})
+    else:
+        result = (sender_asyncio if args.engine == "asyncio" else sender_threads)(args)
+        write_result(args.result, result)
+    os._exit(0)     # do not wait for the protocol threads
+
+
+# --- harness ---
+
+def worker_command(args, role, listen, port, result, extra):
+    command = [sys.executable, os.path.abspath(__file__), "--role", role, "--engine", args.engine,
+               "--listen", str(listen), "--port", str(port), "--result", result,
+               "--fragment", str(args.fragment)]
+    if args.window:
+        command += ["--window", str(args.window)]
+    if args.cc:
+        command += ["--cc", args.cc]
+    if args.fec:
+        command += ["--fec", args.fec]
+    return command + extra
+
+
+def run_scenario(args, name, extra, workdir):
+    receiver_port, sender_port = free_port(), free_port()
+    receiver_dir = os.path.join(workdir, "receiver")
+    shutil.rmtree(receiver_dir, ignore_errors=True)
+    os.makedirs(receiver_dir)
+    receiver_result = os.path.join(workdir, "receiver.json")
+    sender_result = os.path.join(workdir, "sender.json")
+    output = None if args.verbose else subprocess.DEVNULL
+
+    receiver = subprocess.Popen(worker_command(args, "receiver", receiver_port, sender_port, receiver_result, []),
+                                cwd=receiver_dir, stdin=subprocess.PIPE, stdout=output, stderr=output)
+    time.sleep(0.3)
+    sender = subprocess.Popen(worker_command(args, "sender", sender_port, receiver_port, sender_result, extra),
+                              cwd=workdir, stdin=subprocess.DEVNULL, stdout=output, stderr=output)
+    try:
+        sender.wait(args.timeout)
+    except subprocess.TimeoutExpired:
+        sender.kill()
+    receiver.stdin.close()
+    try:
+        receiver.wait(10)
+    except subprocess.TimeoutExpired:
+        receiver.kill()
+
+    result = {"name": name, "ok": False}
+    if os.path.exists(sender_result):
+        with open(sender_result) as f:
+            result.update(json.load(f))
+    else:
+        result["error"] = "sender timed out" if sender.returncode is None or sender.returncode < 0 else "sender crashed"
+    result["sender"] = {key: result.pop(key) for key in ("cpu_seconds", "peak_rss_kb") if key in result}
+    if os.path.exists(receiver_result):
+        with open(receiver_result) as f:
+            result["receiver"] = json.load(f)
+    return result, receiver_dir
+
+
+def bench_file(args, path, workdir):
+    size = os.path.getsize(path)
+    fragments = (size + args.fragment - 1) // args.fragment
+    result, receiver_dir = run_scenario(args, os.path.basename(path), ["--file", path], workdir)
+
+    received = os.path.join(receiver_dir, "received_files", os.path.basename(path))
+    if result["ok"]:
+        result["ok"] = os.path.exists(received) and file_digest(received) == file_digest(path)
+        if not result["ok"]:
+            result["error"] = "received file differs"
+    shutil.rmtree(receiver_dir, ignore_errors=True)
+
+    result.update({"kind": "file", "bytes": size, "fragments": fragments})
+    seconds = result.get("seconds")
+    if result["ok"] and seconds:
+        result["goodput_mbps"] = round(size * 8 / seconds / 1e6, 2)
+        result["packets_per_second"] = round((fragments + result["retransmissions"]) / seconds)
+    return result
+
+
+def bench_messages(args, count, fragments, workdir):
+    name = "message_single" if fragments == 1 else f"message_{fragments}_fragments"
+    result, receiver_dir = run_scenario(args, name, ["--messages", str(count), "--fragments", str(fragments)],
+                                        workdir)
+    shutil.rmtree(receiver_dir, ignore_errors=True)
+
+    latencies = result.pop("latencies", [])
+    size = args.fragment * fragments
+    result.update({"kind": "message", "messages": len(latencies), "bytes": size * len(latencies)})
+    seconds = result.get("seconds")
+    if latencies and seconds:
+        result["goodput_mbps"] = round(size * len(latencies) * 8 / seconds / 1e6, 3)
+        result["packets_per_second"] = round((fragments * len(latencies) + result["retransmissions"]) / seconds)
+        result["latency_p50_ms"] = round(percentile(latencies, 50) * 1000, 3)
+        result["latency_p99_ms"] = round(percentile(latencies, 99) * 1000, 3)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback throughput and latency benchmark")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help="generated file sizes, comma separated (e.g. 10M,100M,1G), empty for none")
+    parser.add_argument("--files", nargs="*", default=DEFAULT_FILES, help="existing files to transfer")
+    parser.add_argument("--messages", type=int, default=DEFAULT_MESSAGES, help="single fragment messages")
+    parser.add_argument("--fragment-messages", type=int, default=DEFAULT_FRAGMENT_MESSAGES,
+                        help=f"messages of {FRAGMENTS_PER_MESSAGE} fragments")
+    parser.add_argument("--fragment", type=int, default=None, help="maximum fragment length")
+    parser.add_argument("--window", type=int, default=None, help="file sender window in fragments")
+    parser.add_argument("--cc", default=None, help="congestion control algorithm")
+    parser.add_argument("--fec", default=None, help='FEC data and parity fragments per group, e.g. "16 2"')
+    parser.add_argument("--timeout", type=float, default=600, help="seconds before a scenario is abandoned")
+    parser.add_argument("--output", default=None, help="write the JSON here instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="show the protocol output of the workers")
+    parser.add_argument("--workdir", default=None, help="where generated files are kept")
+    # worker options, set by the harness
+    parser.add_argument("--role", choices=["bench", "sender", "receiver"], default="bench", help=argparse.SUPPRESS)
+    parser.add_argument("--listen", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    parser.add_argument("--file", help=argparse.SUPPRESS)
+    parser.add_argument("--fragments", type=int, default=1, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    sys.path.insert(0, HERE)
+    if args.fragment is None:
+        from sendThread import DEFAULT_FRAGMENT_MAX_LENGTH
+        args.fragment = DEFAULT_FRAGMENT_MAX_LENGTH
+
+    if args.role != "bench":
+        run_worker(args)
+        return
+
+    workdir = args.workdir or os.path.join(tempfile.gettempdir(), "protocol_bench")
+    os.makedirs(workdir, exist_ok=True)
+    files = [os.path.abspath(path) for path in args.files]
+    for size in filter(None, args.sizes.split(",")):
+        files.append(generate_file(workdir, parse_size(size)))
+
+    results = []
+    for path in files:
+        print(f"Transferring {os.path.basename(path)}...", file=sys.stderr)
+        results.append(bench_file(args, path, workdir))
+    if args.messages:
+        print(f"Sending {args.messages} single fragment messages...", file=sys.stderr)
+        results.append(bench_messages(args, args.messages, 1, workdir))
+    if args.fragment_messages:
+        print(f"Sending {args.fragment_messages} fragmented messages...", file=sys.stderr)
+        results.append(bench_messages(args, args.fragment_messages, FRAGMENTS_PER_MESSAGE, workdir))
+
+    report = {
+        "config": {"engine": args.engine, "fragment": args.fragment, "window": args.window, "cc": args.cc,
+                   "fec": args.fec, "python": sys.version.split()[0], "platform": sys.platform},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import struct
+
+# CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF, no reflection, no final xor)
+CRC16_POLY = 0x1021
+CRC16_INIT = 0xFFFF
+
+
+def crc16_bitwise(data, crc=CRC16_INIT):
+    # reference implementation, one bit at a time (the original hashMSG)
+    for byte in data:
+        crc ^= byte << 8
+        for i in range(8):
+            if crc & 0x8000:
+                crc = (crc << 1) ^ CRC16_POLY
+            else:
+                crc <<= 1
+            crc &= 0xFFFF
+    return crc
+
+
+def _build_table():
+    table = []
+    for byte in range(256):
+        table.append(crc16_bitwise(bytes([byte]), 0))
+    return tuple(table)
+
+CRC16_TABLE = _build_table()
+
+
+def crc16_table(data, crc=CRC16_INIT):
+    # pure python fallback, one table lookup per byte
+    table = CRC16_TABLE
+    for byte in memoryview(data).cast('B'):
+        crc = ((crc << 8) & 0xFF00) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+
+try:
+    # binascii.crc_hqx is the same CRC implemented in C, with the start value as parameter
+    from binascii import crc_hqx as _crc_hqx
+except ImportError:
+    _crc_hqx = None
+
+if _crc_hqx is not None:
+    def crc16(data, crc=CRC16_INIT):
+        return _crc_hqx(data, crc)
+    CRC16_BACKEND = "binascii"
+else:
+    crc16 = crc16_table
+    CRC16_BACKEND = "table"
+
+
+class Crc16:
+    # incremental checksum, accepts bytes, bytearray or memoryview chunks
+    __slots__ = ('value',)
+
+    def __init__(self, data=None, value=CRC16_INIT):
+        self.value = value
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        self.value = crc16(data, self.value)
+        return self
+
+    def copy(self):
+        return Crc16(value=self.value)
+
+    def digest(self):
+        return struct.pack('!H', self.value)
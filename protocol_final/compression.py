@@ -0,0 +1,103 @@
+import bz2
+import tempfile
+import zlib
+from frame_codec import CAP_ZLIB, CAP_BZ2, CAP_LZMA
+
+try:
+    import lzma
+except ImportError:     # Python built without liblzma, the codec is not offered in the handshake
+    lzma = None
+
+NO_CODEC = 0            # codec byte of a file sent as is
+SAMPLE_SIZE = 256 * 1024
+MIN_SAVING = 0.1        # compress only when the sample, and then the whole file, shrinks by at least this much
+CHUNK_SIZE = 1 << 20
+SPOOL_SIZE = 64 << 20   # compressed copies larger than this are spooled to disk
+
+
+class Codec:
+    # id: byte in front of the filename, capability: handshake bit.
+    # The codecs below add compressor() and decompressor(), which return fresh zlib-style stream objects
+    name = "base"
+    id = NO_CODEC
+    capability = 0
+
+
+class ZlibCodec(Codec):
+    name = "zlib"
+    id = 1
+    capability = CAP_ZLIB
+
+    def compressor(self):
+        return zlib.compressobj(6)
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+
+class Bz2Codec(Codec):
+    name = "bz2"
+    id = 2
+    capability = CAP_BZ2
+
+    def compressor(self):
+        return bz2.BZ2Compressor(9)
+
+    def decompressor(self):
+        return bz2.BZ2Decompressor()
+
+
+class LzmaCodec(Codec):
+    name = "lzma"
+    id = 3
+    capability = CAP_LZMA
+
+    def compressor(self):
+        return lzma.LZMACompressor(preset=6)
+
+    def decompressor(self):
+        return lzma.LZMADecompressor()
+
+
+CODECS = {codec.name: codec for codec in (ZlibCodec(), Bz2Codec(), LzmaCodec()) if codec.name != "lzma" or lzma}
+CODEC_IDS = {codec.id: codec for codec in CODECS.values()}
+DEFAULT_CODEC = ZlibCodec.name
+DECOMPRESS_ERRORS = (zlib.error, OSError, EOFError, ValueError) + ((lzma.LZMAError,) if lzma else ())
+
+
+def negotiated_codec(capabilities, name=DEFAULT_CODEC):
+    # the codec to send with, None when compression is off or the peer does not support it
+    codec = CODECS.get(name)
+    if codec is None or not capabilities & codec.capability:
+        return None
+    return codec
+
+
+def compress_file(file, codec, size):
+    # Streams the file through the compressor into a spooled temporary file and returns (copy, compressed size),
+    # None when the data does not compress (JPEG, archives, already compressed logs).
+    # A sample decides first so incompressible files are not read twice.
+    position = file.tell()
+    sample = file.read(SAMPLE_SIZE)
+    compressor = codec.compressor()
+    if len(compressor.compress(sample) + compressor.flush()) > len(sample) * (1 - MIN_SAVING):
+        file.seek(position)
+        return None
+
+    file.seek(position)
+    spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    compressor = codec.compressor()
+    while True:
+        chunk = file.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        spool.write(compressor.compress(chunk))
+    spool.write(compressor.flush())
+
+    compressed_size = spool.tell()
+    file.seek(position)
+    if compressed_size > size * (1 - MIN_SAVING):
+        spool.close()
+        return None
+    spool.seek(0)
+    return spool, compressed_size
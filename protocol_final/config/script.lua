@@ -7,7 +7,10 @@ local msg_types = {
     [2] = "Single Message Packet",
     [3] = "Multi-Fragment Message Packet",
     [4] = "File Transfer Packet",
-    [5] = "ACK/NACK Packet"
+    [5] = "ACK/NACK Packet",
+    [6] = "FEC Parity Packet",
+    [7] = "Resume Packet",
+    [8] = "Delta Packet"
 }
 
 -- Detailed Flag Definitions
@@ -19,7 +22,8 @@ local flag_definitions = {
 
         [4] = "KEEP_ALIVE",
         [5] = "KEEP_ALIVE-ACK",
-
+        [6] = "MTU_PROBE",
+        [7] = "MTU_PROBE-ACK",
         [8] = "FIN",
         [9] = "FIN-ACK"
     },
@@ -40,21 +44,45 @@ local flag_definitions = {
         [2] = "File Size Transfer",
         [3] = "Fragment Count Transfer",
         [4] = "File Fragment part",
-
-        [6] = "Look missing fragment"
+        [5] = "File Fragment part (32-bit index)",
+        [6] = "Look missing fragment",
+        [7] = "File Stripe header"
     },
     -- ACK/NACK Packet Flags
     [5] = {
         [1] = "ACK",
-        [2] = "NACK"
+        [2] = "NACK",
+        [3] = "SACK"
+    },
+    -- FEC Parity Packet Flags
+    [6] = {
+        [0] = "FEC Parity"
+    },
+    -- Resume Packet Flags
+    [7] = {
+        [1] = "Resume Offer",
+        [2] = "Resume Answer"
+    },
+    -- Delta Packet Flags
+    [8] = {
+        [1] = "Signature Request",
+        [2] = "Signature Answer",
+        [3] = "Delta Header"
     }
 }
 
+-- File transfer streams: frames of msgType 4 and up set STREAM_FLAG on top of the flags above
+-- and their payload starts with the 16-bit stream id. Control frames use the bit for FIN (8, 9)
+local STREAM_FLAG = 0x8
+local FIRST_STREAM_TYPE = 4
+
 -- Protocol Fields
 local f_msgType_flags = ProtoField.uint8("mcup.msgType_flags", "Message Type and Flags", base.HEX)
 local f_checksum = ProtoField.uint16("mcup.checksum", "Checksum", base.HEX)
 local f_fragmentSeq = ProtoField.uint16("mcup.fragmentSeq", "Fragment Sequence", base.DEC)
 local f_timestamp = ProtoField.uint8("mcup.timestamp", "Timestamp", base.DEC)
+local f_stream_id = ProtoField.uint16("mcup.stream_id", "Stream ID", base.DEC)
+local f_fragment_index = ProtoField.uint32("mcup.fragment_index", "Fragment Index", base.DEC)
 local f_payload = ProtoField.bytes("mcup.payload", "Payload")
 local f_detailed_type = ProtoField.string("mcup.detailed_type", "Detailed Type")
 
@@ -64,6 +92,8 @@ mcup.fields = {
     f_checksum,
     f_fragmentSeq,
     f_timestamp,
+    f_stream_id,
+    f_fragment_index,
     f_payload,
     f_detailed_type
 }
@@ -100,16 +130,36 @@ function mcup.dissector(buffer, pinfo, tree)
     subtree:add(f_timestamp, buffer(5, 1), timestamp)
 
 
+    -- Split off the stream flag
+    local stream = msgType >= FIRST_STREAM_TYPE and bit.band(flags, STREAM_FLAG) ~= 0
+    local type_flags = flags
+    if stream then
+        type_flags = bit.band(flags, bit.bnot(STREAM_FLAG))
+    end
+
     -- Determine detailed packet type
     local detailed_type = "Unknown"
-    if flag_definitions[msgType] and flag_definitions[msgType][flags] then
-        detailed_type = flag_definitions[msgType][flags]
+    if flag_definitions[msgType] and flag_definitions[msgType][type_flags] then
+        detailed_type = flag_definitions[msgType][type_flags]
     end
     subtree:add(f_detailed_type, buffer(), detailed_type)
 
+    -- Stream id, then the 32-bit index of file fragments
+    local offset = 6
+    local stream_id = nil
+    if stream and buffer:len() >= offset + 2 then
+        stream_id = buffer(offset, 2):uint()
+        subtree:add(f_stream_id, buffer(offset, 2), stream_id)
+        offset = offset + 2
+    end
+    if msgType == 4 and type_flags == 5 and buffer:len() >= offset + 4 then
+        subtree:add(f_fragment_index, buffer(offset, 4), buffer(offset, 4):uint())
+        offset = offset + 4
+    end
+
     -- Add payload if exists
-    if buffer:len() > 6 then
-        subtree:add(f_payload, buffer(6, buffer:len() - 6))
+    if buffer:len() > offset then
+        subtree:add(f_payload, buffer(offset, buffer:len() - offset))
     end
 
     -- Update info column
@@ -118,6 +168,9 @@ function mcup.dissector(buffer, pinfo, tree)
         detailed_type,
         fragmentSeq,
         flags)
+    if stream_id then
+        pinfo.cols.info:append(string.format(", Stream: %d", stream_id))
+    end
 end
 
 -- Register for UDP ports
@@ -0,0 +1,135 @@
+import time
+
+INITIAL_WINDOW = 10     # packets
+MIN_WINDOW = 2
+MAX_WINDOW = 8192
+PACING_GAIN = 2.0       # send at twice cwnd / srtt so pacing never limits a full window
+PACING_BURST = 8        # packets that may leave back to back
+
+
+class CongestionController:
+    # window measured in packets (fragments)
+    name = "base"
+
+    def __init__(self, initial_window=INITIAL_WINDOW, max_window=MAX_WINDOW):
+        self.cwnd = float(initial_window)
+        self.max_window = max_window
+        self.recovery_until = 0.0
+
+    def can_send(self, in_flight: int) -> bool:
+        return in_flight < max(1, int(self.cwnd))
+
+    def in_recovery(self, now: float) -> bool:
+        return now < self.recovery_until
+
+    def enter_recovery(self, now: float, srtt):
+        # react to at most one loss event per round trip
+        self.recovery_until = now + (srtt or 0.0)
+
+    def on_ack(self, acked: int, now: float = None):
+        pass
+
+    def on_loss(self, now: float = None, srtt=None):
+        pass
+
+    def on_timeout(self, now: float = None, srtt=None):
+        pass
+
+
+class FixedWindow(CongestionController):
+    name = "fixed"
+
+
+class AimdController(CongestionController):
+    name = "aimd"
+    decrease = 0.5
+
+    def on_ack(self, acked: int, now: float = None):
+        self.cwnd = min(self.max_window, self.cwnd + acked / self.cwnd)
+
+    def on_loss(self, now: float = None, srtt=None):
+        now = time.time() if now is None else now
+        if self.in_recovery(now):
+            return
+        self.cwnd = max(MIN_WINDOW, self.cwnd * self.decrease)
+        self.enter_recovery(now, srtt)
+
+    def on_timeout(self, now: float = None, srtt=None):
+        self.on_loss(now, srtt)
+
+
+class NewRenoController(AimdController):
+    name = "newreno"
+
+    def __init__(self, initial_window=INITIAL_WINDOW, max_window=MAX_WINDOW):
+        super().__init__(initial_window, max_window)
+        self.ssthresh = float(max_window)
+
+    def on_ack(self, acked: int, now: float = None):
+        if self.cwnd < self.ssthresh:
+            # slow start
+            self.cwnd = min(self.max_window, self.cwnd + acked)
+        else:
+            super().on_ack(acked, now)
+
+    def on_loss(self, now: float = None, srtt=None):
+        now = time.time() if now is None else now
+        if self.in_recovery(now):
+            return
+        self.ssthresh = max(MIN_WINDOW, self.cwnd * self.decrease)
+        self.cwnd = self.ssthresh
+        self.enter_recovery(now, srtt)
+
+    def on_timeout(self, now: float = None, srtt=None):
+        now = time.time() if now is None else now
+        if self.in_recovery(now):
+            return
+        self.ssthresh = max(MIN_WINDOW, self.cwnd * self.decrease)
+        self.cwnd = MIN_WINDOW
+        self.enter_recovery(now, srtt)
+
+
+CONTROLLERS = {
+    FixedWindow.name: FixedWindow,
+    AimdController.name: AimdController,
+    NewRenoController.name: NewRenoController,
+}
+DEFAULT_CONTROLLER = NewRenoController.name
+
+
+def create_controller(name=DEFAULT_CONTROLLER, **kwargs):
+    if name not in CONTROLLERS:
+        raise ValueError(f"Unknown congestion controller: {name}")
+    return CONTROLLERS[name](**kwargs)
+
+
+class Pacer:
+    # token bucket refilled at gain * cwnd / srtt packets per second
+    def __init__(self, gain=PACING_GAIN, burst=PACING_BURST):
+        self.gain = gain
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = None
+
+    def delay(self, cwnd: float, srtt, now: float = None) -> float:
+        # seconds to wait before the next packet may be sent
+        if not srtt:
+            return 0.0
+        now = time.perf_counter() if now is None else now
+        rate = self.gain * cwnd / srtt
+        if self.last_refill is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * rate)
+        self.last_refill = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / rate
+
+    def on_send(self):
+        self.tokens -= 1
+
+    def wait(self, cwnd: float, srtt):
+        delay = self.delay(cwnd, srtt)
+        if delay > 0:
+            time.sleep(delay)
+            self.delay(cwnd, srtt)
+        self.on_send()
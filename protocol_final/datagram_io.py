@@ -0,0 +1,100 @@
+import errno
+import socket
+import struct
+import sys
+from frame_codec import MAX_DATAGRAM_SIZE
+from pmtu import ETHERNET_MTU, IP_UDP_HEADER_LENGTH
+from window_manager import FILE_WINDOW_SIZE, RETRANSMIT_BUDGET
+
+# Linux socket options (linux/udp.h, asm/socket.h), not exported by the socket module
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+SO_SNDBUFFORCE = getattr(socket, "SO_SNDBUFFORCE", 32)
+SO_RCVBUFFORCE = getattr(socket, "SO_RCVBUFFORCE", 33)
+
+MAX_SEGMENTS = 64               # UDP_MAX_SEGMENTS, datagrams per GSO send
+# A GSO send is still one UDP datagram to the kernel, so its segments together must fit one. Frames of more than
+# half of it (the path MTU probe finds about 64 KB on loopback) can't share a send and go out one per sendto
+MAX_GSO_BYTES = MAX_DATAGRAM_SIZE
+
+
+def buffer_size(datagram_size):
+    # a full file window of datagram_size datagrams must fit, the retransmission budget bounds the bytes in flight
+    return min(FILE_WINDOW_SIZE * datagram_size, RETRANSMIT_BUDGET)
+
+
+# until the path MTU probe tells how large the datagrams get
+SOCKET_BUFFER_SIZE = buffer_size(ETHERNET_MTU - IP_UDP_HEADER_LENGTH)
+
+# errors that mean the path cannot offload, as opposed to a transient failure
+OFFLOAD_ERRORS = (errno.EINVAL, errno.EIO, errno.ENOPROTOOPT, errno.EOPNOTSUPP)
+
+
+def size_buffers(sock, size=SOCKET_BUFFER_SIZE):
+    # the FORCE variants ignore net.core.[rw]mem_max but need CAP_NET_ADMIN
+    for force, option in ((SO_SNDBUFFORCE, socket.SO_SNDBUF), (SO_RCVBUFFORCE, socket.SO_RCVBUF)):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, force, size)
+        except OSError:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, size)
+            except OSError:
+                pass
+
+
+class DatagramIO:
+    # wraps the engine's UDP socket, moving many datagrams per syscall where the kernel allows it
+    def __init__(self, sock, buffer_size=SOCKET_BUFFER_SIZE, offload=True):
+        self.sock = sock
+        self.buffer_size = buffer_size
+        size_buffers(self.sock, buffer_size)
+        self.gso = offload and self.enable_gso()
+
+    def enable_gso(self) -> bool:
+        if not sys.platform.startswith("linux") or not hasattr(self.sock, "sendmsg"):
+            return False
+        try:
+            self.sock.getsockopt(SOL_UDP, UDP_SEGMENT)
+            return True
+        except OSError:
+            return False
+
+    def fit(self, datagram_size):
+        # grows the buffers for datagrams of datagram_size bytes, the size a path MTU probe found
+        size = buffer_size(datagram_size)
+        if size > self.buffer_size:
+            self.buffer_size = size
+            size_buffers(self.sock, size)
+
+    def send_many(self, datagrams, address):
+        # returns how many of the datagrams the socket took, a non-blocking socket stops taking them once its
+        # buffer is full. GSO needs equally sized segments, only the last one of a send may be shorter
+        i = 0
+        try:
+            while i < len(datagrams):
+                size = len(datagrams[i])
+                j = i + 1
+                total = size
+                while (self.gso and j < len(datagrams) and j - i < MAX_SEGMENTS and
+                       total + len(datagrams[j]) <= MAX_GSO_BYTES and len(datagrams[j]) <= size):
+                    total += len(datagrams[j])
+                    j += 1
+                    if len(datagrams[j - 1]) < size:
+                        break
+
+                if j - i == 1:
+                    self.sock.sendto(datagrams[i], address)
+                else:
+                    try:
+                        self.sock.sendmsg(datagrams[i:j], [(SOL_UDP, UDP_SEGMENT, struct.pack("=H", size))], 0,
+                                          address)
+                    except OSError as e:
+                        if e.errno not in OFFLOAD_ERRORS:
+                            raise
+                        print(f"UDP segmentation offload unavailable ({e.strerror}), sending datagrams one by one")
+                        self.gso = False
+                        continue
+                i = j
+        except BlockingIOError:
+            pass
+        return i
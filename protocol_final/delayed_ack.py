@@ -0,0 +1,38 @@
+import time
+
+ACK_EVERY = 16      # fragments per SACK
+ACK_DELAY = 0.02    # seconds, longest time a received fragment waits for its ACK
+# what a sender's RTO allows for: the receiver's ACK timer can fire a couple of GIL switch intervals late
+MAX_ACK_DELAY = ACK_DELAY + 0.01
+
+
+class DelayedAck:
+    # ACK every ack_every fragments or after ack_delay seconds, whichever comes first
+    def __init__(self, ack_every=ACK_EVERY, ack_delay=ACK_DELAY):
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        self.pending = 0
+        self.first_pending_time = None
+
+    def on_fragment(self, immediate=False, now=None) -> bool:
+        # returns True when a SACK should be sent right away
+        self.pending += 1
+        if self.first_pending_time is None:
+            self.first_pending_time = time.time() if now is None else now
+        return immediate or self.pending >= self.ack_every
+
+    def is_due(self, now=None) -> bool:
+        if not self.pending:
+            return False
+        now = time.time() if now is None else now
+        return now - self.first_pending_time >= self.ack_delay
+
+    def time_until_due(self, now=None):
+        if not self.pending:
+            return None
+        now = time.time() if now is None else now
+        return max(0.0, self.first_pending_time + self.ack_delay - now)
+
+    def reset(self):
+        self.pending = 0
+        self.first_pending_time = None
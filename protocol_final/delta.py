@@ -0,0 +1,277 @@
+import hashlib
+import os
+import random
+import struct
+import tempfile
+import threading
+import zlib
+from frame_codec import DELTA_PAGE, DELTA_SIGNATURE
+from compression import SPOOL_SIZE, CHUNK_SIZE
+from file_io import read_at
+
+# Delta transfers send a new version of a file the receiver already has an older copy of.
+#
+# Both sides cut their copy into content-defined chunks. Every position gets an 8-bit hash of the WINDOW bytes
+# starting there, a chunk ends after `level` positions in a row whose hash is below 64, so an insertion or
+# deletion only moves the boundaries next to it and every other chunk keeps its content. The hashes of a whole
+# read buffer are computed at once (bytes.translate per window position, xor of the results as big integers) and
+# the boundaries found with bytes.find, all in C, instead of a rolling hash updated byte by byte in Python.
+#
+# The receiver sends the length, Adler-32 and a short BLAKE2b of each chunk of its copy. The sender chunks the new
+# file the same way, looks every chunk up by length and Adler-32, confirms it with BLAKE2b and writes a patch of
+# copy instructions and literal data. The patch is sent like any file (compression, resume and FEC apply to it)
+# and the receiver rebuilds the new file from its copy and the patch.
+
+DELTA_SUFFIX = ".delta"
+MIN_LEVEL = 6           # 4 KiB average chunk
+MAX_LEVEL = 10          # 1 MiB average chunk
+MAX_CHUNKS = 16384      # the level grows with the file so its signature stays small
+READ_SIZE = 4 << 20
+STRONG_SIZE = 8
+MIN_SAVING = 0.1        # a patch has to save at least this much of the file, otherwise the file is sent whole
+POLL_INTERVAL = 0.2     # seconds between signature requests while the receiver is still reading its copy
+MAX_CACHED = 16
+
+WINDOW = 4
+
+def _tables():
+    generator = random.Random(0x5EED)   # fixed, both sides have to cut at the same places
+    tables = []
+    for _ in range(WINDOW):
+        values = list(range(256))
+        generator.shuffle(values)
+        tables.append(bytes(values))
+    return tables
+
+TABLES = _tables()
+MARKS = bytes(1 if value < 64 else 0 for value in range(256))
+
+# patch operations, a copy from the receiver's copy or literal data that follows the operation
+COPY = struct.Struct('!BQQ')
+LITERAL = struct.Struct('!BQ')
+OP_COPY = 1
+OP_LITERAL = 2
+MAX_LITERAL = 1 << 20
+
+
+def chunk_level(size):
+    level = MIN_LEVEL
+    while level < MAX_LEVEL and size >> (2 * level) > MAX_CHUNKS:
+        level += 1
+    return level
+
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=STRONG_SIZE).digest()
+
+
+def window_marks(buffer):
+    # 1 for every position whose window hash is marked, the last WINDOW - 1 positions have no full window
+    n = max(0, len(buffer) - WINDOW + 1)
+    h = 0
+    for k, table in enumerate(TABLES):
+        h ^= int.from_bytes(buffer[k:k + n].translate(table), 'little')
+    return h.to_bytes(n, 'little').translate(MARKS)
+
+
+def chunks(file, level):
+    # (offset, data) of the content-defined chunks from the current position to the end of the file
+    pattern = b'\x01' * level
+    average = 1 << (2 * level)
+    min_size, max_size = average // 4, average * 4
+    buffer = marks = b''
+    start = offset = 0
+    eof = False
+    while True:
+        if not eof and len(buffer) - start < max_size:
+            # a boundary only depends on the data, never on where a read ended
+            block = file.read(READ_SIZE)
+            eof = not block
+            buffer = buffer[start:] + block
+            marks = window_marks(buffer)
+            start = 0
+            continue
+        if start >= len(buffer):
+            return
+        end = marks.find(pattern, start + min_size - level, start + max_size)
+        if end >= 0:
+            end += level
+        else:
+            end = min(start + max_size, len(buffer))
+        yield offset, buffer[start:end]
+        offset += end - start
+        start = end
+
+
+class Signature:
+    # chunk signatures of the receiver's copy of a file
+    def __init__(self, size=0, level=MIN_LEVEL, count=0):
+        self.size = size
+        self.level = level
+        self.count = count
+        self.chunks = []        # (offset, length, Adler-32, BLAKE2b)
+        self.ready = False
+
+    def compute(self, path):
+        try:
+            with open(path, 'rb') as file:
+                for offset, data in chunks(file, self.level):
+                    self.chunks.append((offset, len(data), zlib.adler32(data), strong_hash(data)))
+        except OSError as e:
+            print(f"Cannot read {path} for a delta transfer: {e}")
+            self.chunks = []
+        self.count = len(self.chunks)
+        self.ready = True
+
+    def page(self, first, limit):
+        # answer to a signature request: header and as many signatures from `first` on as fit in limit bytes
+        if not self.ready:
+            return DELTA_PAGE.pack(self.size, 0, 0, first)     # level 0: ask again later
+        count = max(1, (limit - DELTA_PAGE.size) // DELTA_SIGNATURE.size)
+        payload = bytearray(DELTA_PAGE.pack(self.size, self.level, self.count, first))
+        for offset, length, weak, strong in self.chunks[first:first + count]:
+            payload += DELTA_SIGNATURE.pack(length, weak, strong)
+        return payload
+
+    def add_page(self, payload):
+        # sender side, returns the number of signatures still to fetch, None while the receiver is not ready
+        size, level, count, first = DELTA_PAGE.unpack_from(payload)
+        if level == 0:
+            return None
+        self.size, self.level, self.count = size, level, count
+        if first == len(self.chunks):
+            offset = self.chunks[-1][0] + self.chunks[-1][1] if self.chunks else 0
+            for position in range(DELTA_PAGE.size, len(payload) - DELTA_SIGNATURE.size + 1, DELTA_SIGNATURE.size):
+                length, weak, strong = DELTA_SIGNATURE.unpack_from(payload, position)
+                self.chunks.append((offset, length, weak, strong))
+                offset += length
+        return max(0, self.count - len(self.chunks))
+
+
+_signatures = {}    # path -> ((size, mtime), Signature) of the receiver's copies
+_signatures_lock = threading.Lock()
+
+
+def basis_signature(path):
+    # signature of the receiver's copy, read by a background thread on the first request so the receive loop
+    # keeps running; an empty signature when there is no copy
+    try:
+        st = os.stat(path)
+    except OSError:
+        signature = Signature()
+        signature.ready = True
+        return signature
+    key = (st.st_size, st.st_mtime_ns)
+    with _signatures_lock:
+        entry = _signatures.get(path)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        signature = Signature(st.st_size, chunk_level(st.st_size))
+        _signatures[path] = (key, signature)
+        while len(_signatures) > MAX_CACHED:
+            del _signatures[next(iter(_signatures))]
+    threading.Thread(target=signature.compute, args=(path,), daemon=True).start()
+    return signature
+
+
+class PatchWriter:
+    def __init__(self, file):
+        self.file = file
+        self.copy_offset = 0
+        self.copy_length = 0
+        self.literal = bytearray()
+
+    def copy(self, offset, length):
+        self.flush_literal()
+        if self.copy_length and self.copy_offset + self.copy_length == offset:
+            self.copy_length += length  # the next chunk of the copy, one instruction covers both
+            return
+        self.flush_copy()
+        self.copy_offset, self.copy_length = offset, length
+
+    def write_literal(self, data):
+        self.flush_copy()
+        self.literal += data
+        if len(self.literal) >= MAX_LITERAL:
+            self.flush_literal()
+
+    def flush_copy(self):
+        if self.copy_length:
+            self.file.write(COPY.pack(OP_COPY, self.copy_offset, self.copy_length))
+            self.copy_length = 0
+
+    def flush_literal(self):
+        if self.literal:
+            self.file.write(LITERAL.pack(OP_LITERAL, len(self.literal)))
+            self.file.write(self.literal)
+            self.literal = bytearray()
+
+    def close(self):
+        self.flush_copy()
+        self.flush_literal()
+
+
+def build_patch(file, signature, size):
+    # Returns (patch, patch size, bytes taken from the receiver's copy, BLAKE2b-128 of the file),
+    # None when the patch would not be much smaller than the file
+    index = {}
+    for offset, length, weak, strong in signature.chunks:
+        index.setdefault((length, weak), []).append((offset, strong))
+
+    position = file.tell()
+    spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    patch = PatchWriter(spool)
+    digest = hashlib.blake2b(digest_size=16)
+    reused = 0
+    for offset, data in chunks(file, signature.level):
+        digest.update(data)
+        match = None
+        candidates = index.get((len(data), zlib.adler32(data)))
+        if candidates:
+            strong = strong_hash(data)
+            match = next((basis_offset for basis_offset, basis_strong in candidates if basis_strong == strong), None)
+        if match is None:
+            patch.write_literal(data)
+        else:
+            patch.copy(match, len(data))
+            reused += len(data)
+    patch.close()
+
+    file.seek(position)
+    patch_size = spool.tell()
+    if patch_size > size * (1 - MIN_SAVING):
+        spool.close()
+        return None
+    spool.seek(0)
+    return spool, patch_size, reused, digest.digest()
+
+
+def apply_patch(basis_path, patch_path, output_path, size, digest):
+    # rebuilds the new file from the receiver's copy and the patch, True when it matches the sender's file
+    result = hashlib.blake2b(digest_size=16)
+    written = 0
+    with open(basis_path, 'rb') as basis, open(patch_path, 'rb') as patch, open(output_path, 'wb') as output:
+        while True:
+            op = patch.read(1)
+            if not op:
+                break
+            if op[0] == OP_COPY:
+                _, offset, length = COPY.unpack(op + patch.read(COPY.size - 1))
+                while length > 0:
+                    data = read_at(basis, min(CHUNK_SIZE, length), offset)
+                    if not data:
+                        return False
+                    output.write(data)
+                    result.update(data)
+                    offset += len(data)
+                    length -= len(data)
+                    written += len(data)
+            elif op[0] == OP_LITERAL:
+                _, length = LITERAL.unpack(op + patch.read(LITERAL.size - 1))
+                data = patch.read(length)
+                output.write(data)
+                result.update(data)
+                written += len(data)
+            else:
+                return False
+    return written == size and result.digest() == digest
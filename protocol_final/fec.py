@@ -0,0 +1,159 @@
+from frame_codec import FEC_GROUP
+
+# Forward error correction over groups of file fragments. Every group of up to `group_size` data fragments is
+# followed by `parity` parity fragments, the receiver rebuilds up to that many lost or corrupted fragments of the
+# group without a retransmission.
+#
+# The code is systematic Reed-Solomon style over GF(256): parity j is sum(c(j, i) * d_i) over the group's data
+# fragments d_i, with c taken from a Cauchy matrix whose columns are scaled so the first row is all ones. Parity 0
+# is therefore the plain XOR of the group, and every square submatrix stays invertible, so any r missing
+# fragments can be solved from any r parities.
+#
+# Buffers are multiplied with bytes.translate and added as big integers, both run in C.
+
+GF_POLY = 0x11D
+MAX_GROUP = 200         # x and y points of the Cauchy matrix have to be distinct bytes
+MAX_PARITY = 16
+DEFAULT_FEC = (16, 1)   # 16 data fragments, 1 parity (XOR): 6% overhead, survives one loss per group
+
+GF_EXP = [0] * 512
+GF_LOG = [0] * 256
+
+
+def _build_tables():
+    x = 1
+    for i in range(255):
+        GF_EXP[i] = x
+        GF_LOG[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= GF_POLY
+    for i in range(255, 512):
+        GF_EXP[i] = GF_EXP[i - 255]
+
+_build_tables()
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+
+def gf_inv(a):
+    return GF_EXP[255 - GF_LOG[a]]
+
+
+_mul_tables = {}
+
+
+def mul_table(c):
+    table = _mul_tables.get(c)
+    if table is None:
+        table = _mul_tables[c] = bytes(gf_mul(c, x) for x in range(256))
+    return table
+
+
+def coefficient(j, i):
+    # Cauchy entry 1 / (x_j + y_i) with x_j = j and y_i = 255 - i, column scaled by (x_0 + y_i)
+    y = 255 - i
+    return gf_mul(y, gf_inv(j ^ y))
+
+
+def scaled(data, c):
+    # c * data as an integer, ready to be added (xor) to other buffers of any length
+    if c == 0:
+        return 0
+    if c != 1:
+        data = data.translate(mul_table(c))
+    return int.from_bytes(data, 'little')
+
+
+def encode_parity(fragments, j):
+    # shorter fragments count as zero padded to the longest one
+    total = 0
+    for i, fragment in enumerate(fragments):
+        total ^= scaled(fragment, coefficient(j, i))
+    return total.to_bytes(max(len(fragment) for fragment in fragments), 'little')
+
+
+def invert_matrix(matrix):
+    # Gauss-Jordan over GF(256), the matrices are at most MAX_PARITY square
+    n = len(matrix)
+    rows = [list(row) + [1 if i == k else 0 for k in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next(r for r in range(col, n) if rows[r][col])
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        inv = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(inv, value) for value in rows[col]]
+        for r in range(n):
+            factor = rows[r][col]
+            if r != col and factor:
+                rows[r] = [value ^ gf_mul(factor, pivot_value) for value, pivot_value in zip(rows[r], rows[col])]
+    return [row[n:] for row in rows]
+
+
+def recover(received, parities, missing, lengths):
+    # received: position in the group -> data, parities: parity index -> data, missing: positions to rebuild,
+    # lengths: position -> length of the fragment. Needs at least len(missing) parities.
+    used = sorted(parities)[:len(missing)]
+    syndromes = []
+    for j in used:
+        total = int.from_bytes(parities[j], 'little')
+        for i, data in received.items():
+            total ^= scaled(data, coefficient(j, i))
+        syndromes.append(total)
+
+    inverse = invert_matrix([[coefficient(j, i) for i in missing] for j in used])
+    size = max(len(parities[j]) for j in used)
+    rebuilt = {}
+    for row, i in zip(inverse, missing):
+        total = 0
+        for c, syndrome in zip(row, syndromes):
+            if c:
+                total ^= scaled(syndrome.to_bytes(size, 'little'), c)
+        rebuilt[i] = total.to_bytes(size, 'little')[:lengths[i]]
+    return rebuilt
+
+
+class FecEncoder:
+    # collects the data fragments of a transfer and returns parity frames as groups fill up
+    def __init__(self, group_size, parity):
+        self.group_size = group_size
+        self.parity = parity
+        self.start = 0
+        self.fragments = []
+
+    def add(self, fragment):
+        self.fragments.append(fragment)
+        if len(self.fragments) >= self.group_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        # parity payloads of the current group: group header followed by the parity data
+        if not self.fragments:
+            return []
+        header = [FEC_GROUP.pack(self.start, len(self.fragments), j) for j in range(self.parity)]
+        payloads = [header[j] + encode_parity(self.fragments, j) for j in range(self.parity)]
+        self.start += len(self.fragments)
+        self.fragments = []
+        return payloads
+
+
+class FecGroup:
+    # receiver side parities of one group
+    def __init__(self, start, count):
+        self.start = start
+        self.count = count
+        self.parities = {}
+
+
+def parse_fec(value):
+    # "16 2" -> (16, 2), "off" -> None
+    if value.strip().lower() in ("off", "none", "0"):
+        return None
+    group_size, parity = (int(part) for part in value.split())
+    if not 1 <= group_size <= MAX_GROUP or not 1 <= parity <= MAX_PARITY:
+        raise ValueError(f"group size 1..{MAX_GROUP}, parity 1..{MAX_PARITY}")
+    return group_size, parity
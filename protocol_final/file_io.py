@@ -0,0 +1,107 @@
+import os
+
+
+class FragmentBitmap:
+    # one bit per fragment, enough to track multi-GB transfers in a few KB
+    def __init__(self, count: int):
+        self.count = count
+        self.bits = bytearray((count + 7) // 8)
+        self.received = 0
+        self.first_missing = 0  # every fragment below this index has been received
+        self.highest = -1
+
+    def __contains__(self, index: int) -> bool:
+        return 0 <= index < self.count and bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def add(self, index: int) -> bool:
+        if not 0 <= index < self.count or index in self:
+            return False
+        self.bits[index >> 3] |= 1 << (index & 7)
+        self.received += 1
+        self.highest = max(self.highest, index)
+
+        if index == self.first_missing:
+            i = index + 1
+            while i < self.count:
+                # skip whole bytes of received fragments
+                if i & 7 == 0 and self.bits[i >> 3] == 0xFF:
+                    i += 8
+                elif i in self:
+                    i += 1
+                else:
+                    break
+            self.first_missing = i
+        return True
+
+    def is_complete(self) -> bool:
+        return self.received == self.count
+
+    def missing(self, start: int = 0, end: int = None):
+        end = self.count if end is None else min(end, self.count)
+        i = max(start, self.first_missing)
+        while i < end:
+            if i & 7 == 0 and self.bits[i >> 3] == 0xFF:
+                i += 8
+                continue
+            if i not in self:
+                yield i
+            i += 1
+
+    def missing_ranges(self, limit: int = None):
+        # runs of missing fragments as (start, end), once limit runs are found the last one reaches to the end
+        ranges = []
+        i = self.first_missing
+        while True:
+            while i < self.count and i in self:
+                i += 8 if i & 7 == 0 and self.bits[i >> 3] == 0xFF else 1
+            if i >= self.count:
+                return ranges
+            start = i
+            if limit and len(ranges) == limit - 1:
+                ranges.append((start, self.count))
+                return ranges
+            while i < self.count and i not in self:
+                i += 8 if i & 7 == 0 and self.bits[i >> 3] == 0 else 1
+            ranges.append((start, min(i, self.count)))
+
+    @classmethod
+    def restore(cls, count: int, bits: bytes):
+        # bitmap saved in a resume manifest
+        bitmap = cls(count)
+        bitmap.bits[:len(bits)] = bits[:len(bitmap.bits)]
+        if count & 7:
+            bitmap.bits[-1] &= (1 << (count & 7)) - 1
+        bitmap.received = bin(int.from_bytes(bitmap.bits, 'little')).count('1')
+        missing = bitmap.missing_ranges(1)
+        bitmap.first_missing = missing[0][0] if missing else count
+        used = bitmap.bits.rstrip(b'\x00')
+        bitmap.highest = (len(used) - 1) * 8 + used[-1].bit_length() - 1 if used else -1
+        return bitmap
+
+
+def preallocate(path: str, size: int):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    file = open(path, 'w+b')
+    file.truncate(size)
+    return file
+
+
+def write_at(file, data, offset: int):
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(file.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        file.seek(offset)
+        file.write(data)
+
+
+def read_at(file, size: int, offset: int):
+    if hasattr(os, 'pread'):
+        return os.pread(file.fileno(), size, offset)
+    file.seek(offset)
+    return file.read(size)
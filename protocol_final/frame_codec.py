@@ -0,0 +1,179 @@
+import importlib.util
+import struct
+import time
+from checksum import crc16
+import metrics
+
+# Wire layout (see config/script.lua):
+# byte 0    msgType (high nibble) | flags (low nibble)
+# byte 1-2  CRC-16 of the payload, big endian
+# byte 3-4  fragmentSeq, big endian
+# byte 5    timestamp
+# byte 6-   payload
+HEADER = struct.Struct('!BHHB')
+HEADER_LENGTH = HEADER.size
+CHECKSUM = struct.Struct('!H')
+MAX_DATAGRAM_SIZE = 65507
+
+
+class Frame:
+    __slots__ = ('msgType', 'flags', 'checksum', 'fragmentSeq', 'timeStamp', 'payload', 'valid')
+
+    def __init__(self, msgType, flags, checksum, fragmentSeq, timeStamp, payload, valid=True):
+        self.msgType = msgType
+        self.flags = flags
+        self.checksum = checksum
+        self.fragmentSeq = fragmentSeq
+        self.timeStamp = timeStamp
+        self.payload = payload
+        self.valid = valid
+
+    def __repr__(self):
+        return (f"Frame(msgType={self.msgType}, flags={self.flags}, fragmentSeq={self.fragmentSeq}, "
+                f"timeStamp={self.timeStamp}, payload={len(self.payload)} bytes, valid={self.valid})")
+
+
+def encode_into(buf, msgType, flags=0, payload=b'', fragmentSeq=0, timestamp=0, checksum=None, offset=0):
+    # writes header + payload into buf at offset, returns the frame length
+    end = offset + HEADER_LENGTH + len(payload)
+    memoryview(buf)[offset + HEADER_LENGTH:end] = payload
+    return seal(buf, end - offset, msgType, flags, fragmentSeq, timestamp, checksum, offset)
+
+
+def seal(buf, length, msgType, flags=0, fragmentSeq=0, timestamp=0, checksum=None, offset=0):
+    # writes the header of a frame of length bytes whose payload is already in buf, returns the frame length
+    if checksum is None:
+        checksum = crc16(memoryview(buf)[offset + HEADER_LENGTH:offset + length])
+    HEADER.pack_into(buf, offset, (msgType << 4) | flags, checksum, fragmentSeq & 0xFFFF, timestamp)
+    return length
+
+
+def encode(msgType, flags=0, payload=b'', fragmentSeq=0, timestamp=0, checksum=None):
+    buf = bytearray(HEADER_LENGTH + len(payload))
+    encode_into(buf, msgType, flags, payload, fragmentSeq, timestamp, checksum)
+    return buf
+
+
+def decode(data, verify=True):
+    typeFlags, checksum, fragmentSeq, timeStamp = HEADER.unpack_from(data)
+    payload = memoryview(data)[HEADER_LENGTH:]
+    valid = True
+    if verify:
+        started = time.perf_counter()
+        valid = crc16(payload) == checksum
+        metrics.check_time.observe(time.perf_counter() - started)
+        if not valid:
+            metrics.checksum_failures.inc()
+    return Frame(typeFlags >> 4, typeFlags & 15, checksum, fragmentSeq, timeStamp, payload, valid)
+
+
+def read_checksum(data):
+    return CHECKSUM.unpack_from(data, 1)[0]
+
+
+def handler_table(handlers):
+    # dispatch table of a receive loop, indexed by the first header byte: msgType << 4 | flags.
+    # handlers: (msgType, flags, handler) with every flags value the handler takes, the rest stays None
+    table = [None] * 256
+    for msgType, flags, handler in handlers:
+        for flag in flags:
+            table[msgType << 4 | flag] = handler
+    return table
+
+
+# SACK payload (msgType 5, flags 3): cumulative fragment index followed by a bitmap,
+# bit i set means fragment cumulative + 1 + i was received
+SACK_HEADER = struct.Struct('!I')
+MAX_SACK_BITS = 8192
+
+
+def encode_sack(cumulative, selective=()):
+    offsets = [index - cumulative - 1 for index in selective if 0 < index - cumulative <= MAX_SACK_BITS]
+    payload = bytearray(SACK_HEADER.size + (max(offsets) // 8 + 1 if offsets else 0))
+    SACK_HEADER.pack_into(payload, 0, cumulative)
+    for offset in offsets:
+        payload[SACK_HEADER.size + (offset >> 3)] |= 1 << (offset & 7)
+    return payload
+
+
+def decode_sack(payload):
+    cumulative = SACK_HEADER.unpack_from(payload)[0]
+    selective = []
+    bitmap = payload[SACK_HEADER.size:]
+    for i, byte in enumerate(bitmap):
+        while byte:
+            bit = byte & -byte
+            selective.append(cumulative + 1 + i * 8 + bit.bit_length() - 1)
+            byte ^= bit
+    return cumulative, selective
+
+
+# SYN / SYN-ACK payload (msgType 1, flags 2 and 3): bitmask of optional features.
+# A peer that sends no payload supports none of them, the SYN-ACK carries the features both sides share.
+CAPABILITIES = struct.Struct('!I')
+CAP_EXTENDED_SEQ = 0x01     # file fragments (msgType 4, flags 5) start with a 32-bit fragment index
+CAP_MTU_PROBE = 0x02        # answers path MTU probes (msgType 1, flags 6) with a probe ACK (flags 7)
+CAP_STREAMS = 0x04          # file transfers run on their own streams, see STREAM_FLAG
+CAP_STRIPES = 0x08          # accepts stripe headers (msgType 4, flags 7), only servers offer it
+CAP_ZLIB = 0x10             # compression codecs, with any of them the filename frame starts with a codec byte
+CAP_BZ2 = 0x20
+CAP_LZMA = 0x40
+CAP_COMPRESSION = CAP_ZLIB | CAP_BZ2 | CAP_LZMA
+CAP_FEC = 0x80              # takes FEC parity frames (msgType 6) for file fragments, see fec.py
+CAP_RESUME = 0x100          # keeps interrupted file transfers and answers resume offers (msgType 7), see resume.py
+CAP_DELTA = 0x200           # sends chunk signatures of its copies and applies patches (msgType 8), see delta.py
+
+# Python can be built without liblzma, lzma.py is still there but its _lzma extension is not.
+# Only probe for it here, compression.py imports the codec
+AVAILABLE_CODECS = CAP_COMPRESSION if importlib.util.find_spec("_lzma") else CAP_ZLIB | CAP_BZ2
+
+SUPPORTED_CAPABILITIES = (CAP_EXTENDED_SEQ | CAP_MTU_PROBE | CAP_STREAMS | AVAILABLE_CODECS | CAP_FEC |
+                          CAP_RESUME | CAP_DELTA)
+
+# extended file fragment payload: fragment index followed by the data
+FILE_INDEX = struct.Struct('!I')
+
+# With CAP_STREAMS every file transfer frame (msgType 4) and its SACKs (msgType 5, flags 3) set STREAM_FLAG
+# on top of the usual flags, and their payload starts with the stream id. Stream fragments (flags 5 | STREAM_FLAG)
+# always carry the 32-bit index after it.
+STREAM_FLAG = 0x8
+STREAM_ID = struct.Struct('!H')
+
+# A striped file is sent as several transfers from different sockets, each one announces its byte range with a
+# stripe header (msgType 4, flags 7) instead of the filename: transfer id, file size, range offset and length,
+# stripe index and count, CRC-32 of the range, followed by the filename.
+STRIPE = struct.Struct('!IQQQHHI')
+
+# FEC parity frame (msgType 6, flags 0 or STREAM_FLAG): [stream id] + first fragment index of the group,
+# number of data fragments in the group, parity index, followed by the parity data. Parity frames are sent once,
+# they are never acknowledged or retransmitted.
+FEC_GROUP = struct.Struct('!IBB')
+
+# Resume offer (msgType 7, flags 1, [| STREAM_FLAG]), sent between the file size and the fragment count:
+# [stream id] + size and modification time (ns) of the file on the sender, codec id, fragment length the sender
+# would use. The answer (flags 2, same timestamp) is the fragment length to send with followed by the
+# (first, end) fragment ranges the receiver is missing, all of them for a file it knows nothing about.
+RESUME_OFFER = struct.Struct('!QQBI')
+RESUME_ANSWER = struct.Struct('!I')
+RESUME_RANGE = struct.Struct('!II')
+
+# Delta transfer (msgType 8). Before the filename the sender fetches the chunk signatures of the receiver's copy
+# page by page: request (flags 1) [stream id] + first chunk, largest answer, filename; answer (flags 2, same
+# timestamp) [stream id] + size of the copy, chunking level (0: still being read, ask again), number of chunks,
+# first chunk, followed by signatures: chunk length, Adler-32, BLAKE2b-64. After the filename the delta header
+# (flags 3, acknowledged) [stream id] + size of the copy, size and BLAKE2b-128 of the new file announces that the
+# file data is a patch against the copy.
+DELTA_REQUEST = struct.Struct('!II')
+DELTA_PAGE = struct.Struct('!QBII')
+DELTA_SIGNATURE = struct.Struct('!II8s')
+DELTA_HEADER = struct.Struct('!QQ16s')
+
+
+def encode_capabilities(capabilities=SUPPORTED_CAPABILITIES):
+    return CAPABILITIES.pack(capabilities)
+
+
+def decode_capabilities(payload):
+    if len(payload) < CAPABILITIES.size:
+        return 0
+    return CAPABILITIES.unpack_from(payload)[0]
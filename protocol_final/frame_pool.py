@@ -0,0 +1,65 @@
+from frame_codec import HEADER_LENGTH, FILE_INDEX, STREAM_ID, STREAM_FLAG, seal
+
+# File fragments are framed in place: the stream id and fragment index are packed into a free buffer of the
+# transfer's pool, the file data is read in behind them with readinto, the header is written last and the socket
+# gets a view of the buffer. The sender window keeps that view for retransmissions and hands the buffer back when
+# the fragment leaves the window, so a transfer keeps reusing the same memory instead of creating the bytes of a
+# few copies of every fragment.
+#
+# Buffers are cut from slabs of SLAB_SIZE bytes. A pool grows by a slab when every buffer is in flight, the
+# retransmission budget bounds how far, and goes away with its transfer.
+
+SLAB_SIZE = 1 << 20
+
+
+def frame_size(fragMaxLen):
+    # largest file fragment frame: header, stream id, fragment index and the data
+    return HEADER_LENGTH + STREAM_ID.size + FILE_INDEX.size + fragMaxLen
+
+
+class FramePool:
+    # acquire runs where the transfer frames its fragments, release wherever a packet leaves its window: on ACKs
+    # and SACKs, when a packet runs out of attempts, when the sender gives up. All of it runs on the engine's event
+    # loop, which sends a batch of frames before it handles anything else (Session.flush), so a buffer never goes
+    # back before the socket has its frame
+    def __init__(self, fragMaxLen):
+        self.size = frame_size(fragMaxLen)
+        self.slab_count = max(1, SLAB_SIZE // self.size)
+        self.free = []
+
+    def grow(self):
+        slab = memoryview(bytearray(self.size * self.slab_count))
+        self.free.extend(slab[offset:offset + self.size] for offset in range(0, len(slab), self.size))
+
+    def acquire(self):
+        if not self.free:
+            self.grow()
+        return self.free.pop()
+
+    def release(self, buffer):
+        self.free.append(buffer)
+
+    def fragment(self, file, length, seq_num, timestamp, stream_id=None, indexed=False):
+        # frames the next length bytes of file as file fragment seq_num, with the 32-bit index when indexed
+        # (always on a stream). Returns (buffer, frame, data), None at the end of the file
+        buffer = self.acquire()
+        if stream_id is not None:
+            flags = 5 | STREAM_FLAG
+            STREAM_ID.pack_into(buffer, HEADER_LENGTH, stream_id)
+            FILE_INDEX.pack_into(buffer, HEADER_LENGTH + STREAM_ID.size, seq_num)
+            start = HEADER_LENGTH + STREAM_ID.size + FILE_INDEX.size
+        elif indexed:
+            flags = 5
+            FILE_INDEX.pack_into(buffer, HEADER_LENGTH, seq_num)
+            start = HEADER_LENGTH + FILE_INDEX.size
+        else:
+            flags = 4
+            start = HEADER_LENGTH
+        read = file.readinto(buffer[start:start + length])
+        if not read:
+            self.release(buffer)
+            return None
+        end = start + read
+        seal(buffer, end, 4, flags, seq_num, timestamp)
+        frame = buffer if end == self.size else buffer[:end]
+        return buffer, frame, buffer[start:end]
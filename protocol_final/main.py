@@ -1,21 +1,38 @@
-import threading
+import argparse
+import asyncio
 from window_manager import getIpAddress
-from sendThread import sendPacket
-from receiveThread import receivePacket
-from controlThread import sendControlPacket
+from metrics import serve_metrics
 
 if __name__ == "__main__":
-    targetIp = input("Enter the target IP: ")
-    if targetIp.count('.') != 3:
-        targetIp = getIpAddress()
-        print(f"set the IP to the IP of local host ({targetIp})")
-    targetPort = int(input("Enter the target port: "))
-    listenPort = int(input("Enter the port to listen on: "))
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+                        help="threads: the engine runs on its own thread, commands on the main thread (default), "
+                             "asyncio: everything on a single event loop")
+    parser.add_argument("--server", action="store_true",
+                        help="accept connections from many peers, runs the asyncio engine")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="server worker processes sharing the port (default: one per CPU)")
+    parser.add_argument("--metrics", metavar="ADDRESS", default=None,
+                        help="serve metrics over HTTP on [host:]port or unix:/path, as Prometheus text at "
+                             "/metrics and JSON at /metrics.json (server workers use the following ports)")
+    args = parser.parse_args()
 
-    sendThread = threading.Thread(target=sendPacket, args=(targetIp, targetPort))
-    controlThread = threading.Thread(target=sendControlPacket, args=(targetIp, targetPort))
-    receiveThread = threading.Thread(target=receivePacket, args=(targetIp, listenPort, targetPort))
+    if args.server:
+        from async_engine import run_server
+        run_server(int(input("Enter the port to listen on: ")), args.workers, metrics_address=args.metrics)
+    else:
+        if args.metrics:
+            serve_metrics(args.metrics)
+        targetIp = input("Enter the target IP: ")
+        if targetIp.count('.') != 3:
+            targetIp = getIpAddress()
+            print(f"set the IP to the IP of local host ({targetIp})")
+        targetPort = int(input("Enter the target port: "))
+        listenPort = int(input("Enter the port to listen on: "))
 
-    receiveThread.start()
-    sendThread.start()
-    controlThread.start()
\ No newline at end of file
+        if args.engine == "asyncio":
+            from async_engine import run_cli
+            asyncio.run(run_cli(targetIp, targetPort, listenPort))
+        else:
+            from async_engine import run_threaded
+            run_threaded(targetIp, targetPort, listenPort)
@@ -0,0 +1,267 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# Counters and histograms of the protocol engine, shared by every thread of the process. Counters only grow, rates
+# are left to whoever reads them, e.g. in Prometheus:
+#   rate(protocol_file_bytes_received_total[10s])          goodput of the receiver
+#   rate(protocol_retransmits_total[1m]) / rate(protocol_packets_sent_total[1m])     loss seen by the sender
+#
+# --metrics ADDRESS serves them over HTTP on host:port (or just a port, on 127.0.0.1) or on a Unix socket
+# (unix:/path): /metrics in the Prometheus text format, /metrics.json as JSON. !stats prints a summary.
+
+PREFIX = "protocol_"
+
+
+def exponential_buckets(start, factor, count):
+    return [start * factor ** i for i in range(count)]
+
+
+TIME_BUCKETS = exponential_buckets(1e-5, 2, 21)     # 10 us .. 10 s
+FAST_BUCKETS = exponential_buckets(1e-7, 2, 20)     # 100 ns .. 50 ms
+PACKET_BUCKETS = exponential_buckets(1, 2, 13)      # 1 .. 4096 packets
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, "", self.value)]
+
+    def as_json(self):
+        return self.value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # the last bucket holds what is above every bound
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+    def quantile(self, q):
+        # upper bound of the bucket the q-quantile falls in, None before the first observation
+        counts, _, count = self.snapshot()
+        if not count:
+            return None
+        total = 0
+        for bound, n in zip(self.bounds + [float('inf')], counts):
+            total += n
+            if total >= q * count:
+                return bound
+
+    def samples(self):
+        counts, total, count = self.snapshot()
+        samples = []
+        cumulative = 0
+        for bound, n in zip(self.bounds, counts):
+            cumulative += n
+            samples.append((self.name + "_bucket", f'{{le="{bound:g}"}}', cumulative))
+        samples.append((self.name + "_bucket", '{le="+Inf"}', count))
+        samples.append((self.name + "_sum", "", total))
+        samples.append((self.name + "_count", "", count))
+        return samples
+
+    def as_json(self):
+        counts, total, count = self.snapshot()
+        buckets = {f"{bound:g}": n for bound, n in zip(self.bounds, counts)}
+        buckets["+Inf"] = counts[-1]
+        return {
+            "count": count,
+            "sum": total,
+            "buckets": buckets,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help):
+        self.metrics.append(Counter(PREFIX + name, help))
+        return self.metrics[-1]
+
+    def histogram(self, name, help, buckets):
+        self.metrics.append(Histogram(PREFIX + name, help, buckets))
+        return self.metrics[-1]
+
+    def prometheus(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{labels} {value}" for name, labels, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def as_json(self):
+        return {"time": time.time(), "pid": os.getpid(),
+                "metrics": {metric.name: metric.as_json() for metric in self.metrics}}
+
+
+registry = Registry()
+
+packets_sent = registry.counter("packets_sent_total", "Datagrams sent, retransmissions included")
+bytes_sent = registry.counter("bytes_sent_total", "Bytes of the datagrams sent")
+packets_received = registry.counter("packets_received_total", "Datagrams received")
+bytes_received = registry.counter("bytes_received_total", "Bytes of the datagrams received")
+fragments_sent = registry.counter("fragments_sent_total", "Text and file fragments sent for the first time")
+retransmits = registry.counter("retransmits_total", "Frames sent again after a timeout, a NAK or a SACK gap")
+acks_sent = registry.counter("acks_sent_total", "ACK and SACK frames sent")
+acks_received = registry.counter("acks_received_total", "ACK and SACK frames received")
+naks_sent = registry.counter("naks_sent_total", "NAK frames sent")
+naks_received = registry.counter("naks_received_total", "NAK frames received")
+checksum_failures = registry.counter("checksum_failures_total", "Frames received with a CRC that does not match")
+corrupted_fragments = registry.counter("corrupted_fragments_total", "Fragments damaged on purpose with !err")
+file_bytes_sent = registry.counter("file_bytes_sent_total", "File data sent for the first time")
+file_bytes_received = registry.counter("file_bytes_received_total", "New file data written by the receiver")
+
+rtt = registry.histogram("rtt_seconds", "Round trip times sampled from ACKs", TIME_BUCKETS)
+ack_delay = registry.histogram("ack_delay_seconds", "Time a received fragment waited for its SACK", TIME_BUCKETS)
+encode_time = registry.histogram("fragment_encode_seconds", "Time to frame a fragment, CRC included", FAST_BUCKETS)
+check_time = registry.histogram("frame_check_seconds", "Time to check the CRC of a received frame", FAST_BUCKETS)
+window_occupancy = registry.histogram("window_occupancy_packets", "Packets in the window when a fragment is added",
+                                      PACKET_BUCKETS)
+
+
+def _count(datagram, packets, sizes, acks, naks):
+    packets.inc()
+    sizes.inc(len(datagram))
+    if datagram and datagram[0] >> 4 == 5:     # ACK / NAK / SACK, the stream flag may be set on a SACK
+        if datagram[0] & 7 == 2:
+            naks.inc()
+        else:
+            acks.inc()
+
+
+def on_sent(datagram):
+    _count(datagram, packets_sent, bytes_sent, acks_sent, naks_sent)
+
+
+def on_sent_many(datagrams):
+    # batches only carry fragments and parity, nothing to sort out
+    packets_sent.inc(len(datagrams))
+    bytes_sent.inc(sum(len(datagram) for datagram in datagrams))
+
+
+def on_received(datagram):
+    _count(datagram, packets_received, bytes_received, acks_received, naks_received)
+
+
+def on_fragment(encode_seconds=None, occupancy=None):
+    fragments_sent.inc()
+    if encode_seconds is not None:
+        encode_time.observe(encode_seconds)
+    if occupancy is not None:
+        window_occupancy.observe(occupancy)
+
+
+def _duration(seconds):
+    if seconds is None:
+        return "-"
+    if seconds == float('inf'):
+        return "inf"
+    if seconds >= 1:
+        return f"{seconds:.3g} s"
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.3g} ms"
+    return f"{seconds * 1e6:.3g} us"
+
+
+def summary():
+    sent = packets_sent.value
+    lines = [
+        "",
+        "--- Transfer Statistics ---",
+        f"Packets sent: {sent} ({bytes_sent.value} bytes), received: {packets_received.value} "
+        f"({bytes_received.value} bytes)",
+        f"Fragments sent: {fragments_sent.value}, retransmissions: {retransmits.value} "
+        f"({100 * retransmits.value / sent if sent else 0:.2f}% of the packets sent)",
+        f"File data sent: {file_bytes_sent.value} bytes, received: {file_bytes_received.value} bytes",
+        f"ACKs sent: {acks_sent.value}, received: {acks_received.value}, NAKs sent: {naks_sent.value}, "
+        f"received: {naks_received.value}",
+        f"Checksum failures: {checksum_failures.value}, corrupted on purpose: {corrupted_fragments.value}",
+    ]
+    for name, histogram in (("RTT", rtt), ("ACK delay", ack_delay), ("Fragment encode", encode_time),
+                            ("CRC check", check_time)):
+        lines.append(f"{name}: median {_duration(histogram.quantile(0.5))}, "
+                     f"p99 {_duration(histogram.quantile(0.99))} ({histogram.count} samples)")
+    lines.append(f"Window occupancy: median {window_occupancy.quantile(0.5) or '-'}, "
+                 f"p99 {window_occupancy.quantile(0.99) or '-'} packets")
+    lines.append("---------------------------")
+    return "\n".join(lines)
+
+
+def serve_metrics(address, offset=0):
+    # starts the endpoint on a daemon thread, offset keeps the endpoints of server worker processes apart.
+    # The HTTP modules take longer to import than a small transfer, only a process that serves pays for them
+    import json
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if path in ("/", "/metrics"):
+                body, content_type = registry.prometheus().encode(), "text/plain; version=0.0.4; charset=utf-8"
+            elif path == "/metrics.json":
+                body, content_type = json.dumps(registry.as_json()).encode(), "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass    # a scrape every few seconds would bury the chat
+
+    class UnixMetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    if address.startswith("unix:"):
+        path = address[len("unix:"):] + (f".{offset}" if offset else "")
+        try:
+            os.remove(path)     # left behind by an earlier run
+        except FileNotFoundError:
+            pass
+        server = UnixMetricsServer(path, MetricsHandler)
+        where = f"unix:{path}"
+    else:
+        host, _, port = address.rpartition(":")
+        host = host or "127.0.0.1"
+        server = ThreadingHTTPServer((host, int(port) + offset), MetricsHandler)
+        where = f"http://{host}:{int(port) + offset}/metrics"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on {where}")
+    return server
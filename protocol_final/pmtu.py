@@ -0,0 +1,73 @@
+import socket
+import struct
+import sys
+from frame_codec import HEADER_LENGTH, FILE_INDEX, STREAM_ID, FEC_GROUP, MAX_DATAGRAM_SIZE
+
+# Linux socket options (linux/in.h), the socket module only exports some of them
+IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)
+IP_PMTUDISC_DONT = getattr(socket, "IP_PMTUDISC_DONT", 0)
+IP_PMTUDISC_PROBE = getattr(socket, "IP_PMTUDISC_PROBE", 3)    # set DF, ignore the cached path MTU
+IP_MTU = getattr(socket, "IP_MTU", 14)
+
+IP_UDP_HEADER_LENGTH = 28       # IPv4 without options + UDP
+ETHERNET_MTU = 1500
+MIN_MTU = 576                   # every IPv4 path carries this without fragmentation
+PROBE_ATTEMPTS = 2              # a probe lost twice counts as too big
+MTU_PROBE_ACK = struct.Struct('!I')     # probe ACK payload: size of the probe datagram that arrived
+
+
+def fragment_length(datagram_size):
+    # largest fragment payload that fits a datagram, fragments may carry a stream id and a 4-byte index,
+    # their FEC parity the stream id and the group header
+    return datagram_size - HEADER_LENGTH - STREAM_ID.size - max(FILE_INDEX.size, FEC_GROUP.size)
+
+
+def interface_mtu(ip, port):
+    # MTU of the route to the peer as the kernel sees it, 65536 on loopback, 9000 on jumbo-frame LANs
+    if not sys.platform.startswith("linux"):
+        return ETHERNET_MTU
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect((ip, port))
+        return s.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return ETHERNET_MTU
+    finally:
+        s.close()
+
+
+def set_dont_fragment(sock, mode=IP_PMTUDISC_PROBE):
+    # returns the previous mode so it can be restored, None when the platform has no such option
+    try:
+        previous = sock.getsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER)
+        sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, mode)
+        return previous
+    except OSError:
+        return None
+
+
+class MtuSearch:
+    # binary search for the largest datagram that reaches the peer, probe sizes are UDP payload sizes.
+    # The interface limit is tried first, on loopback and well configured LANs that is the only probe.
+    def __init__(self, mtu, low=MIN_MTU - IP_UDP_HEADER_LENGTH):
+        self.low = low          # known to work
+        self.high = max(low, min(MAX_DATAGRAM_SIZE, mtu - IP_UDP_HEADER_LENGTH))
+        self.first = True
+
+    def next_probe(self):
+        if self.low >= self.high:
+            return None
+        if self.first:
+            return self.high
+        return (self.low + self.high + 1) // 2
+
+    def on_result(self, size, delivered):
+        self.first = False
+        if delivered:
+            self.low = max(self.low, size)
+        else:
+            self.high = size - 1
+
+    @property
+    def best(self):
+        return self.low
@@ -1,357 +1,559 @@
-import socket
-from threading import Lock
-
+import os
 import time
-from typing import Set, Dict
-
-import controlThread
-from window_manager import manager, sendMSG, ReceiverWindow, lastMessageCorrupted, window_manager, handle_nak, Packet
-
 
-SIZE = 8
-bigMessageBuffer = []
-processedFile = ''
-fileLen = 0
-textBuffer = [None]
-receiver_lock = Lock()
-file_transfer_state = {}
-receiver_window = None
-fragmented_messages = {}
+from file_io import FragmentBitmap, preallocate, write_at, read_at
+from frame_codec import (encode_sack, MAX_SACK_BITS, FILE_INDEX, STREAM_FLAG, STREAM_ID, CAP_COMPRESSION, FEC_GROUP,
+                         DELTA_REQUEST, DELTA_HEADER)
+from resume import (MANIFEST_SUFFIX, MANIFEST_INTERVAL, answer_limit, decode_offer, encode_answer, save_manifest,
+                    load_manifest, remove_manifest)
+from compression import CODEC_IDS, NO_CODEC, DECOMPRESS_ERRORS, CHUNK_SIZE
+from fec import FecGroup, recover
+from delta import DELTA_SUFFIX, basis_signature, apply_patch
+from delayed_ack import DelayedAck
+import metrics
+from stripes import StripeHeader, open_shared, range_crc32, record_stripe
+from window_manager import manager, sendMSG, MAX_SEQ_NUM
+
+# Receive side of the protocol: the engine in async_engine.py hands every frame of a peer to these handlers,
+# they answer through its socket
+
+RECEIVED_FILES_DIR = "received_files"
+COMPRESSED_SUFFIX = ".compressed"   # compressed fragments are collected here and decompressed into the file
 
 class FileTransferState:
-    def __init__(self, filename: str):
-        self.filename = f"received_files/{filename}"
+    def __init__(self, filename: str, stream_id=None, directory: str = RECEIVED_FILES_DIR):
+        # only the base name is used, a peer must not be able to write outside the directory
+        self.filename = os.path.join(directory, os.path.basename(filename))
+        self.stream_id = stream_id
         self.file = None
         self.file_size: int = 0
         self.fragment_count: int = 0
-        self.received_fragments: Set[int] = set()
-        self.fragments_data: Dict[int, bytes] = {}
-        self.missing_fragments: Set[int] = set()
-        self.last_request_time: Dict[int, float] = {}
-        self.request_attempts: Dict[int, int] = {}
-        self.MAX_RETRIES = 3
-        self.REQUEST_TIMEOUT = 5.0  # seconds
-        self.connection_interrupted = False  # Track if the connection was interrupted
+        self.fragment_size: int = 0
+        self.received_fragments = FragmentBitmap(0)
+        self.delayed_ack = DelayedAck()
+        self.stripe = None      # StripeHeader when this transfer is one byte range of a striped file
+        self.codec = None
+        self.decompressor = None
+        self.output = None
+        self.decoded = 0        # compressed bytes fed to the decompressor so far
+        self.fec_groups = {}    # first fragment of a group -> FecGroup with the parities that arrived for it
+        self.fec_stride = 0     # data fragments per FEC group
+        self.identity = None    # file identity from the sender's resume offer, None when the peer cannot resume
+        self.delta = None       # (size of the local copy, size and BLAKE2b of the new file) when the data is a patch
+        self.checkpoint_time = 0.0
+
+    @property
+    def offset(self) -> int:
+        return self.stripe.offset if self.stripe is not None else 0
+
+    @property
+    def target(self) -> str:
+        # where the transferred data ends up, a patch is kept next to the file until it is applied
+        return self.filename + DELTA_SUFFIX if self.delta is not None else self.filename
+
+    @property
+    def partial_path(self) -> str:
+        # the file the fragments are written to
+        return self.target + COMPRESSED_SUFFIX if self.codec is not None else self.target
+
+    @property
+    def manifest_path(self) -> str:
+        return self.partial_path + MANIFEST_SUFFIX
 
     def initialize_file(self, size: int, count: int):
+        if self.file is not None:
+            if (size, count) == (self.file_size, self.fragment_count):
+                return  # resumed, the offer already opened the partial file
+            self.close_files()
         self.file_size = size
         self.fragment_count = count
-        self.file = open(self.filename, 'wb')
-        self.missing_fragments = set(range(count))
-
-    def can_request_fragment(self, fragment_num: int, current_time: float) -> bool:
-        if fragment_num not in self.last_request_time:
-            return True
-
-        if (current_time - self.last_request_time[fragment_num] >= self.REQUEST_TIMEOUT and
-                self.request_attempts.get(fragment_num, 0) < self.MAX_RETRIES):
-            return True
+        # reserve the whole file up front, fragments are written at their offsets as they arrive.
+        # open_shared and preallocate create the directory
+        if self.stripe is not None:
+            self.file = open_shared(self.filename, self.stripe.file_size)
+        else:
+            remove_manifest(self.manifest_path)    # it described the data that is overwritten now
+            self.file = preallocate(self.partial_path, size)
+            if self.codec is not None:
+                # size and count describe the compressed data, the file itself is written front to back
+                self.output = open(self.target, 'wb')
+        self.received_fragments = FragmentBitmap(count)
+
+    @property
+    def missing_count(self) -> int:
+        return self.fragment_count - self.received_fragments.received
+
+    def offer_resume(self, identity, fragment_size: int):
+        # answer to the sender's resume offer: fragment length to use and the fragment ranges still missing
+        self.identity = identity
+        if self.file is None:
+            manifest = load_manifest(self.manifest_path)
+            if (manifest is not None and manifest["identity"] == identity and
+                    manifest["file_size"] == self.file_size and 0 < manifest["fragment_size"] <= fragment_size):
+                self.resume(manifest)
+        if self.file is not None:
+            return self.fragment_size, self.received_fragments.missing_ranges(answer_limit(fragment_size))
+
+        self.fragment_size = fragment_size
+        count = (self.file_size + fragment_size - 1) // fragment_size
+        return fragment_size, [(0, count)] if count else []
+
+    def resume(self, manifest):
+        path = self.partial_path
+        if not os.path.isfile(path) or os.path.getsize(path) < manifest["file_size"]:
+            return False
+        self.file = open(path, 'r+b')
+        self.fragment_size = manifest["fragment_size"]
+        self.fragment_count = manifest["fragment_count"]
+        self.received_fragments = FragmentBitmap.restore(self.fragment_count, manifest["bitmap"])
+        if self.codec is not None:
+            # the decompressed part is rebuilt from the compressed fragments already on disk
+            self.output = open(self.target, 'wb')
+            self.decoded = 0
+            self.decompress_ready()
+        print(f"Resuming {self.filename}: {self.received_fragments.received} of {self.fragment_count} "
+              f"fragments already here")
+        return True
 
-        return False
+    def checkpoint(self, force: bool = False):
+        now = time.time()
+        if self.identity is None or not force and now - self.checkpoint_time < MANIFEST_INTERVAL:
+            return
+        save_manifest(self.manifest_path, self.identity, self.file_size, self.fragment_size, self.received_fragments)
+        self.checkpoint_time = now
+
+    def learn_fragment_size(self, fragment_num: int, length: int):
+        # every fragment except the last one is exactly fragment_size long
+        if fragment_num < self.fragment_count - 1:
+            self.fragment_size = length
+        elif self.fragment_count > 1:
+            self.fragment_size = (self.file_size - length) // (self.fragment_count - 1)
+        else:
+            self.fragment_size = length
 
-    def record_fragment_request(self, fragment_num: int, current_time: float):
-        self.last_request_time[fragment_num] = current_time
-        self.request_attempts[fragment_num] = self.request_attempts.get(fragment_num, 0) + 1
+    def process_fragment(self, fragment_num: int, data) -> bool:
+        if self.file is None or not 0 <= fragment_num < self.fragment_count:
+            return False
+        if fragment_num in self.received_fragments:
+            return False
+        if not self.fragment_size:
+            self.learn_fragment_size(fragment_num, len(data))
+        write_at(self.file, data, self.offset + fragment_num * self.fragment_size)
+        if not self.received_fragments.add(fragment_num):
+            return False
+        metrics.file_bytes_received.inc(len(data))
+        if self.identity is not None:
+            self.checkpoint()
+        if self.decompressor is not None:
+            self.decompress_ready()
+        if self.fec_groups:
+            group = self.fec_groups.get(fragment_num - fragment_num % self.fec_stride)
+            if group is not None:
+                self.recover_group(group)
+        return True
 
-    def process_fragment(self, fragment_num: int, data: bytes) -> bool:
-        if fragment_num in self.missing_fragments:
-            self.fragments_data[fragment_num] = data
-            self.received_fragments.add(fragment_num)
-            self.missing_fragments.remove(fragment_num)
-            return True
-        return False
+    def fragment_length(self, fragment_num: int) -> int:
+        if fragment_num < self.fragment_count - 1:
+            return self.fragment_size
+        return self.file_size - (self.fragment_count - 1) * self.fragment_size
+
+    def process_parity(self, start: int, count: int, parity_index: int, data) -> int:
+        # returns the number of fragments rebuilt
+        if self.file is None or not 0 <= start < self.fragment_count:
+            return 0
+        group = self.fec_groups.get(start)
+        if group is None:
+            if all(i in self.received_fragments for i in range(start, min(start + count, self.fragment_count))):
+                return 0
+            group = self.fec_groups[start] = FecGroup(start, count)
+            self.fec_stride = max(self.fec_stride, count)
+        group.parities[parity_index] = data
+        return self.recover_group(group)
+
+    def recover_group(self, group: FecGroup) -> int:
+        indexes = range(group.start, min(group.start + group.count, self.fragment_count))
+        missing = [i - group.start for i in indexes if i not in self.received_fragments]
+        if not missing:
+            del self.fec_groups[group.start]
+            return 0
+        if len(missing) > len(group.parities) or not self.fragment_size:
+            return 0
+
+        # the fragments that did arrive are already in the file
+        received = {i - group.start: read_at(self.file, self.fragment_length(i), self.offset + i * self.fragment_size)
+                    for i in indexes if i in self.received_fragments}
+        rebuilt = recover(received, group.parities, missing,
+                          {i - group.start: self.fragment_length(i) for i in indexes})
+        del self.fec_groups[group.start]
+        for position, data in rebuilt.items():
+            self.process_fragment(group.start + position, data)
+        return len(rebuilt)
+
+    def set_codec(self, codec):
+        self.codec = codec
+        self.decompressor = codec.decompressor()
+
+    def decompress_ready(self):
+        # feed the compressed bytes that are contiguous by now, so the file grows while the transfer runs
+        end = min(self.received_fragments.first_missing * self.fragment_size, self.file_size)
+        try:
+            while self.decoded < end:
+                chunk = read_at(self.file, min(CHUNK_SIZE, end - self.decoded), self.decoded)
+                self.output.write(self.decompressor.decompress(chunk))
+                self.decoded += len(chunk)
+        except DECOMPRESS_ERRORS as e:
+            print(f"Cannot decompress {self.filename}: {e}")
+            self.decompressor = None
 
     def is_complete(self) -> bool:
-        return len(self.missing_fragments) == 0
+        return self.file is not None and self.received_fragments.is_complete()
+
+    def build_sack(self):
+        received = self.received_fragments
+        cumulative = received.first_missing
+        end = min(received.highest + 1, cumulative + 1 + MAX_SACK_BITS)
+        selective = [i for i in range(cumulative + 1, end) if i in received]
+        return cumulative, selective
 
     def write_file(self):
         if not self.is_complete():
             return False
 
-        # Sort fragments and write them in order
-        for i in range(self.fragment_count):
-            self.file.write(self.fragments_data[i])
-        self.file.close()
+        if self.stripe is not None:
+            return self.finish_stripe()
+        remove_manifest(self.manifest_path)
+        if self.codec is not None:
+            if not self.finish_decompression():
+                return False
+        else:
+            # fragments are already on disk, just flush and close
+            self.file.close()
+        if self.delta is not None:
+            return self.apply_delta()
         return True
 
-    def handle_interruption(self, current_time: float):
-        """Handle interrupted connection, retry missing fragments."""
-        if self.connection_interrupted:
-            for missing_fragment in list(self.missing_fragments):
-                if self.can_request_fragment(missing_fragment, current_time):
-                    print(f"Requesting missing fragment {missing_fragment} after connection interruption")
-                    request_message = manager(4, flags=6, fragmentSeq=missing_fragment,
-                                              timestamp=current_time)
-                    sendMSG(sock, request_message, ip, responsePort, storeMessage=False)
-                    self.record_fragment_request(missing_fragment, current_time)
-
-def handle_file_transfer(parsedMessage, sock, ip, responsePort, file_transfer_state: FileTransferState = None):
-    checksum = manager.calculate_checksum(parsedMessage['payload'])
-    current_time = time.time()
-
-    if parsedMessage['flags'] == 1:  # Filename
-        if checksum == int.from_bytes(parsedMessage['checksum'], byteorder='big'):
-            filename = parsedMessage['payload'].decode('utf-8')
-            file_transfer_state = FileTransferState(filename)
-            print(f"Receiving file: {filename}")
-            ack_message = manager(5, flags=1, fragmentSeq=parsedMessage['fragmentSeq'],
-                                  timestamp=parsedMessage["timeStamp"])
-            sendMSG(sock, ack_message, ip, responsePort, storeMessage=False)
-            return file_transfer_state
-
-    elif parsedMessage['flags'] == 2:  # File size
-        if checksum == int.from_bytes(parsedMessage['checksum'], byteorder='big'):
-            file_size = int(parsedMessage['payload'].decode('utf-8'))
-            print(f"File size: {file_size}")
-            ack_message = manager(5, flags=1, fragmentSeq=parsedMessage['fragmentSeq'],
-                                  timestamp=parsedMessage["timeStamp"])
-            sendMSG(sock, ack_message, ip, responsePort, storeMessage=False)
-            if file_transfer_state:
-                file_transfer_state.file_size = file_size
-
-    elif parsedMessage['flags'] == 3:  # Fragment count
-        if checksum == int.from_bytes(parsedMessage['checksum'], byteorder='big'):
-            fragment_count = int(parsedMessage['payload'].decode('utf-8'))
-            print(f"Expected fragments: {fragment_count}")
-            if file_transfer_state:
-                file_transfer_state.initialize_file(file_transfer_state.file_size, fragment_count)
-            ack_message = manager(5, flags=1, fragmentSeq=parsedMessage['fragmentSeq'],
-                                  timestamp=parsedMessage["timeStamp"])
-            sendMSG(sock, ack_message, ip, responsePort, storeMessage=False)
-
-    elif parsedMessage['flags'] == 4:  # File fragment
-        if checksum == int.from_bytes(parsedMessage['checksum'], byteorder='big'):
-            fragment_num = parsedMessage['fragmentSeq']
-
-            if file_transfer_state and file_transfer_state.process_fragment(fragment_num, parsedMessage['payload']):
-                print(f"Received fragment {fragment_num}")
-                ack_message = manager(5, flags=1, fragmentSeq=fragment_num,
-                                      timestamp=parsedMessage["timeStamp"])
-                sendMSG(sock, ack_message, ip, responsePort, storeMessage=False)
-
-                # Новая логика проверки и запроса недостающих фрагментов
-                window_size = 100  # Размер окна, можно вынести как параметр
-                window_start = max(0, fragment_num - window_size)
-                window_end = min(file_transfer_state.fragment_count, fragment_num + window_size)
-
-                # Фильтруем недостающие фрагменты в текущем окне
-                current_window_missing = {
-                    missing for missing in file_transfer_state.missing_fragments
-                    if window_start <= missing < window_end
-                }
-
-                if current_window_missing:
-                    for missing_fragment in sorted(current_window_missing):
-                        if file_transfer_state.can_request_fragment(missing_fragment, current_time):
-                            print(f"Requesting missing fragment in current window: {missing_fragment}")
-                            request_message = manager(4, flags=6, fragmentSeq=missing_fragment,
-                                                      timestamp=parsedMessage["timeStamp"])
-                            sendMSG(sock, request_message, ip, responsePort, storeMessage=False)
-                            file_transfer_state.record_fragment_request(missing_fragment, current_time)
-
-                # Проверка полноты передачи файла
-                if file_transfer_state.is_complete():
-                    if file_transfer_state.write_file():
-                        print("File transfer complete")
-                    else:
-                        print("Error writing file")
-
-                progress = ((file_transfer_state.fragment_count - len(file_transfer_state.missing_fragments)) /
-                            file_transfer_state.fragment_count * 100)
-                print(f"File transfer progress: {progress:.2f}%")
+    def finish_decompression(self):
+        if self.decompressor is not None:
+            self.decompress_ready()
+        complete = self.decompressor is not None and self.decompressor.eof
+        self.file.close()
+        self.output.close()
+        os.remove(self.partial_path)
+        if not complete:
+            print(f"Compressed data of {self.filename} is truncated or corrupt")
+        return complete
+
+    def apply_delta(self):
+        basis_size, size, digest = self.delta
+        patch = self.target
+        rebuilt = self.filename + ".tmp"
+        try:
+            complete = (os.path.getsize(self.filename) == basis_size and
+                        apply_patch(self.filename, patch, rebuilt, size, digest))
+        except (OSError, ValueError) as e:
+            print(f"Cannot apply the patch for {self.filename}: {e}")
+            complete = False
+        if complete:
+            os.replace(rebuilt, self.filename)
+            os.remove(patch)
+            print(f"Rebuilt {self.filename} from the local copy and {self.file_size} bytes of patch")
         else:
-            print(f"Checksum mismatch for fragment {parsedMessage['fragmentSeq']}")
-            nak_message = manager(5, flags=2, fragmentSeq=parsedMessage['fragmentSeq'],
-                                  timestamp=parsedMessage["timeStamp"])
-            sendMSG(sock, nak_message, ip, responsePort, storeMessage=False)
-
-    return file_transfer_state
+            print(f"The local copy of {self.filename} changed, the patch does not apply, send the file again")
+            for path in (rebuilt, patch):
+                if os.path.exists(path):
+                    os.remove(path)
+        return complete
+
+    def finish_stripe(self):
+        # a range counts once it matches the sender's CRC, the file is whole when every range has been verified
+        stripe = self.stripe
+        crc = range_crc32(self.file, stripe.offset, stripe.length)
+        self.file.close()
+        if crc != stripe.crc:
+            print(f"Stripe {stripe.index + 1}/{stripe.count} of {self.filename} failed verification")
+            return False
+        if record_stripe(self.filename, stripe.index, stripe.count) == stripe.count:
+            print(f"Striped file complete, {stripe.count} ranges verified: {self.filename}")
+        return True
 
-def handle_text_message(parsedMessage, sock, ip, responsePort, receiver_window, addr):
-    seq_num = parsedMessage['fragmentSeq']
-    message_id = parsedMessage["timeStamp"]
+    def handle_interruption(self):
+        # the peer is gone: keep what arrived, the next transfer of the same file only fetches the rest
+        if self.file is None or self.file.closed or self.is_complete():
+            return
+        if self.identity is not None and self.stripe is None:
+            self.checkpoint(force=True)
+            print(f"Transfer of {self.filename} interrupted, {self.received_fragments.received} of "
+                  f"{self.fragment_count} fragments kept for resuming")
+        else:
+            print(f"Incomplete file transfer: {self.filename}")
+        self.close_files()
 
-    # Create test message with same parameters but without checksum
-    test_message = manager(
-        msgType=parsedMessage['msgType'],
-        flags=parsedMessage['flags'],
-        payload=parsedMessage['payload'],
-        fragmentSeq=parsedMessage['fragmentSeq'],
-        timestamp=parsedMessage["timeStamp"]
-    )
+    def close_files(self):
+        self.file.close()
+        self.file = None
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+
+def send_sack(file_transfer_state: FileTransferState, sock, ip, responsePort):
+    cumulative, selective = file_transfer_state.build_sack()
+    # the header only has room for 16 bits, the payload carries the full cumulative index
+    flags, payload = 3, encode_sack(cumulative, selective)
+    if file_transfer_state.stream_id is not None:
+        flags |= STREAM_FLAG
+        payload = STREAM_ID.pack(file_transfer_state.stream_id) + payload
+    sack_message = manager(5, flags=flags, fragmentSeq=cumulative & MAX_SEQ_NUM, payload=payload)
+    sendMSG(sock, sack_message, ip, responsePort)
+    if file_transfer_state.delayed_ack.first_pending_time is not None:
+        metrics.ack_delay.observe(time.time() - file_transfer_state.delayed_ack.first_pending_time)
+    file_transfer_state.delayed_ack.reset()
+
+def file_stream_id(parsedMessage):
+    # stream of a file transfer frame, None for frames without one
+    if parsedMessage.flags & STREAM_FLAG and len(parsedMessage.payload) >= STREAM_ID.size:
+        return STREAM_ID.unpack_from(parsedMessage.payload)[0]
+    return None
+
+def handle_file_transfer(parsedMessage, sock, ip, responsePort, file_transfer_state: FileTransferState = None,
+                         directory: str = RECEIVED_FILES_DIR, capabilities: int = 0):
+    # frames on a stream carry the stream id in front of the usual payload
+    flags = parsedMessage.flags
+    payload = parsedMessage.payload
+    stream_id = file_stream_id(parsedMessage)
+    if stream_id is not None:
+        flags &= ~STREAM_FLAG
+        payload = payload[STREAM_ID.size:]
+
+    if flags == 1:  # Filename
+        # with compression negotiated the filename starts with the codec byte
+        codec_id = NO_CODEC
+        if capabilities & CAP_COMPRESSION and payload:
+            codec_id, payload = payload[0], payload[1:]
+        filename = str(payload, 'utf-8')
+        file_transfer_state = FileTransferState(filename, stream_id, directory)
+        if codec_id in CODEC_IDS:
+            file_transfer_state.set_codec(CODEC_IDS[codec_id])
+        elif codec_id != NO_CODEC:
+            print(f"Unknown compression codec {codec_id} for {filename}")
+        print(f"Receiving file: {filename}" +
+              (f" ({file_transfer_state.codec.name} compressed)" if file_transfer_state.codec else ""))
+        ack_message = manager(5, flags=1, fragmentSeq=parsedMessage.fragmentSeq, timestamp=parsedMessage.timeStamp)
+        sendMSG(sock, ack_message, ip, responsePort)
+        return file_transfer_state
+
+    elif flags == 7:  # Stripe header, announces one byte range of a file sent over several connections
+        stripe = StripeHeader.unpack(payload)
+        # the stripes arrive from different ports, they meet in a directory named after the transfer
+        directory = os.path.join(RECEIVED_FILES_DIR, f"{ip}_{stripe.transfer_id:08x}")
+        file_transfer_state = FileTransferState(stripe.filename, stream_id, directory)
+        file_transfer_state.stripe = stripe
+        print(f"Receiving stripe {stripe.index + 1}/{stripe.count} of {stripe.filename}")
+        ack_message = manager(5, flags=1, fragmentSeq=parsedMessage.fragmentSeq, timestamp=parsedMessage.timeStamp)
+        sendMSG(sock, ack_message, ip, responsePort)
+        return file_transfer_state
+
+    elif flags == 2:  # File size
+        file_size = int(str(payload, 'utf-8'))
+        print(f"File size: {file_size}")
+        ack_message = manager(5, flags=1, fragmentSeq=parsedMessage.fragmentSeq, timestamp=parsedMessage.timeStamp)
+        sendMSG(sock, ack_message, ip, responsePort)
+        if file_transfer_state:
+            file_transfer_state.file_size = file_size
+
+    elif flags == 3:  # Fragment count
+        fragment_count = int(str(payload, 'utf-8'))
+        print(f"Expected fragments: {fragment_count}")
+        if file_transfer_state:
+            file_transfer_state.initialize_file(file_transfer_state.file_size, fragment_count)
+        ack_message = manager(5, flags=1, fragmentSeq=parsedMessage.fragmentSeq, timestamp=parsedMessage.timeStamp)
+        sendMSG(sock, ack_message, ip, responsePort)
+
+    elif flags in (4, 5):  # File fragment, flags 5 carries the full 32-bit index in the payload
+        fragment_num = parsedMessage.fragmentSeq
+        data = payload
+        if flags == 5:
+            fragment_num = FILE_INDEX.unpack_from(data)[0]
+            data = data[FILE_INDEX.size:]
+
+        if file_transfer_state:
+            first_missing = file_transfer_state.received_fragments.first_missing
+            received_before = file_transfer_state.received_fragments.received
+            is_new = file_transfer_state.process_fragment(fragment_num, data)
+
+            # ACK immediately on gaps, filled holes and duplicates so the sender learns about loss quickly
+            out_of_order = (fragment_num != first_missing or
+                            file_transfer_state.received_fragments.first_missing > first_missing + 1)
+            if file_transfer_state.delayed_ack.on_fragment(not is_new or out_of_order or
+                                                           file_transfer_state.is_complete()):
+                send_sack(file_transfer_state, sock, ip, responsePort)
+
+            if is_new:
+                report_file_progress(file_transfer_state, received_before)
 
-    # Compare checksums
-    received_checksum = int.from_bytes(parsedMessage['checksum'], byteorder='big')
-    wait_checksum = test_message.checksum
+    return file_transfer_state
 
-    print(f"Received checksum: {received_checksum}")
-    print(f"Calculated checksum: {wait_checksum}")
+def report_file_progress(file_transfer_state: FileTransferState, received_before: int):
+    # Проверка полноты передачи файла
+    if file_transfer_state.is_complete():
+        if file_transfer_state.write_file():
+            print(f"File transfer complete: {file_transfer_state.filename}")
+        else:
+            print("Error writing file")
+
+    # report progress once per percent instead of once per fragment
+    received = file_transfer_state.received_fragments.received
+    progress = received * 100 // file_transfer_state.fragment_count
+    if progress != received_before * 100 // file_transfer_state.fragment_count:
+        print(f"File transfer progress: {progress}%")
+
+def handle_fec_parity(parsedMessage, sock, ip, responsePort, file_transfer_state: FileTransferState = None):
+    # parity of a group of file fragments, rebuilds what the group lost without waiting for a retransmission
+    if file_transfer_state is None:
+        return
+    payload = parsedMessage.payload
+    if parsedMessage.flags & STREAM_FLAG:
+        payload = payload[STREAM_ID.size:]
+    start, count, parity_index = FEC_GROUP.unpack_from(payload)
+    received_before = file_transfer_state.received_fragments.received
+    recovered = file_transfer_state.process_parity(start, count, parity_index, payload[FEC_GROUP.size:])
+    if recovered:
+        print(f"Recovered {recovered} fragment(s) of group {start} from parity")
+        # the sender learns right away that it does not have to resend them
+        send_sack(file_transfer_state, sock, ip, responsePort)
+        report_file_progress(file_transfer_state, received_before)
+
+def handle_resume_offer(parsedMessage, sock, ip, responsePort, file_transfer_state: FileTransferState = None):
+    # the sender asks which fragments of the announced file are still missing here
+    if file_transfer_state is None or file_transfer_state.stripe is not None:
+        return
+    payload = parsedMessage.payload
+    if parsedMessage.flags & STREAM_FLAG:
+        payload = payload[STREAM_ID.size:]
+    identity, fragment_size = decode_offer(payload)
+    fragment_size, ranges = file_transfer_state.offer_resume(identity, fragment_size)
+    payload = encode_answer(fragment_size, ranges)
+    if file_transfer_state.stream_id is not None:
+        payload = STREAM_ID.pack(file_transfer_state.stream_id) + payload
+    answer = manager(7, flags=2 | (parsedMessage.flags & STREAM_FLAG), payload=payload,
+                     fragmentSeq=parsedMessage.fragmentSeq, timestamp=parsedMessage.timeStamp)
+    sendMSG(sock, answer, ip, responsePort)
+
+def control_answer(parsedMessage):
+    # payload of a resume or delta signature answer without the stream id
+    payload = parsedMessage.payload
+    if parsedMessage.flags & STREAM_FLAG:
+        payload = payload[STREAM_ID.size:]
+    return bytes(payload)
+
+def handle_delta(parsedMessage, sock, ip, responsePort, file_transfer_state: FileTransferState = None,
+                 directory: str = RECEIVED_FILES_DIR):
+    flags = parsedMessage.flags & ~STREAM_FLAG
+    payload = parsedMessage.payload
+    prefix = b''
+    if parsedMessage.flags & STREAM_FLAG:
+        prefix, payload = bytes(payload[:STREAM_ID.size]), payload[STREAM_ID.size:]
+
+    if flags == 1:
+        # signature request, comes before the filename and only names the file
+        first, limit = DELTA_REQUEST.unpack_from(payload)
+        filename = os.path.basename(str(payload[DELTA_REQUEST.size:], 'utf-8'))
+        page = basis_signature(os.path.join(directory, filename)).page(first, limit)
+        answer = manager(8, flags=2 | (parsedMessage.flags & STREAM_FLAG), payload=prefix + page,
+                         fragmentSeq=parsedMessage.fragmentSeq, timestamp=parsedMessage.timeStamp)
+        sendMSG(sock, answer, ip, responsePort)
+
+    elif flags == 3 and file_transfer_state is not None:
+        # the file data that follows is a patch against the local copy
+        file_transfer_state.delta = DELTA_HEADER.unpack_from(payload)
+        print(f"{file_transfer_state.filename} comes as a patch against the local copy")
+        ack_message = manager(5, flags=1, fragmentSeq=parsedMessage.fragmentSeq, timestamp=parsedMessage.timeStamp)
+        sendMSG(sock, ack_message, ip, responsePort)
+
+def register_transfer(file_transfer_states, stream_id, file_transfer_state: FileTransferState):
+    # a transfer restarted by the peer may come on another stream, the old state is saved for resuming first
+    for key, other in list(file_transfer_states.items()):
+        if other is not None and (key == stream_id or other.filename == file_transfer_state.filename):
+            other.handle_interruption()
+            del file_transfer_states[key]
+    file_transfer_states[stream_id] = file_transfer_state
+
+def interrupt_transfers(file_transfer_states):
+    for file_transfer_state in file_transfer_states.values():
+        if file_transfer_state is not None:
+            file_transfer_state.handle_interruption()
+    file_transfer_states.clear()
+
+def handle_text_message(parsedMessage, sock, ip, responsePort, receiver_window, addr, messages):
+    # messages: reassembly buffers of the peer's fragmented messages, by message id
+    seq_num = parsedMessage.fragmentSeq
+    message_id = parsedMessage.timeStamp
 
     # Non-fragmented message
-    if parsedMessage['flags'] == 1:
+    if parsedMessage.flags == 1:
         if receiver_window.is_in_window(seq_num):
-            if wait_checksum == received_checksum:
-                # Send ack for verif. message
-                print(f"Message verified. Sending ACK for packet {seq_num}")
-                ack_message = manager(5, flags=1, fragmentSeq=seq_num, timestamp=message_id)
-                sendMSG(sock, ack_message, ip, responsePort, storeMessage=False)
-                print(f"{addr} Sent a message: {parsedMessage['payload'].decode('utf-8')}")
-
-                # Update receiver window with received packet
-                receiver_window.receive_packet(seq_num, parsedMessage['payload'])
-            else:
-                print(f"Checksum mismatch for packet {seq_num}, sending NAK")
-                nak_message = manager(5, flags=2, fragmentSeq=seq_num, timestamp=message_id)
-                sendMSG(sock, nak_message, ip, responsePort, storeMessage=False)
-
-    # Start of fragmented message
-    elif parsedMessage['flags'] == 2:
-        fragmented_messages[message_id] = {
-            "buffer": [None] * parsedMessage["fragmentSeq"],
-            "expected_fragments": parsedMessage["fragmentSeq"],
-            "received_fragments": set()  # Track successfully received fragments
-        }
-        print(f"Started receiving fragmented message with {parsedMessage['fragmentSeq']} fragments")
+            # Send ack for verif. message
+            ack_message = manager(5, flags=1, fragmentSeq=seq_num, timestamp=message_id)
+            sendMSG(sock, ack_message, ip, responsePort)
+            print(f"{addr} Sent a message: {str(parsedMessage.payload, 'utf-8')}")
+
+            # Update receiver window with received packet
+            receiver_window.receive_packet(seq_num, parsedMessage.payload)
+
+    # Start of fragmented message, the sender resends it until it is acknowledged
+    elif parsedMessage.flags == 2:
+        message_info = messages.get(message_id)
+        if message_info is None or message_info["expected_fragments"] != parsedMessage.fragmentSeq:
+            # messages are sent one after the other, one that never completed was given up by the sender
+            messages.clear()
+            messages[message_id] = {
+                "buffer": [None] * parsedMessage.fragmentSeq,
+                "expected_fragments": parsedMessage.fragmentSeq,
+                "received_fragments": set()  # Track successfully received fragments
+            }
+            print(f"Started receiving fragmented message with {parsedMessage.fragmentSeq} fragments")
+        ack_message = manager(5, flags=1, fragmentSeq=seq_num, timestamp=message_id)
+        sendMSG(sock, ack_message, ip, responsePort)
 
     # Fragment of message
-    elif parsedMessage['flags'] == 4:
-        if message_id not in fragmented_messages:
+    elif parsedMessage.flags == 4:
+        if message_id not in messages:
             print(f"Received fragment for unknown message ID {message_id}")
             return
 
-        message_info = fragmented_messages[message_id]
-        extracted_j = int.from_bytes(parsedMessage['payload'][:4], byteorder='big')
-        original_payload = parsedMessage['payload'][4:]
-
-        if wait_checksum == received_checksum:
-            if extracted_j < len(message_info["buffer"]):
-                # Check if this fragment was already received correctly
-                if extracted_j not in message_info["received_fragments"]:
-                    message_info["buffer"][extracted_j] = original_payload.decode('utf-8')
-                    message_info["received_fragments"].add(extracted_j)
-                    print(f"Fragment {extracted_j} received and verified")
-
-                # Send ack
-                ack_message = manager(5, flags=1, fragmentSeq=seq_num, timestamp=message_id)
-                sendMSG(sock, ack_message, ip, responsePort, storeMessage=False)
-
-                # Check if message is complete sended
-                if len(message_info["received_fragments"]) == message_info["expected_fragments"]:
-                    complete_message = ''.join(message_info["buffer"])
-                    print(f"{addr} Sent a complete fragmented message: {complete_message}")
-                    del fragmented_messages[message_id]
-            else:
-                print(f"Fragment index {extracted_j} out of range")
+        message_info = messages[message_id]
+        extracted_j = int.from_bytes(parsedMessage.payload[:4], byteorder='big')
+        original_payload = parsedMessage.payload[4:]
+
+        if extracted_j < len(message_info["buffer"]):
+            # Check if this fragment was already received correctly
+            if extracted_j not in message_info["received_fragments"]:
+                message_info["buffer"][extracted_j] = str(original_payload, 'utf-8')
+                message_info["received_fragments"].add(extracted_j)
+
+            # Send ack
+            ack_message = manager(5, flags=1, fragmentSeq=seq_num, timestamp=message_id)
+            sendMSG(sock, ack_message, ip, responsePort)
+
+            # Check if message is complete sended
+            if len(message_info["received_fragments"]) == message_info["expected_fragments"]:
+                complete_message = ''.join(message_info["buffer"])
+                print(f"{addr} Sent a complete fragmented message: {complete_message}")
+                del messages[message_id]
         else:
-            print(f"Checksum mismatch for fragment {extracted_j}, sending NAK")
-            nak_message = manager(5, flags=2, fragmentSeq=seq_num, timestamp=message_id)
-            sendMSG(sock, nak_message, ip, responsePort, storeMessage=False)
-
-def receivePacket(ip: str, listenPort: int, responsePort: int):
-    global processedFile, fileLen, textBuffer, file_transfer_state, receiver_window, sender_window
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(('', listenPort))
-
-    with window_manager.window_lock:
-        receiver_window = ReceiverWindow(8)  # Same window size as sender
-
-    print(f"Listening on port {listenPort}...")
-
-    while True:
-        try:
-            data, addr = sock.recvfrom(1500)
-            message = manager.fromMessageBytes(data)
-            parsedMessage = message.parse()
-
-            if receiver_window is None:
-                with receiver_lock:
-                    receiver_window = ReceiverWindow(8)
-
-            if lastMessageCorrupted:
-                print(f"Message corrupted, requesting resend")
-                nak_message = manager(5, flags=2, timestamp=parsedMessage["timeStamp"])
-                sendMSG(sock, nak_message, ip, responsePort, storeMessage=False)
-                continue
-
-            # control messages
-            if parsedMessage['msgType'] == 1:
-                # Handle control messages
-                with controlThread.connection_lock:
-                    if parsedMessage['flags'] == 2:
-                        controlThread.hasConnectionToPeer = True
-                        response = manager(1, flags=3)
-                        sendMSG(sock, response, ip, responsePort)
-                        print(f"A peer has connected: {addr}")
-                        receiver_window = ReceiverWindow(8)
-                    elif parsedMessage['flags'] == 3:
-                        controlThread.hasConnectionToPeer = True
-                    elif parsedMessage['flags'] == 4:
-                        response = manager(1, flags=5) # response to keep alive
-                        sendMSG(sock, response, ip, responsePort)
-                    elif parsedMessage['flags'] == 5:
-                        controlThread.expectingResponse = False
-                    elif parsedMessage['flags'] == 8:
-                        response = manager(1, flags=9)
-                        sendMSG(sock, response, ip, responsePort)
-                        controlThread.hasConnectionToPeer = False
-                        controlThread.expectingResponse = False
-                        controlThread.ConnectionManuallyInterrupted = True
-                        print("peer has cut their connection")
-                    elif parsedMessage['flags'] == 9:
-                        controlThread.hasConnectionToPeer = False
-                        controlThread.expectingResponse = False
-                        controlThread.ConnectionManuallyInterrupted = True
-
-            # receivePacket
-            elif parsedMessage['msgType'] in [2, 3]:
-                handle_text_message(parsedMessage, sock, ip, responsePort, receiver_window, addr)
-
-            #file transfer
-            elif parsedMessage['msgType'] == 4:
-                file_transfer_state = handle_file_transfer(parsedMessage, sock, ip, responsePort, file_transfer_state)
-
-            elif parsedMessage['msgType'] == 5 and parsedMessage['flags'] == 1:
-                with window_manager.window_lock:
-                    print(f"Received ACK for packet {parsedMessage['fragmentSeq']}")
-
-                    if window_manager.sender_window is not None:
-                        seq_num = parsedMessage['fragmentSeq']
-
-                        # Print debug information
-                        print(f"Current sender window packets: {list(window_manager.sender_window.packets.keys())}")
-
-                        # Modify to handle packets more flexibly
-                        if seq_num in window_manager.sender_window.packets:
-                            packet = window_manager.sender_window.packets[seq_num]
-                            packet.acknowledged = True
-                            window_manager.sender_window.remove_packet(seq_num)
-                            print(f"Packet {seq_num} acknowledged and removed")
-                        else:
-                            # Add more flexible handling for ACKs
-                            print(f"Warning: ACK for packet {seq_num} not found in current window")
-
-                            # Try to find and update the packet in a more flexible way
-                            for p_seq, packet in list(window_manager.sender_window.packets.items()):
-                                if p_seq == seq_num:
-                                    packet.acknowledged = True
-                                    window_manager.sender_window.remove_packet(p_seq)
-                                    print(f"Found and acknowledged packet {p_seq}")
-                                    break
-
-            elif parsedMessage['msgType'] == 5 and parsedMessage['flags'] == 2:
-                print(f"Received NAK for packet {parsedMessage['fragmentSeq']}")
-                handle_nak(parsedMessage, parsedMessage['fragmentSeq'], sock, ip, responsePort)
-
-                # Add to sender_window.packets
-                seq_num = parsedMessage['fragmentSeq']
-                window_manager.sender_window.add_packet(Packet(seq_num, window_manager.sender_window.packets[seq_num].payload, time.time()))
-                continue
-            else:
-                print(f"Unknown message type: {parsedMessage['msgType']}")
-                continue
-
-
-
-        except Exception as e:
-            print(f"Error in receive thread: {e}")
-            continue
\ No newline at end of file
+            print(f"Fragment index {extracted_j} out of range")
+
+    # flags 5 closes a fragmented message, it was printed when its last fragment arrived
+
+def reject_frame(parsedMessage, sock, ip, responsePort):
+    # a frame whose payload does not match its CRC. Text and file fragments outside a stream are NAKed so they
+    # are resent right away, anything else is dropped and sent again when the sender's timer runs out
+    msgType, flags = parsedMessage.msgType, parsedMessage.flags
+    if msgType in (2, 3) and flags in (1, 4) or msgType == 4 and flags in (4, 5):
+        print(f"Checksum mismatch for packet {parsedMessage.fragmentSeq}, sending NAK")
+        nak_message = manager(5, flags=2, fragmentSeq=parsedMessage.fragmentSeq, timestamp=parsedMessage.timeStamp)
+        sendMSG(sock, nak_message, ip, responsePort)
+    elif msgType == 4 and flags & STREAM_FLAG:
+        # the stream id of a damaged frame cannot be trusted, the gap shows up in the next SACK instead
+        print(f"Checksum mismatch for a stream fragment {parsedMessage.fragmentSeq}")
+    else:
+        print(f"Checksum mismatch, dropping a frame of type {msgType} with flags {flags}")
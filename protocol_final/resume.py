@@ -0,0 +1,82 @@
+import base64
+import json
+import os
+from frame_codec import RESUME_OFFER, RESUME_ANSWER, RESUME_RANGE
+from compression import NO_CODEC
+
+# A receiver keeps a manifest next to every partial file: which version of which file it is, the transfer size,
+# the fragment length and the bitmap of the fragments already on disk. When the same file is sent again the
+# receiver answers the sender's resume offer with the fragment ranges it is still missing.
+#
+# The manifest is rewritten at most once per MANIFEST_INTERVAL while fragments arrive and once more when the
+# connection drops. The fragments it lists were written before it, so a stale manifest only costs resends.
+# Nothing is fsynced: this survives a lost peer or a killed process, not a power cut.
+
+MANIFEST_SUFFIX = ".manifest"
+MANIFEST_INTERVAL = 1.0     # seconds
+
+
+def file_identity(file, codec=None):
+    # (size, modification time, codec id), a file changed since the interrupted transfer starts over
+    st = os.fstat(file.fileno())
+    return st.st_size, st.st_mtime_ns, codec.id if codec else NO_CODEC
+
+
+def encode_offer(identity, fragment_size):
+    return RESUME_OFFER.pack(*identity, fragment_size)
+
+
+def decode_offer(payload):
+    size, mtime_ns, codec_id, fragment_size = RESUME_OFFER.unpack_from(payload)
+    return (size, mtime_ns, codec_id), fragment_size
+
+
+def answer_limit(fragment_size):
+    # ranges that fit an answer no larger than a fragment, past them the last range reaches to the end of the file
+    return max(1, (fragment_size - RESUME_ANSWER.size) // RESUME_RANGE.size)
+
+
+def encode_answer(fragment_size, ranges):
+    payload = bytearray(RESUME_ANSWER.pack(fragment_size))
+    for first, end in ranges:
+        payload += RESUME_RANGE.pack(first, end)
+    return payload
+
+
+def decode_answer(payload):
+    fragment_size = RESUME_ANSWER.unpack_from(payload)[0]
+    ranges = [RESUME_RANGE.unpack_from(payload, offset)
+              for offset in range(RESUME_ANSWER.size, len(payload) - RESUME_RANGE.size + 1, RESUME_RANGE.size)]
+    return fragment_size, ranges
+
+
+def save_manifest(path, identity, file_size, fragment_size, bitmap):
+    manifest = {
+        "identity": list(identity),
+        "file_size": file_size,
+        "fragment_size": fragment_size,
+        "fragment_count": bitmap.count,
+        "bitmap": base64.b64encode(bytes(bitmap.bits)).decode('ascii'),
+    }
+    # written aside and renamed, a crash in the middle leaves the previous manifest
+    with open(path + ".tmp", 'w') as file:
+        json.dump(manifest, file)
+    os.replace(path + ".tmp", path)
+
+
+def load_manifest(path):
+    try:
+        with open(path) as file:
+            manifest = json.load(file)
+        manifest["identity"] = tuple(manifest["identity"])
+        manifest["bitmap"] = base64.b64decode(manifest["bitmap"])
+        return manifest
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def remove_manifest(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
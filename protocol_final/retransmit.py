@@ -0,0 +1,36 @@
+from delayed_ack import MAX_ACK_DELAY
+import metrics
+
+INITIAL_RTO = 0.2       # seconds, used until the first RTT sample
+MIN_RTO = 0.005
+MAX_RTO = 5.0
+MAX_RETRANSMISSIONS = 10
+CLOCK_GRANULARITY = 0.001
+
+
+class RttEstimator:
+    # smoothed RTT / RTT variance as in RFC 6298, plus the peer's delayed-ACK allowance
+    def __init__(self, initial_rto=INITIAL_RTO, min_rto=MIN_RTO, max_rto=MAX_RTO, max_ack_delay=MAX_ACK_DELAY):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.max_ack_delay = max_ack_delay
+
+    def sample(self, rtt: float):
+        if rtt < 0:
+            return
+        metrics.rtt.observe(rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        rto = self.srtt + max(CLOCK_GRANULARITY, 4 * self.rttvar) + self.max_ack_delay
+        self.rto = min(self.max_rto, max(self.min_rto, rto))
+
+    def timeout(self, retransmissions: int = 0) -> float:
+        # exponential backoff for packets that already timed out
+        return min(self.max_rto, self.rto * (2 ** retransmissions))
@@ -0,0 +1,84 @@
+import os
+import zlib
+from frame_codec import STRIPE
+from file_io import read_at
+
+try:
+    import fcntl
+except ImportError:     # no file locks, stripes finishing at the same moment may both miss the last one
+    fcntl = None
+
+DEFAULT_STRIPES = os.cpu_count() or 1
+MIN_STRIPE_SIZE = 1 << 20       # smaller ranges do not pay for a process and a handshake
+CRC_CHUNK = 1 << 20
+
+
+def stripe_range(file_size, index, count):
+    # (offset, length) of a stripe, the lengths differ by at most one byte
+    start = file_size * index // count
+    return start, file_size * (index + 1) // count - start
+
+
+def stripe_count(file_size, stripes=DEFAULT_STRIPES):
+    return max(1, min(stripes, file_size // MIN_STRIPE_SIZE))
+
+
+def range_crc32(file, offset, length):
+    crc = 0
+    while length > 0:
+        chunk = read_at(file, min(CRC_CHUNK, length), offset)
+        if not chunk:
+            break
+        crc = zlib.crc32(chunk, crc)
+        offset += len(chunk)
+        length -= len(chunk)
+    return crc
+
+
+class StripeHeader:
+    def __init__(self, transfer_id, file_size, offset, length, index, count, crc, filename):
+        self.transfer_id = transfer_id
+        self.file_size = file_size
+        self.offset = offset
+        self.length = length
+        self.index = index
+        self.count = count
+        self.crc = crc
+        self.filename = filename
+
+    def pack(self):
+        return STRIPE.pack(self.transfer_id, self.file_size, self.offset, self.length, self.index, self.count,
+                           self.crc) + self.filename.encode('utf-8')
+
+    @classmethod
+    def unpack(cls, payload):
+        fields = STRIPE.unpack_from(payload)
+        return cls(*fields, str(payload[STRIPE.size:], 'utf-8'))
+
+
+def open_shared(path, size):
+    # every stripe's receiver opens the same file, it is created once and never truncated below its size
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    if os.fstat(fd).st_size < size:
+        os.ftruncate(fd, size)
+    return os.fdopen(fd, 'r+b')
+
+
+def record_stripe(path, index, count):
+    # marks a verified stripe in a journal next to the file, returns how many stripes are done.
+    # Receivers of the same file may run in different processes, the journal is locked while it is updated.
+    journal = path + ".stripes"
+    fd = os.open(journal, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        os.lseek(fd, index, os.SEEK_SET)
+        os.write(fd, b'\x01')
+        os.lseek(fd, 0, os.SEEK_SET)
+        done = os.read(fd, count).count(1)
+        if done == count:
+            os.unlink(journal)
+        return done
+    finally:
+        os.close(fd)
@@ -0,0 +1,102 @@
+import hashlib
+import io
+import random
+from delta import chunks, chunk_level, Signature, build_patch, apply_patch, MIN_LEVEL, MAX_LEVEL, DELTA_PAGE
+
+
+def random_data(size, seed=1):
+    return random.Random(seed).randbytes(size)
+
+
+def test_chunks_cover_the_file():
+    data = random_data(300000)
+    pieces = list(chunks(io.BytesIO(data), MIN_LEVEL))
+    assert b''.join(piece for _, piece in pieces) == data
+    offsets = [offset for offset, _ in pieces]
+    assert offsets == sorted(offsets) and offsets[0] == 0
+    average = 1 << (2 * MIN_LEVEL)
+    assert all(len(piece) <= average * 4 for _, piece in pieces)
+
+
+def test_chunks_do_not_depend_on_the_read_size(monkeypatch):
+    data = random_data(200000)
+    expected = [piece for _, piece in chunks(io.BytesIO(data), MIN_LEVEL)]
+    monkeypatch.setattr("delta.READ_SIZE", 7000)
+    assert [piece for _, piece in chunks(io.BytesIO(data), MIN_LEVEL)] == expected
+
+
+def test_insertion_keeps_the_other_chunks():
+    data = random_data(400000)
+    changed = data[:200000] + b'inserted' + data[200000:]
+    before = {piece for _, piece in chunks(io.BytesIO(data), MIN_LEVEL)}
+    after = [piece for _, piece in chunks(io.BytesIO(changed), MIN_LEVEL)]
+    assert sum(piece in before for piece in after) >= len(after) - 3
+
+
+def test_chunk_level():
+    assert chunk_level(0) == MIN_LEVEL
+    assert chunk_level(1 << 40) == MAX_LEVEL
+
+
+def signature_pages(path, limit=1000):
+    # the receiver's signature as the sender fetches it, page by page
+    signature = Signature(level=MIN_LEVEL)
+    signature.compute(path)
+    fetched = Signature()
+    while fetched.add_page(signature.page(len(fetched.chunks), limit)):
+        pass
+    return signature, fetched
+
+
+def test_signature_pages(tmp_path):
+    path = tmp_path / "copy"
+    path.write_bytes(random_data(100000))
+    signature, fetched = signature_pages(str(path))
+    assert fetched.count == signature.count > 1
+    assert fetched.chunks == signature.chunks
+
+
+def test_signature_not_ready():
+    page = Signature(size=10).page(0, 1000)
+    assert len(page) == DELTA_PAGE.size
+    assert Signature().add_page(page) is None
+
+
+def test_patch_round_trip(tmp_path):
+    old = random_data(500000)
+    new = old[:100000] + random_data(5000, seed=2) + old[120000:400000] + old[450000:]
+    basis = tmp_path / "copy"
+    basis.write_bytes(old)
+    _, signature = signature_pages(str(basis))
+
+    with open(tmp_path / "new", 'wb') as file:
+        file.write(new)
+    with open(tmp_path / "new", 'rb') as file:
+        patch, patch_size, reused, digest = build_patch(file, signature, len(new))
+        assert file.tell() == 0
+    assert digest == hashlib.blake2b(new, digest_size=16).digest()
+    assert patch_size < len(new) // 4
+    assert reused > len(new) * 3 // 4
+
+    (tmp_path / "patch").write_bytes(patch.read())
+    assert apply_patch(str(basis), str(tmp_path / "patch"), str(tmp_path / "out"), len(new), digest)
+    assert (tmp_path / "out").read_bytes() == new
+
+
+def test_unrelated_file_is_not_patched(tmp_path):
+    basis = tmp_path / "copy"
+    basis.write_bytes(random_data(100000))
+    _, signature = signature_pages(str(basis))
+    new = random_data(100000, seed=3)
+    assert build_patch(io.BytesIO(new), signature, len(new)) is None
+
+
+def test_patch_against_another_copy_fails(tmp_path):
+    old = random_data(200000)
+    new = old[:150000] + b'changed' + old[150000:]
+    (tmp_path / "copy").write_bytes(old)
+    _, signature = signature_pages(str(tmp_path / "copy"))
+    patch, _, _, digest = build_patch(io.BytesIO(new), signature, len(new))
+    (tmp_path / "patch").write_bytes(patch.read())
+    (tmp_path / "other").write_bytes(random_data(200000, seed=4))
+    assert not apply_patch(str(tmp_path / "other"), str(tmp_path / "patch"), str(tmp_path / "out"), len(new), digest)
@@ -0,0 +1,74 @@
+import os
+import random
+import pytest
+from fec import FecEncoder, encode_parity, recover, parse_fec, gf_mul, gf_inv, MAX_GROUP, MAX_PARITY
+from frame_codec import FEC_GROUP
+
+
+def group(count, length=64, seed=1):
+    rng = random.Random(seed)
+    return [rng.randbytes(rng.randint(1, length)) for _ in range(count)]
+
+
+def test_field_inverse():
+    for a in range(1, 256):
+        assert gf_mul(a, gf_inv(a)) == 1
+
+
+def test_first_parity_is_xor():
+    fragments = [b'\x01\x02', b'\x10\x20', b'\xff\x00']
+    assert encode_parity(fragments, 0) == bytes([0x01 ^ 0x10 ^ 0xff, 0x02 ^ 0x20 ^ 0x00])
+
+
+def rebuild(fragments, parity, lost):
+    parities = {j: encode_parity(fragments, j) for j in range(parity)}
+    received = {i: data for i, data in enumerate(fragments) if i not in lost}
+    lengths = {i: len(data) for i, data in enumerate(fragments)}
+    return recover(received, parities, sorted(lost), lengths)
+
+
+def test_recover_one_loss():
+    fragments = group(16)
+    for lost in range(16):
+        assert rebuild(fragments, 1, {lost}) == {lost: fragments[lost]}
+
+
+@pytest.mark.parametrize("lost", [{0, 1}, {3, 15}, {2, 7, 11}, {0, 5, 9, 12}])
+def test_recover_several_losses(lost):
+    fragments = group(16, seed=len(lost))
+    rebuilt = rebuild(fragments, 4, lost)
+    assert rebuilt == {i: fragments[i] for i in lost}
+
+
+def test_recover_with_any_parities():
+    fragments = group(8)
+    parities = {j: encode_parity(fragments, j) for j in (1, 3)}
+    received = {i: data for i, data in enumerate(fragments) if i not in (2, 6)}
+    lengths = {i: len(data) for i, data in enumerate(fragments)}
+    assert recover(received, parities, [2, 6], lengths) == {2: fragments[2], 6: fragments[6]}
+
+
+def test_encoder_groups():
+    encoder = FecEncoder(4, 2)
+    fragments = [os.urandom(32) for _ in range(10)]
+    payloads = []
+    for fragment in fragments:
+        payloads += encoder.add(fragment)
+    assert len(payloads) == 4
+    payloads += encoder.flush()
+    assert len(payloads) == 6
+    assert encoder.flush() == []
+
+    headers = [FEC_GROUP.unpack_from(payload) for payload in payloads]
+    assert headers == [(0, 4, 0), (0, 4, 1), (4, 4, 0), (4, 4, 1), (8, 2, 0), (8, 2, 1)]
+    assert payloads[5][FEC_GROUP.size:] == encode_parity(fragments[8:], 1)
+
+
+def test_parse_fec():
+    assert parse_fec("16 2") == (16, 2)
+    assert parse_fec("off") is None
+    assert parse_fec(" None ") is None
+    with pytest.raises(ValueError):
+        parse_fec(f"{MAX_GROUP + 1} 1")
+    with pytest.raises(ValueError):
+        parse_fec(f"16 {MAX_PARITY + 1}")
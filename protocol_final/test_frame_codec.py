@@ -0,0 +1,93 @@
+import pytest
+import frame_codec
+from frame_codec import (encode, encode_into, decode, seal, read_checksum, handler_table, encode_sack, decode_sack,
+                         encode_capabilities, decode_capabilities, HEADER_LENGTH, MAX_SACK_BITS, SACK_HEADER,
+                         SUPPORTED_CAPABILITIES)
+from checksum import crc16
+
+
+def test_round_trip():
+    frame = decode(encode(4, 5, b'fragment data', fragmentSeq=0x1234, timestamp=200))
+    assert (frame.msgType, frame.flags, frame.fragmentSeq, frame.timeStamp) == (4, 5, 0x1234, 200)
+    assert bytes(frame.payload) == b'fragment data'
+    assert frame.valid
+
+
+def test_header_layout():
+    data = encode(3, 2, b'abc', fragmentSeq=7, timestamp=9)
+    assert len(data) == HEADER_LENGTH + 3
+    assert data[0] == 3 << 4 | 2
+    assert read_checksum(data) == crc16(b'abc')
+    assert data[3:5] == b'\x00\x07'
+    assert data[5] == 9
+
+
+def test_fragment_seq_is_truncated_to_16_bits():
+    assert decode(encode(4, 1, fragmentSeq=0x12345)).fragmentSeq == 0x2345
+
+
+def test_corrupted_payload_is_invalid():
+    data = encode(2, 1, b'hello')
+    data[-1] ^= 0x01
+    assert not decode(data).valid
+    assert decode(data, verify=False).valid
+
+
+def test_explicit_checksum_is_kept():
+    frame = decode(encode(2, 1, b'hello', checksum=0xBEEF))
+    assert frame.checksum == 0xBEEF
+    assert not frame.valid
+
+
+def test_encode_into_offset():
+    buf = bytearray(64)
+    length = encode_into(buf, 4, 5, b'xyz', fragmentSeq=3, timestamp=1, offset=10)
+    assert length == HEADER_LENGTH + 3
+    assert bytes(buf[:10]) == bytes(10)
+    assert bytes(decode(buf[10:10 + length]).payload) == b'xyz'
+
+
+def test_seal_payload_in_place():
+    buf = bytearray(HEADER_LENGTH) + b'payload'
+    seal(buf, len(buf), 4, 1, fragmentSeq=2)
+    assert buf == encode(4, 1, b'payload', fragmentSeq=2)
+
+
+def test_handler_table():
+    def text(frame): pass
+    def ack(frame): pass
+    table = handler_table([(2, (1, 2), text), (5, (1,), ack)])
+    assert len(table) == 256
+    assert table[2 << 4 | 1] is text and table[2 << 4 | 2] is text
+    assert table[5 << 4 | 1] is ack
+    assert table.count(None) == 253
+
+
+def test_sack_round_trip():
+    payload = encode_sack(100, [101, 103, 108, 200])
+    assert decode_sack(payload) == (100, [101, 103, 108, 200])
+
+
+def test_sack_without_selective():
+    payload = encode_sack(42)
+    assert len(payload) == SACK_HEADER.size
+    assert decode_sack(payload) == (42, [])
+
+
+def test_sack_drops_indexes_outside_the_bitmap():
+    payload = encode_sack(10, [5, 10, 11, 10 + MAX_SACK_BITS, 11 + MAX_SACK_BITS])
+    assert decode_sack(payload) == (10, [11, 10 + MAX_SACK_BITS])
+
+
+def test_capabilities():
+    assert decode_capabilities(encode_capabilities()) == SUPPORTED_CAPABILITIES
+    assert decode_capabilities(encode_capabilities(frame_codec.CAP_STREAMS)) == frame_codec.CAP_STREAMS
+    # a peer that sends no payload supports none of them
+    assert decode_capabilities(b'') == 0
+
+
+@pytest.mark.parametrize("size", [0, 1, 1400, 65507 - HEADER_LENGTH])
+def test_payload_sizes(size):
+    payload = bytes(range(256)) * (size // 256) + bytes(size % 256)
+    frame = decode(encode(4, 5, payload))
+    assert frame.valid and bytes(frame.payload) == payload
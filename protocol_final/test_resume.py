@@ -0,0 +1,60 @@
+import os
+from file_io import FragmentBitmap
+from resume import (encode_offer, decode_offer, encode_answer, decode_answer, answer_limit, save_manifest,
+                    load_manifest, remove_manifest)
+from frame_codec import RESUME_ANSWER
+
+
+def test_offer_round_trip():
+    identity = (123456789, 1700000000123456789, 2)
+    assert decode_offer(encode_offer(identity, 1400)) == (identity, 1400)
+
+
+def test_answer_round_trip():
+    ranges = [(0, 5), (9, 10), (20, 100)]
+    assert decode_answer(encode_answer(1400, ranges)) == (1400, ranges)
+    assert decode_answer(encode_answer(1400, [])) == (1400, [])
+
+
+def test_answer_fits_a_fragment():
+    limit = answer_limit(1400)
+    assert len(encode_answer(1400, [(i, i + 1) for i in range(limit)])) <= 1400
+    assert answer_limit(RESUME_ANSWER.size) == 1
+
+
+def test_manifest_round_trip(tmp_path):
+    path = str(tmp_path / "file.bin.manifest")
+    bitmap = FragmentBitmap(21)
+    for index in (0, 1, 2, 7, 8, 20):
+        bitmap.add(index)
+    save_manifest(path, (5000, 42, 0), 5000, 250, bitmap)
+    assert not os.path.exists(path + ".tmp")
+
+    manifest = load_manifest(path)
+    assert manifest["identity"] == (5000, 42, 0)
+    assert (manifest["file_size"], manifest["fragment_size"], manifest["fragment_count"]) == (5000, 250, 21)
+    restored = FragmentBitmap.restore(manifest["fragment_count"], manifest["bitmap"])
+    assert restored.received == 6 and restored.first_missing == 3 and restored.highest == 20
+    assert restored.missing_ranges() == bitmap.missing_ranges() == [(3, 7), (9, 20)]
+
+
+def test_bad_manifest_is_ignored(tmp_path):
+    path = tmp_path / "file.bin.manifest"
+    assert load_manifest(str(path)) is None
+    path.write_text("{not json")
+    assert load_manifest(str(path)) is None
+    path.write_text('{"identity": [1, 2, 0]}')
+    assert load_manifest(str(path)) is None
+
+
+def test_restore_ignores_bits_past_the_count():
+    bitmap = FragmentBitmap.restore(10, b'\xff\xff\xff')
+    assert bitmap.received == 10 and bitmap.is_complete()
+
+
+def test_remove_manifest(tmp_path):
+    path = tmp_path / "file.bin.manifest"
+    path.write_text("{}")
+    remove_manifest(str(path))
+    assert not path.exists()
+    remove_manifest(str(path))
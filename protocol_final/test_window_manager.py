@@ -0,0 +1,78 @@
+from window_manager import Packet, PacketRing, SenderWindow, ReceiverWindow, ring_capacity, MAX_SEQ_NUM
+
+SEQ_SPACE = MAX_SEQ_NUM + 1
+
+
+def test_ring_capacity():
+    assert [ring_capacity(size) for size in (1, 2, 3, 100, 128)] == [1, 2, 4, 128, 128]
+
+
+def test_packet_ring_across_the_wrap():
+    ring = PacketRing(8)
+    for seq_num in (SEQ_SPACE - 2, SEQ_SPACE - 1, 0, 1):
+        assert ring.put(Packet(seq_num, b'x')) is None
+    assert len(ring) == 4
+    assert SEQ_SPACE - 1 in ring and 0 in ring
+    # the slot of 6 is taken by SEQ_SPACE - 2, a different sequence number
+    assert 6 not in ring and ring.get(6) is None and ring.pop(6) is None
+    assert ring.pop(SEQ_SPACE - 2).sequence_number == SEQ_SPACE - 2
+    assert sorted(ring.keys()) == [0, 1, SEQ_SPACE - 1]
+
+
+def test_packet_ring_resend_replaces():
+    ring = PacketRing(4)
+    first = Packet(5, b'a')
+    ring.put(first)
+    assert ring.put(Packet(5, b'b')) is first
+    assert len(ring) == 1 and ring[5].payload == b'b'
+
+
+def test_receiver_window_across_the_wrap():
+    window = ReceiverWindow(4)
+    window.base = SEQ_SPACE - 2
+    assert window.is_in_window(1) and not window.is_in_window(2)
+    assert window.receive_packet(0, b'')
+    assert window.base == SEQ_SPACE - 2
+    assert window.receive_packet(SEQ_SPACE - 2, b'') and window.receive_packet(SEQ_SPACE - 1, b'')
+    assert window.base == 1
+    assert not window.receive_packet(SEQ_SPACE - 1, b'')
+
+
+def sent_window(first, count, size=16):
+    window = SenderWindow(size)
+    window.base = window.next_seq_num = window.loss_scan = first
+    for i in range(count):
+        seq_num = (first + i) % SEQ_SPACE
+        assert window.add_packet(Packet(seq_num, b'frame'))
+        window.next_seq_num = (seq_num + 1) % SEQ_SPACE
+    return window
+
+
+def test_process_sack_across_the_wrap():
+    window = sent_window(SEQ_SPACE - 3, 8)
+    acked = window.process_sack((SEQ_SPACE - 1), [0, 2])
+    assert sorted(packet.sequence_number for packet in acked) == [0, 2, SEQ_SPACE - 3, SEQ_SPACE - 2]
+    assert window.base == SEQ_SPACE - 1
+    assert window.bytes == 4 * len(b'frame')
+
+
+def test_stale_sack_acks_nothing():
+    window = sent_window(100, 4)
+    assert window.process_sack(90, []) == []
+    assert window.base == 100
+
+
+def test_highest_across_the_wrap():
+    window = SenderWindow(16)
+    assert window.highest(SEQ_SPACE - 4, [SEQ_SPACE - 2, 3, SEQ_SPACE - 1]) == 3
+    assert window.highest(10, [12, 11]) == 12
+
+
+def test_detect_losses_across_the_wrap():
+    window = sent_window(SEQ_SPACE - 4, 10)
+    cumulative, selective = SEQ_SPACE - 4, [SEQ_SPACE - 2, 0, 1, 2]
+    window.process_sack(cumulative, selective)
+    lost = window.detect_losses(window.highest(cumulative, selective))
+    # more than three packets after them arrived
+    assert [packet.sequence_number for packet in lost] == [SEQ_SPACE - 4, SEQ_SPACE - 3]
+    assert window.detect_losses(2) == []
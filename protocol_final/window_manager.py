@@ -1,46 +1,154 @@
 import socket
 import random
-import time
-from collections import deque
-import threading
+from checksum import crc16
+import frame_codec
+from congestion import MAX_WINDOW
+import metrics
 
 WINDOW_SIZE = 100
-TIMEOUT = 5000  # millisec.
+FILE_WINDOW_SIZE = MAX_WINDOW
+DUP_THRESHOLD = 3
 SEQ_NUM_BITS = 16
 MAX_SEQ_NUM = 2 ** SEQ_NUM_BITS - 1
+EXTENDED_SEQ_SPACE = 2 ** 32     # files with the negotiated 32-bit fragment index
+RETRANSMIT_BUDGET = 64 * 2 ** 20    # bytes of unacknowledged frames kept for retransmission, all windows together
 lastTimestamp = 0
 lastMessageCorrupted = False
-storedMessages = deque(maxlen=256)
+
+
+def next_timestamp():
+    global lastTimestamp
+    lastTimestamp = (lastTimestamp + 1) % 256
+    return lastTimestamp
 
 
 class Packet:
-    def __init__(self, sequence_number, payload, send_time=None):
+    def __init__(self, sequence_number, payload, send_time=None, stream_id=None, buffer=None, pool=None):
         self.sequence_number = sequence_number
+        self.stream_id = stream_id  # None for packets of sender_window
         self.payload = payload
+        self.buffer = buffer        # FramePool buffer the payload was framed in, see frame_pool.py
+        self.pool = pool
         self.send_time = send_time
         self.acknowledged = False
+        self.retransmissions = 0
+        self.timer = None          # retransmission timer, see Session.track
 
-class SenderWindow:
+def ring_capacity(size):
+    # power of two, so it divides the sequence space and seq % capacity stays in step across the wrap
+    return 1 << max(0, size - 1).bit_length()
+
+
+class PacketRing:
+    # the packets of a window in a list indexed by seq % capacity, with the few dict methods the engines use.
+    # The window keeps every packet within size sequence numbers of its base, so two never share a slot
     def __init__(self, size):
+        self.mask = ring_capacity(size) - 1
+        self.slots = [None] * (self.mask + 1)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def get(self, seq_num, default=None):
+        packet = self.slots[seq_num & self.mask]
+        if packet is not None and packet.sequence_number == seq_num:
+            return packet
+        return default
+
+    def __contains__(self, seq_num):
+        return self.get(seq_num) is not None
+
+    def __getitem__(self, seq_num):
+        packet = self.get(seq_num)
+        if packet is None:
+            raise KeyError(seq_num)
+        return packet
+
+    def put(self, packet):
+        # returns the packet that had the slot, the same sequence number sent again
+        index = packet.sequence_number & self.mask
+        previous = self.slots[index]
+        self.slots[index] = packet
+        if previous is None:
+            self.count += 1
+        return previous
+
+    def pop(self, seq_num, default=None):
+        index = seq_num & self.mask
+        packet = self.slots[index]
+        if packet is None or packet.sequence_number != seq_num:
+            return default
+        self.slots[index] = None
+        self.count -= 1
+        return packet
+
+    def values(self):
+        return [packet for packet in self.slots if packet is not None] if self.count else []
+
+    def keys(self):
+        return [packet.sequence_number for packet in self.values()]
+
+    def clear(self):
+        if self.count:
+            self.slots = [None] * len(self.slots)
+            self.count = 0
+
+
+class SenderWindow:
+    # packets holds the only copy of every frame that may have to be sent again, by sequence number.
+    # A frame leaves it when it is acknowledged or given up, bytes is the size of the frames still there.
+    # Sequence numbers in flight span at most size from the base, so packets can be a ring instead of a dict
+    def __init__(self, size, seq_space=MAX_SEQ_NUM + 1):
         self.size = size
+        self.seq_space = seq_space
         self.base = 0
         self.next_seq_num = 0
-        self.packets = {}
+        self.packets = PacketRing(size)
+        self.bytes = 0
+        self.failed = False  # a packet ran out of retransmissions
+        self.loss_scan = 0   # packets before this one were already looked at by detect_losses
 
     def is_full(self):
-        return len(self.packets) >= self.size
+        # a packet that is still missing at the base holds the window, however many behind it were acked
+        return (len(self.packets) >= self.size or
+                (self.next_seq_num - self.base) % self.seq_space >= self.size)
 
     def can_send(self, seq_num):
-        return (seq_num >= self.base and
-                seq_num < self.base + self.size and
+        return ((seq_num - self.base) % self.seq_space < self.size and
                 len(self.packets) < self.size)
 
+    def sent(self):
+        # packets from the base that were sent, only those can be acknowledged or given up
+        return (self.next_seq_num - self.base) % self.seq_space
+
     def add_packet(self, packet):
         if self.can_send(packet.sequence_number):
-            self.packets[packet.sequence_number] = packet
+            self.store(packet)
             return True
         return False
 
+    def store(self, packet):
+        previous = self.packets.put(packet)
+        if previous is not None:
+            self.release(previous)
+        self.bytes += len(packet.payload)
+
+    def release(self, packet):
+        # a packet can outlive its place in the window (a timer that is due, a list of lost packets),
+        # without the frame that costs a few bytes instead of a fragment
+        self.bytes -= len(packet.payload)
+        packet.payload = None
+        if packet.buffer is not None:
+            packet.pool.release(packet.buffer)
+            packet.buffer = None
+
+    def clear(self):
+        # a transfer that gave up hands back the frames it still holds
+        for packet in self.packets.values():
+            self.release(packet)
+        self.packets.clear()
+
     # def remove_packet(self, seq_num):
     #     if seq_num in self.packets:
     #         del self.packets[seq_num]
@@ -50,104 +158,118 @@ class SenderWindow:
     #
 
     def remove_packet(self, seq_num):
-        if seq_num in self.packets:
-            del self.packets[seq_num]
-
-        while self.base not in self.packets and self.base != self.next_seq_num:
-            self.base = (self.base + 1) % (MAX_SEQ_NUM + 1)
-
-        if self.base > self.next_seq_num:
+        packet = self.packets.pop(seq_num, None)
+        if packet is not None:
+            self.release(packet)
+        self.slide()
+
+    def slide(self):
+        # every sequence number is passed once, so sliding costs O(1) per packet
+        if not self.packets:
             self.base = self.next_seq_num
+            return
+        while self.base not in self.packets and self.base != self.next_seq_num:
+            self.base = (self.base + 1) % self.seq_space
+
+    def resolve(self, seq_num):
+        # a 16-bit header sequence number (NAKs) back to the full sequence number of a packet in the window
+        return (self.base + (seq_num - self.base) % (MAX_SEQ_NUM + 1)) % self.seq_space
+
+    def process_sack(self, cumulative, selective):
+        # acknowledge every packet below the cumulative point plus the selectively acked ones
+        seq_space = self.seq_space
+        sent = self.sent()
+        cumulative_offset = (cumulative - self.base) % seq_space
+        if cumulative_offset > sent:
+            # stale SACK from before the current base, or a resumed receiver that already had everything sent
+            cumulative_offset = sent if cumulative_offset < seq_space // 2 else 0
+
+        acked = []
+        for offset in range(cumulative_offset):
+            packet = self.packets.pop((self.base + offset) % seq_space)
+            if packet is not None:
+                acked.append(packet)
+        for index in selective:
+            packet = self.packets.pop(index % seq_space)
+            if packet is not None:
+                acked.append(packet)
+
+        for packet in acked:
+            packet.acknowledged = True
+            self.release(packet)
+        self.slide()
+        return acked
+
+    def highest(self, cumulative, selective):
+        # selectively acked sequence numbers all follow the cumulative point, count from there across the wrap
+        return max(selective, key=lambda seq_num: (seq_num - cumulative) % self.seq_space)
+
+    def detect_losses(self, highest_acked, threshold=DUP_THRESHOLD):
+        # packets sent more than threshold packets before one the receiver already has are treated as lost,
+        # each packet is fast retransmitted only once, after that the timer takes over. The callers resend
+        # what this returns, so the next call starts where this one stopped
+        seq_space = self.seq_space
+        in_flight = self.sent()
+        limit = (highest_acked - self.base) % seq_space - threshold
+        if limit > in_flight:
+            return []   # stale SACK
+        start = (self.loss_scan - self.base) % seq_space
+        if start > in_flight:
+            start = 0
+        lost = []
+        for offset in range(start, limit):
+            packet = self.packets.get((self.base + offset) % seq_space)
+            if packet is not None and packet.retransmissions == 0:
+                lost.append(packet)
+        if limit > start:
+            self.loss_scan = (self.base + limit) % seq_space
+        return lost
 
 class ReceiverWindow:
-    def __init__(self, size):
+    # one flag per slot of a ring like PacketRing, for the sequence numbers that arrived ahead of the base
+    def __init__(self, size, seq_space=MAX_SEQ_NUM + 1):
         self.size = size
+        self.seq_space = seq_space
         self.base = 0
-        self.received_buffer = {}
+        self.mask = ring_capacity(size) - 1
+        self.received = bytearray(self.mask + 1)
 
     def is_in_window(self, seq_num):
-        if self.base <= seq_num < self.base + self.size:
-            return True
-        # Handle wrap-around
-        if self.base + self.size > MAX_SEQ_NUM:
-            if seq_num >= self.base or seq_num < (self.base + self.size) % (MAX_SEQ_NUM + 1):
-                return True
-        return False
+        # distance from the base modulo the sequence space, so the window may straddle the wrap
+        return (seq_num - self.base) % self.seq_space < self.size
 
     def receive_packet(self, seq_num, payload):
         if self.is_in_window(seq_num):
-            self.received_buffer[seq_num] = payload
+            self.received[seq_num & self.mask] = 1
 
-            while self.base in self.received_buffer:
-                del self.received_buffer[self.base]
-                self.base = (self.base + 1) % (MAX_SEQ_NUM + 1)
+            while self.received[self.base & self.mask]:
+                self.received[self.base & self.mask] = 0
+                self.base = (self.base + 1) % self.seq_space
             return True
         return False
 
 def hashMSG(bytes):
-    crc = 0xFFFF
-    polynomial = 0x1021
-
-    for byte in bytes:
-        crc ^= byte << 8
-        for i in range(8):
-            if crc & 0x8000:
-                crc = (crc << 1) ^ polynomial
-            else:
-                crc <<= 1
-            crc &= 0xFFFF
-    return crc
+    return crc16(bytes)
 
 
 class manager:
-    def __init__(self, msgType: int, flags: int = 0, payload=[], fragmentSeq: int = 0, timestamp=None,
+    def __init__(self, msgType: int, flags: int = 0, payload=b'', fragmentSeq: int = 0, timestamp=None,
                      checksum=None):
-        global lastTimestamp
-
-        infoList = []
-        infoList.append((msgType << 4) | flags)
-        infoList.append((fragmentSeq >> 8) & 0xFF)
-        infoList.append(fragmentSeq & 0xFF)
         if timestamp is None:
-            infoList.append((lastTimestamp + 1) % 256)
-            self.timestamp = (lastTimestamp + 1) % 256
-            lastTimestamp = (lastTimestamp + 1) % 256
+            self.timestamp = next_timestamp()
         else:
             self.timestamp = timestamp % 256
-            infoList.append(self.timestamp)
 
-        for b in payload:
-            if not (0 <= b < 256):
-                print(f"Invalid byte value: {b}")
-            infoList.append(b if 0 <= b < 256 else 0)
-
-        if checksum is not None:
-            self.checksum = checksum
-        else:
-            payload_bytes = bytes(infoList[4:])
-            self.checksum = hashMSG(payload_bytes)
-
-        self.bytes = bytes(infoList)
-        self.bytes = (self.bytes[:1] + self.checksum.to_bytes(2, byteorder='big') + self.bytes[1:])
+        self.bytes = frame_codec.encode(msgType, flags, payload, fragmentSeq, self.timestamp, checksum)
+        self.checksum = frame_codec.read_checksum(self.bytes)
 
     def parse(self):
         global lastMessageCorrupted
-        message = {
-                'msgType': (self.bytes[0] >> 4),
-                'flags': self.bytes[0] & 15,
-                'checksum': self.bytes[1:3],
-                'fragmentSeq': (self.bytes[3] << 8) | self.bytes[4],
-                'timeStamp': int.from_bytes(self.bytes[5:6], byteorder='big'),
-                'payload': self.bytes[6:]
-        }
-
-        payload_checksum = hashMSG(message['payload'])
-        received_checksum = int.from_bytes(message['checksum'], byteorder='big')
-
-        if payload_checksum != received_checksum:
-            lastMessageCorrupted = True
-            print(f"Checksum mismatch: expected {received_checksum}, got {payload_checksum}")
+        message = frame_codec.decode(self.bytes)
 
+        if not message.valid:
+            lastMessageCorrupted = True
+            print(f"Checksum mismatch: expected {message.checksum}, got {hashMSG(message.payload)}")
 
         return message
 
@@ -158,7 +280,7 @@ class manager:
     def fromMessageBytes(cls, messageBytes):
         obj = cls.__new__(cls)
         obj.bytes = messageBytes
-        obj.checksum = int.from_bytes(obj.bytes[1:3], byteorder='big')
+        obj.checksum = frame_codec.read_checksum(messageBytes)
         return obj
 
 
@@ -171,47 +293,20 @@ def getIpAddress():
         s.close()
     return ipAddress
 
-def sendMSG(sock, message: manager, ip, port, storeMessage=True, sendBadMessage=False):
-    if storeMessage:
-        storedMessages.append(message)
-    bytesToSend = message.bytes
-    if sendBadMessage:
-        byteData = bytearray(message.bytes)
-        byteData[random.randint(6, len(byteData) - 1)] = random.randint(0, 255)
-        bytesToSend = bytes(byteData)
+def sendMSG(sock, message: manager, ip, port, sendBadMessage=False):
+    sendFrame(sock, message.bytes, ip, port, sendBadMessage)
 
+def sendFrame(sock, frame, ip, port, sendBadMessage=False):
+    # frame: bytes, bytearray or a view of a pooled buffer, sent as it is
+    bytesToSend = corrupt_frame(frame) if sendBadMessage else frame
     sock.sendto(bytesToSend, (ip, port))
+    metrics.on_sent(bytesToSend)
 
-def findStoredMessage(timestamp):
-    for message in storedMessages:
-        if message.timestamp == timestamp:
-            return message
-    return None
-
-class WindowManager:
-    def __init__(self):
-        self.sender_window = None
-        self.receiver_window = None
-        self.window_lock = threading.Lock()
-window_manager = WindowManager()
-
-def handle_nak(parsedMessage, fragmentSeq, sock, ip, port):
-    print(f"Processing NAK for sequence number {fragmentSeq}")
-
-    if window_manager.sender_window and fragmentSeq in window_manager.sender_window.packets:
-        packet = window_manager.sender_window.packets[fragmentSeq]
-        message = manager.fromMessageBytes(packet.payload)
-
-        print(f"Resending packet {fragmentSeq}")
-        sendMSG(sock, message, ip, port, sendBadMessage=False)
-        packet.send_time = time.time()
-
-        packet.acknowledged = False
-        # Add to sender window
-        window_manager.sender_window.add_packet(packet)
-
-    else:
-        print(f"Packet {fragmentSeq} not found in window")
+def corrupt_frame(frame):
+    # a copy of the frame with a random payload byte overwritten, !err sends these
+    byteData = bytearray(frame)
+    byteData[random.randint(6, len(byteData) - 1)] = random.randint(0, 255)
+    return bytes(byteData)
 
 def calculate_checksum(msg):
     return hashMSG(msg)
\ No newline at end of file